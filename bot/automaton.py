@@ -0,0 +1,106 @@
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+
+# Transitions are built in one dict keyed by node * STRIDE + code point,
+# which takes a fraction of the memory of a dict per node
+STRIDE = 0x110000
+
+
+class Automaton(object):
+    """Aho-Corasick automaton telling which of many patterns occur in a text
+    in one pass over it, however many patterns there are.
+
+    It's kept in flat arrays only: edges of node n are edge_codes and
+    edge_targets[edge_bounds[n]:edge_bounds[n + 1]], sorted by code point.
+    So a snapshot can map an automaton from a file as it is, see
+    `bot.snapshots`, and the processes of a host share one copy"""
+    ARRAYS = (
+        ('edge_bounds', 'I'), ('edge_codes', 'I'), ('edge_targets', 'I'),
+        ('output', 'i'), ('fail', 'I'), ('link', 'I'),
+    )
+
+    def __init__(self, edge_bounds, edge_codes, edge_targets, output, fail, link):
+        self.edge_bounds = edge_bounds
+        self.edge_codes = edge_codes
+        self.edge_targets = edge_targets
+        self.output = output
+        self.fail = fail
+        self.link = link
+        # Searches fall back to the root all the time, its edges are looked up in a dict
+        start, end = edge_bounds[0], edge_bounds[1]
+        self._root = dict(zip(edge_codes[start:end], edge_targets[start:end]))
+
+
+    @classmethod
+    def build(cls, patterns):
+        goto = {}
+        children = [[]]
+        output = [-1]
+        for j, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                code = ord(char)
+                following = goto.get(node * STRIDE + code)
+                if following is None:
+                    following = goto[node * STRIDE + code] = len(output)
+                    output.append(-1)
+                    children.append([])
+                    children[node].append(code)
+                node = following
+            output[node] = j
+
+        # Failure links, and links to the nearest node on the failure chain
+        # that ends a pattern, set in breadth-first order
+        output = array('i', output)
+        fail = array('I', [0]) * len(output)
+        link = array('I', [0]) * len(output)
+        queue = deque([0])
+        while queue:
+            node = queue.popleft()
+            for code in children[node]:
+                following = goto[node * STRIDE + code]
+                if node:
+                    failed = fail[node]
+                    while failed and failed * STRIDE + code not in goto:
+                        failed = fail[failed]
+                    failed = fail[following] = goto.get(failed * STRIDE + code, 0)
+                    link[following] = failed if output[failed] >= 0 else link[failed]
+                queue.append(following)
+
+        edge_bounds, edge_codes, edge_targets = array('I', [0]), array('I'), array('I')
+        for node, codes in enumerate(children):
+            for code in sorted(codes):
+                edge_codes.append(code)
+                edge_targets.append(goto[node * STRIDE + code])
+            edge_bounds.append(len(edge_codes))
+        return cls(edge_bounds, edge_codes, edge_targets, output, fail, link)
+
+
+    def __len__(self):
+        return len(self.output)
+
+
+    def search(self, text):
+        "Indexes of the patterns occurring in the text"
+        bounds, codes, targets = self.edge_bounds, self.edge_codes, self.edge_targets
+        fail, output, link, root = self.fail, self.output, self.link, self._root.get
+        found = set()
+        node = 0
+        for char in text:
+            code = ord(char)
+            while node:
+                start, stop = bounds[node], bounds[node + 1]
+                i = bisect_left(codes, code, start, stop)
+                if i < stop and codes[i] == code:
+                    node = targets[i]
+                    break
+                node = fail[node]
+            else:
+                node = root(code, 0)
+            end = node if output[node] >= 0 else link[node]
+            while end:
+                found.add(output[end])
+                end = link[end]
+        return found
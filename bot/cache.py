@@ -0,0 +1,315 @@
+import logging
+import os
+import pickle
+import time
+import uuid
+
+import redis
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+
+from .lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class TwoTierCache(BaseCache):
+    """Django cache backend with a small per-process LRU in front of Redis.
+
+    Redis is the shared tier every process reads and writes through, the
+    local tier only saves round-trips for hot, read-mostly entries. Every
+    write and delete is published on INVALIDATION_CHANNEL and the other
+    processes drop their local copies. Local copies also expire after
+    LOCAL_TIMEOUT seconds, which bounds staleness if a message is missed,
+    and never outlive the entry in Redis. Atomic operations (`add`, `incr`)
+    go to Redis.
+
+    When Redis can't be reached the cache keeps working on the local tier
+    alone: reads are served from it, writes only go to it and `add` is
+    atomic within the process. Once Redis is back the local tier is
+    cleared, as invalidations may have been missed meanwhile. `incr`
+    raises, it can't be done right without Redis.
+
+        CACHES = {
+            'default': {
+                'BACKEND': 'bot.cache.TwoTierCache',
+                'LOCATION': 'redis://redis:6379/0',
+                'OPTIONS': {'LOCAL_MAXSIZE': 1024, 'LOCAL_TIMEOUT': 5},
+            }
+        }
+    """
+    INVALIDATION_CHANNEL = 'cache-invalidation'
+    # Seconds to wait before trying to subscribe again when Redis is down
+    LISTEN_RETRY = 5
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._client = redis.Redis.from_url(location, socket_connect_timeout=options.get('CONNECT_TIMEOUT', 1))
+        self._local = LRUCache(maxsize=options.get('LOCAL_MAXSIZE', 1024), ttl=options.get('LOCAL_TIMEOUT', 5))
+        # Tells own invalidation messages from other processes' ones
+        self._origin = uuid.uuid4().hex
+        self._listener = None
+        self._listener_pid = None
+        self._listen_at = 0
+
+
+    def _listen(self):
+        """Subscribe to invalidations once per process, workers are forked,
+        and again if the subscription was lost with the connection"""
+        if self._listener_pid == os.getpid() and self._listener.is_alive():
+            return
+        if self._listener_pid == os.getpid() and time.monotonic() < self._listen_at:
+            return
+        self._listen_at = time.monotonic() + self.LISTEN_RETRY
+        self._origin = uuid.uuid4().hex
+        try:
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.INVALIDATION_CHANNEL: self._invalidated})
+        except redis.RedisError as e:
+            logger.warning("Can't subscribe to cache invalidations: {}".format(e))
+            self._listener_pid = os.getpid()
+            self._listener = _DEAD_LISTENER
+            return
+        self._listener = pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+        self._listener_pid = os.getpid()
+        # Copies made before, in the parent process or while Redis was
+        # down, may have missed invalidations
+        self._local.clear()
+
+
+    def _invalidated(self, message):
+        origin, _, key = message['data'].decode().partition(':')
+        if origin == self._origin:
+            return
+        if key:
+            self._local.delete(key)
+        else:
+            self._local.clear()
+
+
+    def _redis(self, command, *args, **kwargs):
+        "Run the Redis command, return UNAVAILABLE if Redis can't be reached"
+        try:
+            return getattr(self._client, command)(*args, **kwargs)
+        except redis.RedisError as e:
+            logger.warning("Redis {} failed, using the local cache: {}".format(command, e))
+            return UNAVAILABLE
+
+
+    def _publish(self, key=''):
+        "Drop the key, or everything if no key given, from other processes' local tiers"
+        self._redis('publish', self.INVALIDATION_CHANNEL, '{}:{}'.format(self._origin, key))
+
+
+    def _timeout(self, timeout):
+        "Seconds the entry should live for, None for forever"
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return timeout
+
+
+    def _local_timeout(self, timeout):
+        if timeout is None:
+            return None
+        return min(timeout, self._local.ttl)
+
+
+    def _remote_timeout(self, pttl):
+        "Local timeout of an entry read from Redis with the given PTTL"
+        return self._local_timeout(pttl / 1000 if pttl >= 0 else None)
+
+
+    def _store(self, key, value, timeout, nx=False):
+        """Write the entry to Redis. Returns whether it's written,
+        or UNAVAILABLE if Redis can't be reached"""
+        if timeout is not None and timeout <= 0:
+            self._local.delete(key)
+            self._redis('delete', key)
+            return False
+        px = int(timeout * 1000) if timeout is not None else None
+        return self._redis('set', key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), px=px, nx=nx)
+
+
+    def _read(self, keys):
+        "Values and PTTLs of the keys in Redis, or UNAVAILABLE"
+        try:
+            with self._client.pipeline(transaction=False) as pipe:
+                pipe.mget(keys)
+                for key in keys:
+                    pipe.pttl(key)
+                data, *ttls = pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Redis read failed, using the local cache: {}".format(e))
+            return UNAVAILABLE
+        return zip(keys, data, ttls)
+
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._listen()
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        timeout = self._timeout(timeout)
+        stored = self._store(key, value, timeout, nx=True)
+        if stored is UNAVAILABLE:
+            return self._local.add(key, value, self._local_timeout(timeout))
+        if not stored:
+            return False
+        self._local.set(key, value, self._local_timeout(timeout))
+        self._publish(key)
+        return True
+
+
+    def get(self, key, default=None, version=None):
+        return self.get_many([key], version=version).get(key, default)
+
+
+    def get_many(self, keys, version=None):
+        self._listen()
+        found, remote = {}, {}
+        missing = object()
+        for key in keys:
+            made = self.make_key(key, version=version)
+            self.validate_key(made)
+            value = self._local.get(made, missing)
+            if value is missing:
+                remote[made] = key
+            else:
+                found[key] = value
+        if remote:
+            read = self._read(list(remote))
+            if read is UNAVAILABLE:
+                return found
+            for made, data, pttl in read:
+                if data is not None:
+                    found[remote[made]] = value = pickle.loads(data)
+                    self._local.set(made, value, self._remote_timeout(pttl))
+        return found
+
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._listen()
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        timeout = self._timeout(timeout)
+        # Without Redis the local tier keeps the entry
+        if self._store(key, value, timeout) in (True, UNAVAILABLE):
+            self._local.set(key, value, self._local_timeout(timeout))
+        self._publish(key)
+
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        timeout = self._timeout(timeout)
+        if timeout is None:
+            touched = self._redis('persist', key)
+        else:
+            touched = self._redis('pexpire', key, int(timeout * 1000))
+            # The local copy mustn't outlive the new expiry
+            self._local.delete(key)
+        return touched is not UNAVAILABLE and bool(touched)
+
+
+    def delete(self, key, version=None):
+        self._listen()
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._local.delete(key)
+        self._redis('delete', key)
+        self._publish(key)
+
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        exists = self._redis('exists', key)
+        if exists is UNAVAILABLE:
+            return self._local.get(key, UNAVAILABLE) is not UNAVAILABLE
+        return bool(exists)
+
+
+    def incr(self, key, delta=1, version=None):
+        # Read-modify-write of the pickled value inside a transaction,
+        # retried if another process changes the key meanwhile
+        self._listen()
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    data = pipe.get(key)
+                    if data is None:
+                        raise ValueError("Key '%s' not found" % key)
+                    value = pickle.loads(data) + delta
+                    ttl = pipe.pttl(key)
+                    pipe.multi()
+                    pipe.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), px=ttl if ttl > 0 else None)
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        self._local.delete(key)
+        self._publish(key)
+        return value
+
+
+    def clear(self):
+        """Delete the entries of this cache only. The Redis database may be
+        shared with Celery, so it is never flushed as a whole."""
+        self._listen()
+        self._local.clear()
+        pattern = '{}:*'.format(self.key_prefix)
+        try:
+            for keys in _chunks(self._client.scan_iter(match=pattern, count=1000), 1000):
+                self._client.delete(*keys)
+        except redis.RedisError as e:
+            logger.warning("Can't clear the cache in Redis: {}".format(e))
+            return
+        self._publish()
+
+
+# Returned by `TwoTierCache._redis` when Redis can't be reached
+UNAVAILABLE = object()
+
+
+class _DeadListener(object):
+    "Listener of a process that couldn't subscribe to invalidations"
+
+    def is_alive(self):
+        return False
+
+
+_DEAD_LISTENER = _DeadListener()
+
+
+class SweptFileBasedCache(FileBasedCache):
+    """Django's file cache that can remove its expired entries. The file
+    cache only notices an entry has expired when reading it, so entries
+    that are never read again, like dedup records, pile up on disk
+    until `sweep` is called, see `bot.tasks.sweep_cache`."""
+
+    def sweep(self):
+        "Remove expired entries, return the number of removed ones"
+        removed = 0
+        for fname in self._list_cache_files():
+            try:
+                with open(fname, 'rb') as f:
+                    # Deletes the file if it has expired
+                    removed += self._is_expired(f)
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
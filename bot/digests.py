@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import redis
+from tdigest import TDigest
+
+
+logger = logging.getLogger(__name__)
+
+# What the matching records, per chat and per keyword
+MATCH_COST = 'match_cost'
+MESSAGE_LENGTH = 'message_length'
+FORWARD_LATENCY = 'forward_latency'
+METRICS = (MATCH_COST, MESSAGE_LENGTH, FORWARD_LATENCY)
+
+CHAT = 'chat'
+KEYWORD = 'keyword'
+
+# Every process keeps digests of what it recorded in the current hour,
+# merged on every snapshot, and writes the ones that changed to its own
+# hash of the hour, a field per (scope, id, metric). Readers merge the
+# hashes of all processes over the hours they are asked for, so nothing
+# recorded is ever dropped, and a hash holds one digest per field however
+# many snapshots the process takes.
+SNAPSHOT_INTERVAL = 60
+SNAPSHOT_KEY = 'digests:{hour}:{process}'
+# Processes that wrote digests in the hour
+PROCESSES_KEY = 'digests:{hour}:processes'
+SNAPSHOT_RETENTION = 48 * 60 * 60
+# Samples a process buffers between snapshots, the rest are dropped
+MAX_SAMPLES = 100000
+
+# Raw samples are buffered on the message path and only folded into
+# digests by the snapshot thread of the process
+_lock = threading.Lock()
+_samples = []
+_dropped = 0
+_flusher_pid = None
+_client = None
+
+# Digests of the current hour of this process, and the keys not written yet
+_snapshot_lock = threading.Lock()
+_hour_digests = {}
+_digests_hour = None
+_unsaved = set()
+# Name of the process' hashes, a new one in every forked child
+_process = None
+_process_pid = None
+
+
+def _redis():
+    global _client
+    if _client is None and os.environ.get('REDIS_URL'):
+        _client = redis.Redis.from_url(os.environ.get('REDIS_URL'))
+    return _client
+
+
+def _hour(timestamp):
+    return int(timestamp // 3600)
+
+
+def _start_flusher():
+    "Start the snapshot thread once per process, workers are forked"
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+
+    def flush():
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            try:
+                snapshot()
+            except Exception:
+                logger.exception("(flush) cannot snapshot digests")
+
+    threading.Thread(target=flush, name='digests', daemon=True).start()
+
+
+def record(chat_id, keyword_ids, metric, value):
+    "Buffer the value for digests of the chat and of the keywords"
+    global _dropped
+    _start_flusher()
+    with _lock:
+        if len(_samples) < MAX_SAMPLES:
+            _samples.append((chat_id, keyword_ids, metric, value))
+        else:
+            _dropped += 1
+
+
+def _digests(samples):
+    "Digests of the samples keyed by (scope, id, metric)"
+    values = defaultdict(list)
+    for chat_id, keyword_ids, metric, value in samples:
+        values[(CHAT, chat_id, metric)].append(value)
+        for keyword_id in keyword_ids:
+            values[(KEYWORD, keyword_id, metric)].append(value)
+    digests = {}
+    for key, batch in values.items():
+        digest = digests[key] = TDigest()
+        digest.batch_update(batch)
+        digest.compress()
+    return digests
+
+
+def _field(scope, pk, metric):
+    return '{}:{}:{}'.format(scope, pk, metric)
+
+
+def _process_name():
+    global _process, _process_pid
+    if _process_pid != os.getpid():
+        _process, _process_pid = uuid.uuid4().hex, os.getpid()
+    return _process
+
+
+def snapshot():
+    "Merge the samples buffered by this process into its digests of the hour and write them to Redis"
+    global _samples, _dropped, _hour_digests, _digests_hour
+    with _lock:
+        samples, _samples = _samples, []
+        dropped, _dropped = _dropped, 0
+    if dropped:
+        logger.warning("(snapshot) dropped {} samples over MAX_SAMPLES".format(dropped))
+    client = _redis()
+    if client is None:
+        return
+
+    with _snapshot_lock:
+        hour = _hour(time.time())
+        if hour != _digests_hour:
+            if _unsaved:
+                logger.warning("(snapshot) dropped {} digests of the last hour not written".format(len(_unsaved)))
+            _hour_digests, _digests_hour = {}, hour
+            _unsaved.clear()
+        for key, digest in _digests(samples).items():
+            current = _hour_digests.get(key)
+            if current is None:
+                _hour_digests[key] = digest
+            else:
+                current.update_centroids_from_list(digest.centroids_to_list())
+                current.compress()
+            _unsaved.add(key)
+        if not _unsaved:
+            return
+
+        fields = {_field(*key): json.dumps(_hour_digests[key].centroids_to_list()) for key in _unsaved}
+        key = SNAPSHOT_KEY.format(hour=hour, process=_process_name())
+        processes = PROCESSES_KEY.format(hour=hour)
+        try:
+            with client.pipeline() as pipe:
+                pipe.hmset(key, fields)
+                pipe.expire(key, SNAPSHOT_RETENTION)
+                pipe.sadd(processes, _process_name())
+                pipe.expire(processes, SNAPSHOT_RETENTION)
+                pipe.execute()
+        except redis.RedisError:
+            # Written with the next snapshot
+            logger.exception("(snapshot) cannot write {} digests".format(len(fields)))
+            return
+        _unsaved.clear()
+
+
+def merged(hours=24, scope=None, metric=None):
+    """Return digests merged over the last `hours` hours of snapshots
+    of all processes, keyed by (scope, id, metric)"""
+    client = _redis()
+    result = defaultdict(TDigest)
+    if client is None:
+        return result
+    match = _field(scope or '*', '*', metric or '*')
+    now = _hour(time.time())
+    for hour in range(now - hours + 1, now + 1):
+        for process in client.smembers(PROCESSES_KEY.format(hour=hour)):
+            key = SNAPSHOT_KEY.format(hour=hour, process=process.decode())
+            for field, centroids in client.hscan_iter(key, match=match):
+                field_scope, pk, field_metric = field.decode().split(':')
+                result[(field_scope, int(pk), field_metric)].update_centroids_from_list(json.loads(centroids))
+    return result
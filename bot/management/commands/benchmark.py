@@ -0,0 +1,167 @@
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from bot import matching, subscriptions, utils
+from bot.models import Chat, Keyword, NegativeKeyword, Relation, User
+
+
+LATIN = 'abcdefghijklmnopqrstuvwxyz'
+CYRILLIC = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюяіїєґ'
+
+
+class Rollback(Exception):
+    "Raised to throw the synthetic data away"
+
+
+def percentiles(samples, scale=1):
+    samples = sorted(samples)
+    pick = lambda p: samples[min(int(len(samples) * p / 100), len(samples) - 1)] * scale
+    return {
+        'mean': statistics.mean(samples) * scale,
+        'p50': pick(50),
+        'p95': pick(95),
+        'p99': pick(99),
+    }
+
+
+class Corpus(object):
+    "Synthetic words, keys and messages, the same for the same seed"
+
+    def __init__(self, seed, cyrillic_share):
+        self.random = random.Random(seed)
+        self.cyrillic_share = cyrillic_share
+        self.vocabulary = [self.word() for _ in range(20000)]
+
+
+    def word(self):
+        alphabet = CYRILLIC if self.random.random() < self.cyrillic_share else LATIN
+        return ''.join(self.random.choice(alphabet) for _ in range(self.random.randint(3, 10)))
+
+
+    def keys(self, count):
+        keys = set()
+        while len(keys) < count:
+            keys.add(' '.join(self.random.choice(self.vocabulary) for _ in range(self.random.choice((1, 1, 1, 2)))))
+        return list(keys)
+
+
+    def message(self, keys, hit_rate):
+        words = [self.random.choice(self.vocabulary) for _ in range(self.random.randint(5, 60))]
+        if keys and self.random.random() < hit_rate:
+            words.insert(self.random.randrange(len(words) + 1), self.random.choice(keys).upper())
+        return ' '.join(words)
+
+
+class Command(BaseCommand):
+    help = ("Time matching and dedup on synthetic chats, keys and messages in the configured "
+            "database and cache, and print the results as JSON. The data is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keys', default='10,100,1000,10000',
+                            help="Comma separated numbers of keys per chat to run with")
+        parser.add_argument('--users', type=int, default=10, help="Users the keys of a chat are spread over")
+        parser.add_argument('--messages', type=int, default=1000, help="Messages matched per run")
+        parser.add_argument('--hit-rate', type=float, default=0.1, help="Share of messages that contain a key")
+        parser.add_argument('--negative-share', type=float, default=0.1, help="Share of keys with a negative key")
+        parser.add_argument('--cyrillic-share', type=float, default=0.7, help="Share of Cyrillic words")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help="Write the results to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        corpus = Corpus(options['seed'], options['cyrillic_share'])
+        results = {
+            'commit': self.commit(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'cache': settings.CACHES['default']['BACKEND'],
+            'options': {k: options[k] for k in ('keys', 'users', 'messages', 'hit_rate', 'negative_share', 'cyrillic_share', 'seed')},
+            'matching': [self.bench_matching(corpus, int(n), options) for n in options['keys'].split(',')],
+            'dedup': self.bench_dedup(corpus, options),
+        }
+        output = json.dumps(results, ensure_ascii=False, indent=1)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf8') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+
+    def commit(self):
+        try:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+
+    def bench_matching(self, corpus, keys_count, options):
+        self.stderr.write("Matching with {} keys per chat".format(keys_count))
+        result = {'keys_per_chat': keys_count}
+        try:
+            with transaction.atomic():
+                chat = Chat.objects.create(chat_id=-random.randrange(10 ** 12, 10 ** 13), title='benchmark')
+                users = User.objects.bulk_create([
+                    User(chat_id=random.randrange(10 ** 12, 10 ** 13), name='benchmark') for _ in range(options['users'])
+                ])
+                users = list(User.objects.filter(chat_id__in=[u.chat_id for u in users]))
+                Relation.objects.bulk_create([Relation(user=user, chat=chat) for user in users])
+
+                keys = corpus.keys(keys_count)
+                Keyword.objects.bulk_create([Keyword(user=users[i % len(users)], key=key) for i, key in enumerate(keys)])
+                keywords = list(Keyword.objects.filter(user__in=users).values_list('id', 'user_id'))
+                Keyword.chats.through.objects.bulk_create([
+                    Keyword.chats.through(keyword_id=pk, chat_id=chat.id) for pk, _ in keywords
+                ])
+                negatives = [(pk, user_id) for pk, user_id in keywords if corpus.random.random() < options['negative_share']]
+                NegativeKeyword.objects.bulk_create([
+                    NegativeKeyword(user_id=user_id, key=corpus.random.choice(corpus.vocabulary)) for _, user_id in negatives
+                ], ignore_conflicts=True)
+                nkeys = {user_id: pk for pk, user_id in NegativeKeyword.objects.filter(user__in=users).values_list('id', 'user_id')}
+                NegativeKeyword.keywords.through.objects.bulk_create([
+                    NegativeKeyword.keywords.through(negativekeyword_id=nkeys[user_id], keyword_id=pk)
+                    for pk, user_id in negatives if user_id in nkeys
+                ], ignore_conflicts=True)
+
+                started = time.perf_counter()
+                subscriptions.refresh_keywords([pk for pk, _ in keywords])
+                result['refresh_subscriptions_ms'] = (time.perf_counter() - started) * 1000
+
+                chat.refresh_from_db()
+                started = time.perf_counter()
+                index = matching.build_index(chat)
+                result['build_index_ms'] = (time.perf_counter() - started) * 1000
+
+                messages = [corpus.message(keys, options['hit_rate']) for _ in range(options['messages'])]
+                samples, matched = [], 0
+                for message in messages:
+                    started = time.perf_counter()
+                    matched += bool(index.match(message))
+                    samples.append(time.perf_counter() - started)
+                result['match_us'] = percentiles(samples, 10 ** 6)
+                result['matched_share'] = matched / len(messages)
+                raise Rollback()
+        except Rollback:
+            pass
+        return result
+
+
+    def bench_dedup(self, corpus, options):
+        self.stderr.write("Dedup")
+        # Own users, so entries of earlier runs don't count as repeats
+        prefix = uuid.uuid4().hex[:8]
+        messages = [('{}-{}'.format(prefix, i % options['users']), corpus.message([], 0)) for i in range(options['messages'])]
+        samples = {'unique': [], 'repeated': []}
+        for kind in ('unique', 'repeated'):
+            for user, message in messages:
+                started = time.perf_counter()
+                utils.check_for_uniqueness(user, message)
+                samples[kind].append(time.perf_counter() - started)
+        return {kind: percentiles(values, 10 ** 6) for kind, values in samples.items()}
@@ -0,0 +1,132 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl
+
+from django.core.management.base import BaseCommand
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeBotAPI(object):
+    "Answers Bot API methods the bot uses, with simulated latency, rate limits and errors"
+
+    def __init__(self, latency, jitter, rate_limit_share, retry_after, error_share, record):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.error_share = error_share
+        self.record = record
+        self.lock = threading.Lock()
+        self.message_id = 0
+        self.counts = {}
+
+
+    def next_message_id(self):
+        with self.lock:
+            self.message_id += 1
+            return self.message_id
+
+
+    def answer(self, method, body):
+        "Return the status code and the response of the method"
+        time.sleep(max(random.gauss(self.latency, self.jitter), 0))
+        roll = random.random()
+        if roll < self.rate_limit_share:
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after {}'.format(self.retry_after),
+                         'parameters': {'retry_after': self.retry_after}}
+        if roll < self.rate_limit_share + self.error_share:
+            return 500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+
+        chat = {'id': body.get('chat_id'), 'type': 'private'}
+        if method == 'forwardMessage':
+            result = {'message_id': self.next_message_id(), 'date': int(time.time()), 'chat': chat,
+                      'forward_from_chat': {'id': body.get('from_chat_id'), 'type': 'supergroup'},
+                      'forward_date': int(time.time())}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = {'message_id': body.get('message_id') or self.next_message_id(), 'date': int(time.time()),
+                      'chat': chat, 'text': body.get('text', '')}
+        elif method == 'getChatMember':
+            result = {'user': {'id': body.get('user_id'), 'is_bot': False, 'first_name': 'user'}, 'status': 'member'}
+        else:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+        return 200, {'ok': True, 'result': result}
+
+
+    def handle(self, method, body):
+        status, response = self.answer(method, body)
+        with self.lock:
+            self.counts[(method, status)] = self.counts.get((method, status), 0) + 1
+            if self.record:
+                self.record.write(json.dumps({'time': time.time(), 'method': method, 'status': status, 'body': body},
+                                             ensure_ascii=False) + '\n')
+                self.record.flush()
+        return status, response
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            # /bot<token>/<method>
+            method = self.path.rstrip('/').rsplit('/', 1)[-1]
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+            try:
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    body = json.loads(raw.decode() or '{}')
+                else:
+                    body = dict(parse_qsl(raw.decode()))
+            except ValueError:
+                body = {}
+            status, response = api.handle(method, body)
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class Command(BaseCommand):
+    help = ("Run a local stand-in for the Telegram Bot API. Set TELEGRAM_API_URL "
+            "to http://<host>:<port> for workers to deliver messages to it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--latency', type=float, default=50, help="Mean response latency, ms")
+        parser.add_argument('--jitter', type=float, default=20, help="Standard deviation of the latency, ms")
+        parser.add_argument('--rate-limit-share', type=float, default=0, help="Share of requests answered 429")
+        parser.add_argument('--retry-after', type=int, default=1, help="retry_after of the 429 answers, s")
+        parser.add_argument('--error-share', type=float, default=0, help="Share of requests answered 500")
+        parser.add_argument('--record', help="Append received requests to this JSON lines file")
+
+    def handle(self, *args, **options):
+        record = open(options['record'], 'a', encoding='utf8') if options['record'] else None
+        api = FakeBotAPI(options['latency'] / 1000, options['jitter'] / 1000, options['rate_limit_share'],
+                         options['retry_after'], options['error_share'], record)
+        server = ThreadingHTTPServer((options['host'], options['port']), make_handler(api))
+        self.stdout.write("Fake Bot API on http://{}:{}".format(options['host'], options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if record:
+                record.close()
+            for (method, status), count in sorted(api.counts.items()):
+                self.stdout.write("{} {} {}".format(method, status, count))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from bot import digests
+from bot.models import Chat, Keyword
+
+
+class Command(BaseCommand):
+    help = "Show p50/p95/p99 of match cost, message length or forward latency per chat or keyword"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scope', choices=[digests.CHAT, digests.KEYWORD], default=digests.CHAT)
+        parser.add_argument('--metric', choices=digests.METRICS, default=digests.MATCH_COST)
+        parser.add_argument('--hours', type=int, default=24, help="Snapshots of how many last hours to merge")
+        parser.add_argument('--top', type=int, default=20, help="Show this many rows with the highest p99")
+
+    def handle(self, *args, **options):
+        # Include what this process recorded, e.g. when run in a worker shell
+        digests.snapshot()
+        merged = digests.merged(options['hours'], options['scope'], options['metric'])
+        rows = sorted(
+            ((pk, digest.n, *(digest.percentile(p) for p in (50, 95, 99))) for (_, pk, _), digest in merged.items()),
+            key=lambda row: row[-1], reverse=True,
+        )[:options['top']]
+        if not rows:
+            self.stdout.write("No samples recorded")
+            return
+
+        ids = [row[0] for row in rows]
+        if options['scope'] == digests.CHAT:
+            names = dict(Chat.objects.filter(chat_id__in=ids).values_list('chat_id', 'title'))
+        else:
+            names = dict(Keyword.objects.filter(id__in=ids).values_list('id', 'key'))
+
+        scale, unit = (1000, 'ms') if options['metric'] != digests.MESSAGE_LENGTH else (1, 'chars')
+        self.stdout.write("{:>16} {:>8} {:>10} {:>10} {:>10}  {}".format(
+            options['scope'], 'n', 'p50 ' + unit, 'p95 ' + unit, 'p99 ' + unit, 'name'))
+        for pk, n, p50, p95, p99 in rows:
+            self.stdout.write("{:>16} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}  {}".format(
+                pk, int(n), p50 * scale, p95 * scale, p99 * scale, names.get(pk, '')))
@@ -0,0 +1,54 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bot import profiling
+
+
+class Command(BaseCommand):
+    help = ("Profile the matching task on demand. `start` switches profiling on for chats or a "
+            "share of messages, `dump` prints a chat's aggregated stacks in the collapsed format "
+            "flamegraph.pl and speedscope read.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['start', 'stop', 'status', 'dump', 'clear'])
+        parser.add_argument('--chat', type=int, action='append', default=[], help="Telegram id of a chat")
+        parser.add_argument('--rate', type=float, default=0, help="Share of messages of other chats to profile")
+        parser.add_argument('--mode', choices=[profiling.SAMPLE, profiling.TRACE], default=profiling.SAMPLE,
+                            help="Sample stacks every millisecond or follow every call (slow, exact)")
+        parser.add_argument('--minutes', type=float, default=10, help="Switch profiling off after this time")
+        parser.add_argument('--output', help="Write the dump to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'start':
+            if not options['chat'] and not options['rate']:
+                raise CommandError("Give --chat or --rate")
+            profiling.start(options['chat'], options['rate'], options['mode'], int(options['minutes'] * 60))
+            self.stdout.write("Profiling on, processes pick it up within {}s".format(profiling.CONFIG_REFRESH))
+        elif action == 'stop':
+            profiling.stop()
+            self.stdout.write("Profiling off")
+        elif action == 'status':
+            config = profiling.config()
+            if config is None:
+                self.stdout.write("Profiling off")
+            else:
+                until = datetime.datetime.fromtimestamp(config['until']).strftime('%Y-%m-%d %H:%M:%S')
+                self.stdout.write("Profiling {} chats {} and {:.2%} of others in {} mode until {}".format(
+                    len(config['chats']), config['chats'], config['rate'], config['mode'], until))
+        else:
+            if len(options['chat']) != 1:
+                raise CommandError("Give one --chat")
+            chat_id = options['chat'][0]
+            if action == 'clear':
+                profiling.clear(chat_id)
+                return
+            lines = profiling.collapsed(chat_id)
+            if not lines:
+                raise CommandError("No profiles of {}".format(chat_id))
+            if options['output']:
+                with open(options['output'], 'w', encoding='utf8') as f:
+                    f.write('\n'.join(lines) + '\n')
+            else:
+                self.stdout.write('\n'.join(lines))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from bot import subscriptions
+
+
+class Command(BaseCommand):
+    help = "Rebuild the chat subscriptions table from keywords, pins, relations and negative keys"
+
+    def handle(self, *args, **options):
+        count = subscriptions.rebuild()
+        self.stdout.write(self.style.SUCCESS("Rebuilt {} chat subscriptions".format(count)))
@@ -0,0 +1,107 @@
+import json
+import random
+import time
+
+import telegram
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.models import Chat, ChatSubscription
+from .benchmark import Corpus, percentiles
+
+
+class Command(BaseCommand):
+    help = ("Feed recorded or synthetic group message updates through handle_group_message "
+            "at a chosen rate and report throughput and latency as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input', help="JSON lines file of Telegram updates, e.g. recorded from the webhook")
+        parser.add_argument('--synthetic', type=int, default=0, help="Generate this many updates instead")
+        parser.add_argument('--chat', type=int, action='append', help="Telegram id of a chat to write synthetic "
+                            "messages to, all chats with active subscriptions by default")
+        parser.add_argument('--hit-rate', type=float, default=0.1, help="Share of synthetic messages that contain a key")
+        parser.add_argument('--rate', type=float, default=0, help="Updates per second, 0 for as fast as possible")
+        parser.add_argument('--eager', action='store_true', help="Run the matching task in this process, so the "
+                            "latency covers matching and delivery to TELEGRAM_API_URL")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help="Write the results to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        if options['eager']:
+            from chatmonitor.celery import app
+            app.conf.task_always_eager = True
+        # Imported late, the module sets the bot up on import
+        from bot.telegrambot import handle_group_message
+
+        if options['input']:
+            with open(options['input'], encoding='utf8') as f:
+                updates = [json.loads(line) for line in f if line.strip()]
+        elif options['synthetic']:
+            updates = self.synthetic(options)
+        else:
+            raise CommandError("Give either --input or --synthetic")
+
+        bot = telegram.Bot('100000:replay', base_url=settings.TELEGRAM_API_URL + '/bot')
+        samples = []
+        started = time.perf_counter()
+        for i, data in enumerate(updates):
+            if options['rate']:
+                delay = started + i / options['rate'] - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            update = telegram.Update.de_json(data, bot)
+            if update.message is None:
+                continue
+            sent = time.perf_counter()
+            handle_group_message(bot, update)
+            samples.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - started
+
+        if not samples:
+            raise CommandError("No group messages to replay")
+        results = {
+            'updates': len(samples),
+            'eager': options['eager'],
+            'api': settings.TELEGRAM_API_URL,
+            'seconds': elapsed,
+            'throughput': len(samples) / elapsed,
+            'latency_ms': percentiles(samples, 1000),
+        }
+        output = json.dumps(results, indent=1)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf8') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+
+    def synthetic(self, options):
+        "Updates of messages to chats with active subscriptions, some containing their keys"
+        chats = Chat.objects.filter(subscriptions__active=True).distinct()
+        if options['chat']:
+            chats = chats.filter(chat_id__in=options['chat'])
+        chats = list(chats.values_list('id', 'chat_id', 'title'))
+        if not chats:
+            raise CommandError("No chats with active subscriptions")
+        keys = {}
+        for chat, key in ChatSubscription.objects.filter(chat_id__in=[c[0] for c in chats], active=True) \
+                .values_list('chat_id', 'key'):
+            keys.setdefault(chat, []).append(key)
+
+        corpus = Corpus(options['seed'], 0.7)
+        rand = random.Random(options['seed'])
+        updates = []
+        for i in range(options['synthetic']):
+            pk, chat_id, title = rand.choice(chats)
+            user_id = rand.randrange(10 ** 8, 10 ** 9)
+            updates.append({
+                'update_id': i + 1,
+                'message': {
+                    'message_id': i + 1,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'supergroup', 'title': title},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'},
+                    'text': corpus.message(keys.get(pk, []), options['hit_rate']),
+                },
+            })
+        return updates
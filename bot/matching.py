@@ -0,0 +1,302 @@
+import json
+import logging
+from array import array
+from collections import namedtuple
+from sys import intern
+
+from django.conf import settings
+
+from . import rules, stemming
+from .automaton import Automaton
+from .lru import LRUCache
+from .normalization import compose, normalize
+from .models import ChatSubscription, Keyword
+
+
+logger = logging.getLogger(__name__)
+
+Subscription = namedtuple('Subscription', ['keyword_id', 'key', 'owner', 'negative_keys'])
+
+# Built indexes by chat id, along with the chat's `index_version`
+_indexes = LRUCache(maxsize=1024, ttl=60 * 60)
+
+# Modes by the numbers indexes keep them as
+MODES = [mode for mode, _ in Keyword.MODES]
+
+# Finding which of a few patterns occur in a message is faster with `in`
+# for each of them, the automaton pays off on chats with many patterns and
+# messages shorter than a few characters per pattern
+AUTOMATON_MIN_PATTERNS = 256
+AUTOMATON_PATTERNS_PER_CHAR = 3
+
+
+# Parsed and normalized lists of negative keys by their JSON, most keywords share a few of them
+_negative_keys = LRUCache(maxsize=4096, ttl=60 * 60)
+
+
+def _parse_negative_keys(data):
+    parsed = _negative_keys.get(data)
+    if parsed is None:
+        parsed = tuple(intern(normalize(nkey)) for nkey in json.loads(data))
+        _negative_keys.set(data, parsed)
+    return parsed
+
+
+class KeywordTable(object):
+    """Subscriptions of a chat in typed arrays. Keys and negative keys are
+    interned, so users pinning the same key in many chats share one string.
+    Negative keys are kept normalized, as they're matched"""
+    __slots__ = ('keyword_ids', 'owners', 'keys', 'negative_keys')
+
+    def __init__(self):
+        self.keyword_ids = array('q')
+        self.owners = array('q')
+        self.keys = []
+        self.negative_keys = []
+
+
+    def append(self, keyword_id, key, owner, negative_keys):
+        self.keyword_ids.append(keyword_id)
+        self.owners.append(owner)
+        self.keys.append(intern(key))
+        self.negative_keys.append(_parse_negative_keys(negative_keys))
+
+
+    def __len__(self):
+        return len(self.keyword_ids)
+
+
+    def __getitem__(self, i):
+        return Subscription(self.keyword_ids[i], self.keys[i], self.owners[i], self.negative_keys[i])
+
+
+def _flatten(groups):
+    "Items of the groups in one array, and an array of where each group starts"
+    order, bounds = array('I'), array('I', [0])
+    for group in groups:
+        order.extend(group)
+        bounds.append(len(order))
+    return order, bounds
+
+
+class ChatIndex(object):
+    """Active subscriptions of a chat compiled into one engine. Keys of all
+    modes come down to literals -- each distinct one is scanned for once per
+    message however many users subscribe to it, lemmas are looked up by the
+    stems of the message's words. Literal keys map straight to
+    the `records` of their subscribers, boolean expressions are evaluated
+    over the set of literals found and regexes run only on messages
+    containing a literal every match of theirs contains.
+
+    Everything but the strings is kept in the flat arrays of TABLES, so a
+    snapshot maps a compiled index from a file as it is. Expressions are
+    parsed or compiled when a message first triggers them"""
+    TABLES = (
+        # Mode number of every record
+        ('modes', 'B'),
+        # Kind and pattern of every literal
+        ('kinds', 'B'), ('literal_patterns', 'I'),
+        # Patterns the text is scanned for, and literals of the lemma kind
+        ('scanned', 'I'), ('lemma_literals', 'I'),
+        # Literals of pattern j are pattern_literals[pattern_bounds[j]:pattern_bounds[j + 1]]
+        ('pattern_literals', 'I'), ('pattern_bounds', 'I'),
+        # Subscribers of literal k are records[order[bounds[k]:bounds[k + 1]]]
+        ('order', 'I'), ('bounds', 'I'),
+        # Expressions literal k triggers are trigger_order[trigger_bounds[k]:trigger_bounds[k + 1]]
+        ('trigger_order', 'I'), ('trigger_bounds', 'I'),
+        # Record of every expression
+        ('expression_records', 'I'),
+    )
+
+    def __init__(self, records, patterns, expression_sources, automaton=None, **tables):
+        self.records = records
+        self.patterns = patterns
+        self.expression_sources = expression_sources
+        for name, _ in self.TABLES:
+            setattr(self, name, tables[name])
+        self._automaton = automaton
+        self._expressions = {}
+        self._lemmas = None
+
+
+    @classmethod
+    def compile(cls, sources, records):
+        "`sources` are (mode, pattern) of the records, in the same order, see `rules.pattern`"
+        tables = {name: array(typecode) for name, typecode in cls.TABLES}
+        patterns = {}
+        literals = {}
+        direct = []
+        triggers = []
+        expression_sources = []
+
+        def literal(kind, pattern):
+            if (kind, pattern) not in literals:
+                literals[kind, pattern] = len(direct)
+                direct.append([])
+                triggers.append([])
+                tables['kinds'].append(kind)
+                tables['literal_patterns'].append(patterns.setdefault(pattern, len(patterns)))
+            return literals[kind, pattern]
+
+        for i, (mode, source) in enumerate(sources):
+            tables['modes'].append(MODES.index(mode))
+            if not source:
+                continue
+            if mode in rules.LITERAL_KINDS:
+                direct[literal(rules.LITERAL_KINDS[mode], source)].append(i)
+                continue
+            if mode == Keyword.BOOLEAN:
+                expression = rules.parse(source)
+                waits_for = set(rules.literals(expression)) if expression is not None else ()
+            else:
+                # Regexes without a required literal don't compile
+                expression = rules.compile_regex(source)
+                waits_for = [(rules.SUBSTRING, rules.required_literal(source))]
+            if expression is None:
+                continue
+            e = len(expression_sources)
+            for kind, pattern in waits_for:
+                triggers[literal(kind, pattern)].append(e)
+            tables['expression_records'].append(i)
+            expression_sources.append(source)
+
+        patterns = list(patterns)
+        by_pattern = [[] for _ in patterns]
+        scanned = set()
+        for k, j in enumerate(tables['literal_patterns']):
+            by_pattern[j].append(k)
+            if tables['kinds'][k] == rules.LEMMA:
+                tables['lemma_literals'].append(k)
+            else:
+                scanned.add(j)
+        tables['scanned'].extend(sorted(scanned))
+        tables['pattern_literals'], tables['pattern_bounds'] = _flatten(by_pattern)
+        tables['order'], tables['bounds'] = _flatten(direct)
+        tables['trigger_order'], tables['trigger_bounds'] = _flatten(triggers)
+        return cls(records, patterns, expression_sources, **tables)
+
+
+    @classmethod
+    def from_rows(cls, rows):
+        "Build the index from (keyword_id, key, owner, negative_keys JSON, mode) rows"
+        sources, records = [], KeywordTable()
+        for keyword_id, key, owner, negative_keys, mode in rows:
+            if key:
+                sources.append((mode, intern(rules.pattern(key, mode))))
+                records.append(keyword_id, key, owner, negative_keys)
+        return cls.compile(sources, records)
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def automaton(self):
+        "Automaton of the scanned patterns, built on first use"
+        if self._automaton is None:
+            self._automaton = Automaton.build([self.patterns[j] for j in self.scanned])
+        return self._automaton
+
+
+    def _scan(self, text):
+        "Indexes of the scanned patterns occurring in the text"
+        if len(self.scanned) >= AUTOMATON_MIN_PATTERNS and len(text) * AUTOMATON_PATTERNS_PER_CHAR < len(self.scanned):
+            return [self.scanned[x] for x in self.automaton().search(text)]
+        return [j for j in self.scanned if self.patterns[j] in text]
+
+
+    def _find_lemmas(self, text):
+        "Lemma literals occurring in the text, the words of which are stemmed once"
+        if self._lemmas is None:
+            # Lemmas by their first stem
+            self._lemmas = {}
+            for k in self.lemma_literals:
+                stems = tuple(self.patterns[self.literal_patterns[k]].split(' '))
+                self._lemmas.setdefault(stems[0], []).append((stems, k))
+        found = []
+        stems = stemming.stems(text)
+        for i, stem in enumerate(stems):
+            for lemma, k in self._lemmas.get(stem, ()):
+                if len(lemma) == 1 or tuple(stems[i:i + len(lemma)]) == lemma:
+                    found.append(k)
+        return found
+
+
+    def _expression(self, e):
+        "Boolean tree or compiled regex of the expression"
+        if e not in self._expressions:
+            source = self.expression_sources[e]
+            if MODES[self.modes[self.expression_records[e]]] == Keyword.BOOLEAN:
+                self._expressions[e] = rules.parse(source)
+            else:
+                self._expressions[e] = rules.compile_regex(source)
+        return self._expressions[e]
+
+
+    def match(self, text):
+        """Return subscriptions whose keys match the text and negative keys
+        don't occur in it. The text is normalized once, keys were when the
+        index was built"""
+        normalized = normalize(text)
+        found = set()
+        for j in self._scan(normalized):
+            for k in self.pattern_literals[self.pattern_bounds[j]:self.pattern_bounds[j + 1]]:
+                kind = self.kinds[k]
+                if kind == rules.SUBSTRING or kind != rules.LEMMA and rules.occurs(normalized, self.patterns[j], kind):
+                    found.add(k)
+        if len(self.lemma_literals):
+            found.update(self._find_lemmas(normalized))
+
+        matched = set()
+        waiting = set()
+        for k in found:
+            matched.update(self.order[self.bounds[k]:self.bounds[k + 1]])
+            waiting.update(self.trigger_order[self.trigger_bounds[k]:self.trigger_bounds[k + 1]])
+        if waiting:
+            values = set((self.kinds[k], self.patterns[self.literal_patterns[k]]) for k in found)
+            composed = None
+            for e in waiting:
+                i, expression = self.expression_records[e], self._expression(e)
+                if expression is None:
+                    continue
+                if isinstance(expression, tuple):
+                    if rules.evaluate(expression, values):
+                        matched.add(i)
+                else:
+                    if composed is None:
+                        composed = compose(text)
+                    if expression.search(composed):
+                        matched.add(i)
+
+        result = []
+        for i in sorted(matched):
+            subscription = self.records[i]
+            if not any(nkey in normalized for nkey in subscription.negative_keys):
+                result.append(subscription)
+        return result
+
+
+def build_index(chat):
+    return ChatIndex.from_rows(
+        ChatSubscription.objects.filter(chat=chat, active=True)
+            .values_list('keyword_id', 'key', 'owner', 'negative_keys', 'mode')
+    )
+
+
+def get_index(chat):
+    """Return the chat's index, building it only when the chat's
+    subscriptions changed since it was built in this process.
+    With MATCH_INDEX_DIR set, indexes are shared between the
+    processes of a host through memory-mapped snapshots."""
+    cached = _indexes.get(chat.id)
+    if cached is not None and cached[0] == chat.index_version:
+        return cached[1]
+    if settings.MATCH_INDEX_DIR:
+        # Snapshots are laid out after the index's tables
+        from . import snapshots
+        index = snapshots.load_or_build(settings.MATCH_INDEX_DIR, chat, build_index)
+    else:
+        index = build_index(chat)
+    _indexes.set(chat.id, (chat.index_version, index))
+    logger.debug("Loaded index of {} subscriptions for {}".format(len(index), chat.chat_id))
+    return index
@@ -0,0 +1,61 @@
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter,
+                               Histogram, REGISTRY, generate_latest,
+                               start_http_server)
+from prometheus_client import multiprocess
+
+
+# Prefork workers and gunicorn write their samples to files in this
+# directory, the exporter and the view collect them from all processes
+MULTIPROC_DIR = os.environ.get('prometheus_multiproc_dir')
+
+# Chats are grouped into this many shards to keep the number of series bounded
+CHAT_SHARDS = 16
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+MATCH_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+
+MESSAGES_RECEIVED = Counter(
+    'chatmonitor_messages_received_total', "Group messages queued for matching", ['shard', 'queue'])
+MESSAGES_PREFILTERED = Counter(
+    'chatmonitor_messages_prefiltered_total', "Messages skipped before matching, the chat has no active keys", ['shard', 'queue'])
+MESSAGES_MATCHED = Counter(
+    'chatmonitor_messages_matched_total', "Messages that matched at least one key", ['shard', 'queue'])
+MESSAGES_DEDUPLICATED = Counter(
+    'chatmonitor_messages_deduplicated_total', "Matched messages dropped as repeats", ['shard', 'queue'])
+MESSAGES_FORWARDED = Counter(
+    'chatmonitor_messages_forwarded_total', "Forwards of matched messages to users", ['shard', 'queue'])
+
+ENQUEUE_TO_MATCH_SECONDS = Histogram(
+    'chatmonitor_enqueue_to_match_seconds', "Time from queueing a message to matching it", ['shard', 'queue'],
+    buckets=LATENCY_BUCKETS)
+MATCH_SECONDS = Histogram(
+    'chatmonitor_match_seconds', "Time spent matching a message against the chat's keys", ['shard', 'queue'],
+    buckets=MATCH_BUCKETS)
+TELEGRAM_API_SECONDS = Histogram(
+    'chatmonitor_telegram_api_seconds', "Telegram Bot API request latency", ['method', 'status'],
+    buckets=LATENCY_BUCKETS)
+
+
+def shard(chat_id):
+    return str(abs(int(chat_id)) % CHAT_SHARDS)
+
+
+def registry():
+    "Registry with samples of all processes if running multi-process"
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    collecting = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collecting)
+    return collecting
+
+
+def render():
+    "Return the body and content type of a scrape"
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def start_exporter(port, addr):
+    "Serve metrics of this process and its children on the address and port"
+    start_http_server(port, addr=addr, registry=registry())
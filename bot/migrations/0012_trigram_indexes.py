@@ -0,0 +1,39 @@
+from django.db import migrations
+
+
+# Indexes for the search in inline listings. `icontains` is rendered as
+# UPPER(column) LIKE UPPER(%term%) on PostgreSQL, so the indexes are
+# built over the same expression. Other databases search in memory.
+TRIGRAM_INDEXES = (
+    ('bot_keyword', 'key'),
+    ('bot_negativekeyword', 'key'),
+    ('bot_keywordsgroup', 'name'),
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS {table}_{column}_trgm ON {table} USING gin (UPPER({column}) gin_trgm_ops)'.format(table=table, column=column)
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, column in TRIGRAM_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {table}_{column}_trgm'.format(table=table, column=column))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0011_user_debug'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations, models
+
+
+def merge_duplicates(apps, schema_editor):
+    "Merge keys duplicated in the scope of a user and duplicated relations, so the constraints can be added"
+    Keyword = apps.get_model('bot', 'Keyword')
+    NegativeKeyword = apps.get_model('bot', 'NegativeKeyword')
+    Relation = apps.get_model('bot', 'Relation')
+
+    for model, links in ((Keyword, ('chats', 'negativekeyword', 'groups')), (NegativeKeyword, ('keywords',))):
+        duplicates = model.objects.values('user', 'key').annotate(count=models.Count('id'), keep=models.Min('id')).filter(count__gt=1)
+        for duplicate in duplicates:
+            keep = model.objects.get(id=duplicate['keep'])
+            others = model.objects.filter(user=duplicate['user'], key=duplicate['key']).exclude(id=keep.id)
+            for other in others:
+                for link in links:
+                    getattr(keep, link).add(*getattr(other, link).all())
+            others.delete()
+
+    duplicates = Relation.objects.values('user', 'chat').annotate(count=models.Count('id'), keep=models.Min('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        Relation.objects.filter(user=duplicate['user'], chat=duplicate['chat']).exclude(id=duplicate['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    # On PostgreSQL the rows deleted by `merge_duplicates` leave deferred
+    # FK trigger events behind, and ALTER TABLE refuses to run on a table
+    # with pending ones. So the merge commits on its own, merging again
+    # when the migration is retried after a failure is harmless.
+    atomic = False
+
+    dependencies = [
+        ('bot', '0012_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='keyword',
+            constraint=models.UniqueConstraint(fields=('user', 'key'), name='keyword_user_key_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='negativekeyword',
+            constraint=models.UniqueConstraint(fields=('user', 'key'), name='negativekeyword_user_key_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='relation',
+            constraint=models.UniqueConstraint(fields=('user', 'chat'), name='relation_user_chat_unique'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 2.2.3 on 2026-10-19 14:04
+
+import json
+from collections import defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_subscriptions(apps, schema_editor):
+    "Same as `bot.subscriptions.rebuild`, against historical models"
+    Keyword = apps.get_model('bot', 'Keyword')
+    NegativeKeyword = apps.get_model('bot', 'NegativeKeyword')
+    Relation = apps.get_model('bot', 'Relation')
+    ChatSubscription = apps.get_model('bot', 'ChatSubscription')
+
+    keywords = {
+        pk: (key, state, user_id, owner)
+        for pk, key, state, user_id, owner in Keyword.objects
+            .values_list('id', 'key', 'state', 'user_id', 'user__chat_id')
+    }
+    relations = {
+        (user_id, chat_id): active
+        for user_id, chat_id, active in Relation.objects.values_list('user_id', 'chat_id', 'active')
+    }
+    negative_keys = defaultdict(list)
+    for keyword_id, nkey in NegativeKeyword.keywords.through.objects.values_list('keyword_id', 'negativekeyword__key'):
+        negative_keys[keyword_id].append(nkey)
+
+    subscriptions = []
+    for keyword_id, chat_id in Keyword.chats.through.objects.values_list('keyword_id', 'chat_id').iterator():
+        key, state, user_id, owner = keywords[keyword_id]
+        subscriptions.append(ChatSubscription(
+            chat_id=chat_id,
+            keyword_id=keyword_id,
+            key=key,
+            owner=owner,
+            active=state and relations.get((user_id, chat_id), False),
+            negative_keys=json.dumps(sorted(negative_keys[keyword_id]), ensure_ascii=False),
+        ))
+    ChatSubscription.objects.bulk_create(subscriptions, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0013_unique_keys_and_active_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='index_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ChatSubscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.TextField()),
+                ('owner', models.BigIntegerField()),
+                ('active', models.BooleanField(default=True)),
+                ('negative_keys', models.TextField(default='[]')),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subscriptions', to='bot.Chat')),
+                ('keyword', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subscriptions', to='bot.Keyword')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='chatsubscription',
+            index=models.Index(fields=['chat', 'active'], name='chatsubscription_chat_active'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatsubscription',
+            constraint=models.UniqueConstraint(fields=('chat', 'keyword'), name='chatsubscription_chat_keyword_unique'),
+        ),
+        migrations.RunPython(fill_subscriptions, migrations.RunPython.noop),
+    ]
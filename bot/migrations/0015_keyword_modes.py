@@ -0,0 +1,33 @@
+# Generated by Django 2.2.3 on 2026-10-19 14:30
+
+from django.db import migrations, models
+
+
+MODES = [
+    ('substring', 'substring'),
+    ('word', 'whole word'),
+    ('prefix', 'word prefix'),
+    ('regex', 'regular expression'),
+    ('boolean', 'boolean expression'),
+]
+
+
+class Migration(migrations.Migration):
+
+    # Existing keys keep matching as substrings, whatever they look like
+    dependencies = [
+        ('bot', '0014_chat_subscriptions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyword',
+            name='mode',
+            field=models.CharField(choices=MODES, default='substring', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='chatsubscription',
+            name='mode',
+            field=models.CharField(choices=MODES, default='substring', max_length=16),
+        ),
+    ]
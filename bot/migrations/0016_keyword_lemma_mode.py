@@ -0,0 +1,33 @@
+# Generated by Django 2.2.3 on 2026-10-19 14:34
+
+from django.db import migrations, models
+
+
+MODES = [
+    ('substring', 'substring'),
+    ('word', 'whole word'),
+    ('prefix', 'word prefix'),
+    ('regex', 'regular expression'),
+    ('boolean', 'boolean expression'),
+    ('lemma', 'any form of the words'),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0015_keyword_modes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='keyword',
+            name='mode',
+            field=models.CharField(choices=MODES, default='substring', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='chatsubscription',
+            name='mode',
+            field=models.CharField(choices=MODES, default='substring', max_length=16),
+        ),
+    ]
@@ -11,6 +11,37 @@ class LocalManager(models.Manager):
 
 
 
+# Querysets below prefetch everything the `prepare_description`-like
+# methods need, so a page of an inline listing costs a fixed number of
+# queries instead of one or more per item.
+
+class ChatQuerySet(models.QuerySet):
+    def with_keys(self, user):
+        return self.prefetch_related(models.Prefetch('keywords', queryset=Keyword.objects.filter(user=user).only('id', 'key'), to_attr='user_keywords'))
+
+
+
+class KeywordQuerySet(models.QuerySet):
+    def with_chats(self):
+        return self.prefetch_related(models.Prefetch('chats', queryset=Chat.objects.only('id', 'title').order_by('id')))
+
+    def with_negative_keys(self):
+        return self.prefetch_related(models.Prefetch('negativekeyword', queryset=NegativeKeyword.objects.only('id', 'key').order_by('id')))
+
+
+
+class NegativeKeywordQuerySet(models.QuerySet):
+    def with_keys(self):
+        return self.prefetch_related(models.Prefetch('keywords', queryset=Keyword.objects.only('id', 'key').order_by('id')))
+
+
+
+class KeywordsGroupQuerySet(models.QuerySet):
+    def with_keys(self):
+        return self.prefetch_related(models.Prefetch('keys', queryset=Keyword.objects.only('id', 'key').order_by('id')))
+
+
+
 class User(models.Model):
     chat_id = models.BigIntegerField(unique=True)
     name = models.CharField(max_length=1024)
@@ -53,8 +84,11 @@ class Chat(models.Model):
     title = models.TextField(blank=True)
     username = models.CharField(max_length=512, blank=True)
     user = models.ManyToManyField(User, through='Relation', related_name='chats')
+    # Bumped whenever the chat's subscriptions change, see `bot.matching`.
+    # Only ever written with F() updates, save chats with `update_fields`
+    index_version = models.PositiveIntegerField(default=0)
 
-    objects = LocalManager()
+    objects = LocalManager.from_queryset(ChatQuerySet)()
 
 
     def __str__(self):
@@ -67,7 +101,11 @@ class Chat(models.Model):
 
 
     def get_keys(self, user):
-        return ' | '.join([kw.key for kw in self.keywords.filter(user=user)])
+        # Prefetched by `ChatQuerySet.with_keys`
+        keywords = getattr(self, 'user_keywords', None)
+        if keywords is None:
+            keywords = self.keywords.filter(user=user)
+        return ' | '.join([kw.key for kw in keywords])
 
 
 
@@ -76,15 +114,48 @@ class Relation(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
     active = models.BooleanField(default=True)
 
+    objects = LocalManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat'], name='relation_user_chat_unique'),
+        ]
+
+
+    def represent(self):
+        return "{} {}".format(self.chat.title, '☑️' if self.active else '❎')
+
 
 
 class Keyword(models.Model):
+    # How the key is matched, given by its syntax, see `bot.rules`
+    SUBSTRING = 'substring'
+    WORD = 'word'
+    PREFIX = 'prefix'
+    REGEX = 'regex'
+    BOOLEAN = 'boolean'
+    LEMMA = 'lemma'
+    MODES = (
+        (SUBSTRING, 'substring'),
+        (WORD, 'whole word'),
+        (PREFIX, 'word prefix'),
+        (REGEX, 'regular expression'),
+        (BOOLEAN, 'boolean expression'),
+        (LEMMA, 'any form of the words'),
+    )
+
     chats = models.ManyToManyField(Chat, related_name='keywords')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='keywords')
     key = models.TextField()
     state = models.BooleanField(default=True)
+    mode = models.CharField(max_length=16, choices=MODES, default=SUBSTRING)
 
-    objects = LocalManager()
+    objects = LocalManager.from_queryset(KeywordQuerySet)()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='keyword_user_key_unique'),
+        ]
 
 
     def __str__(self):
@@ -106,7 +177,12 @@ class NegativeKeyword(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='negativekeyword')
     key = models.TextField()
 
-    objects = LocalManager()
+    objects = LocalManager.from_queryset(NegativeKeywordQuerySet)()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='negativekeyword_user_key_unique'),
+        ]
 
 
     def __str__(self):
@@ -124,7 +200,7 @@ class KeywordsGroup(models.Model):
     keys = models.ManyToManyField(Keyword, related_name='groups')
     state = models.BooleanField(default=True)
 
-    objects = LocalManager()
+    objects = LocalManager.from_queryset(KeywordsGroupQuerySet)()
 
     def __str__(self):
         return "<KGroup {} by {}>".format(self.name, self.user)
@@ -135,7 +211,35 @@ class KeywordsGroup(models.Model):
 
 
     def prepare_description(self):
-        if self.keys.count() > 7:
-            return ', '.join(map(lambda x: x.key, self.keys.all()[:3])) + ', ... , ' + ', '.join(map(lambda x: x.key, self.keys.order_by('-id')[:2]))
+        keys = [kw.key for kw in sorted(self.keys.all(), key=lambda x: x.id)]
+        if len(keys) > 7:
+            return ', '.join(keys[:3]) + ', ... , ' + ', '.join(reversed(keys[-2:]))
         else:
-            return ', '.join(map(lambda x: x.key, self.keys.all()))
+            return ', '.join(keys)
+
+
+class ChatSubscription(models.Model):
+    """Denormalized pins of keywords to chats with everything the matching
+    needs, so a chat's subscriptions are read in one index scan.
+    Kept up to date by `bot.subscriptions`, never edit it by hand."""
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='subscriptions')
+    keyword = models.ForeignKey(Keyword, on_delete=models.CASCADE, related_name='subscriptions')
+    key = models.TextField()
+    mode = models.CharField(max_length=16, choices=Keyword.MODES, default=Keyword.SUBSTRING)
+    # Telegram chat id of the keyword's owner
+    owner = models.BigIntegerField()
+    # Keyword is on and the owner monitors the chat
+    active = models.BooleanField(default=True)
+    # JSON list of the keyword's negative keys
+    negative_keys = models.TextField(default='[]')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'keyword'], name='chatsubscription_chat_keyword_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['chat', 'active'], name='chatsubscription_chat_active'),
+        ]
+
+    def __str__(self):
+        return "'{}' in {} for {}".format(self.key, self.chat_id, self.owner)
@@ -0,0 +1,37 @@
+import unicodedata
+
+from django.conf import settings
+
+
+# Latin letters that look like Cyrillic ones, folded to the Cyrillic letter.
+# Only letters whose capitals casefold to them too, so folding doesn't
+# break case-insensitive matching of Latin keys. Pairs for str.replace,
+# which is many times faster than str.translate on non-ASCII text
+HOMOGLYPHS = list(zip('aceopxyi', 'асеорхуі'))
+YO = [('ё', 'е')]
+
+# Bits of `flags()`, stored with index snapshots to detect ones built
+# with other settings
+FOLD_YO = 1
+FOLD_HOMOGLYPHS = 2
+
+
+def flags():
+    return (FOLD_YO if settings.MATCH_FOLD_YO else 0) | \
+           (FOLD_HOMOGLYPHS if settings.MATCH_FOLD_HOMOGLYPHS else 0)
+
+
+def normalize(text):
+    """Form of the text keys are matched in: NFKC, case-folded, with ё as е
+    and Latin homoglyphs as Cyrillic letters unless switched off in settings"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    for folds, enabled in ((YO, settings.MATCH_FOLD_YO), (HOMOGLYPHS, settings.MATCH_FOLD_HOMOGLYPHS)):
+        if enabled:
+            for letter, replacement in folds:
+                text = text.replace(letter, replacement)
+    return text
+
+
+def compose(text):
+    "NFKC form of the text, regular expressions are matched in it ignoring case"
+    return unicodedata.normalize('NFKC', text)
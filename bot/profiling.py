@@ -0,0 +1,166 @@
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.core.cache import cache
+
+from .lru import LRUCache
+
+
+# Operators switch profiling on with `manage.py profile_matching start`.
+# The config is an entry of the shared cache, each process looks at it
+# at most once per CONFIG_REFRESH seconds, so there's no cache access
+# per message -- when profiling is off, checking for it is a dict lookup.
+CONFIG_KEY = 'profiling:config'
+CONFIG_REFRESH = 10
+STACKS_KEY = 'profiling:stacks:{}'
+STACKS_TIMEOUT = 7 * 24 * 60 * 60
+
+SAMPLE = 'sample'
+TRACE = 'trace'
+# Seconds between samples of the sampling profiler
+SAMPLE_INTERVAL = 0.001
+
+_config = LRUCache(maxsize=1, ttl=CONFIG_REFRESH)
+
+
+def start(chats=(), rate=0, mode=SAMPLE, timeout=10 * 60):
+    "Profile messages of the chats and a `rate` share of all other messages for `timeout` seconds"
+    cache.set(CONFIG_KEY, {'chats': list(chats), 'rate': rate, 'mode': mode, 'until': time.time() + timeout}, timeout)
+
+
+def stop():
+    cache.delete(CONFIG_KEY)
+
+
+def config():
+    "Current config or None, as seen by this process"
+    current = _config.get(CONFIG_KEY)
+    if current is None:
+        current = cache.get(CONFIG_KEY) or False
+        _config.set(CONFIG_KEY, current)
+    return current or None
+
+
+def profiler_for(chat_id):
+    "Return a profiler to run the message of the chat under or None"
+    current = config()
+    if current is None:
+        return None
+    if chat_id not in current['chats'] and random.random() >= current['rate']:
+        return None
+    profiler = SamplingProfiler() if current['mode'] == SAMPLE else TracingProfiler()
+    return Profiled(chat_id, profiler)
+
+
+def _frame_name(frame):
+    return '{}.{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class SamplingProfiler(object):
+    "Samples the stack of the profiled thread from a background thread, counts are samples"
+
+    def __init__(self):
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+
+    def start(self):
+        self._ident = threading.get_ident()
+        # Frames above the profiled block are the same for every sample
+        self._depth = len(_stack(sys._getframe(2)))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def _run(self):
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._ident)
+            if frame is not None:
+                stack = _stack(frame)[self._depth:]
+                # Skip samples of the profiler stopping itself
+                if stack and not stack[0].startswith(__name__):
+                    self.stacks[';'.join(stack)] += 1
+
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class TracingProfiler(object):
+    "Follows every call with sys.setprofile, counts are microseconds of own time"
+
+    def __init__(self):
+        self.stacks = Counter()
+        self._names = []
+        self._last = None
+
+
+    def start(self):
+        self._previous = sys.getprofile()
+        self._last = time.perf_counter()
+        sys.setprofile(self._event)
+
+
+    def _event(self, frame, event, arg):
+        now = time.perf_counter()
+        if self._names:
+            self.stacks[';'.join(self._names)] += int((now - self._last) * 10 ** 6)
+        if event == 'call':
+            self._names.append(_frame_name(frame))
+        elif event == 'c_call':
+            self._names.append('{}.{}'.format(getattr(arg, '__module__', None) or 'builtins', arg.__name__))
+        elif event in ('return', 'c_return', 'c_exception') and self._names:
+            self._names.pop()
+        self._last = now
+
+
+    def stop(self):
+        sys.setprofile(self._previous)
+
+
+class Profiled(object):
+    "Runs the block under the profiler and adds its stacks to the chat's aggregate"
+
+    def __init__(self, chat_id, profiler):
+        self.chat_id = chat_id
+        self.profiler = profiler
+
+
+    def __enter__(self):
+        self.profiler.start()
+        return self.profiler
+
+
+    def __exit__(self, *exc_info):
+        self.profiler.stop()
+        if self.profiler.stacks:
+            # Concurrent workers may lose each other's updates now and then,
+            # which is fine for a profile
+            key = STACKS_KEY.format(self.chat_id)
+            stacks = Counter(cache.get(key) or {})
+            stacks.update(self.profiler.stacks)
+            cache.set(key, dict(stacks), STACKS_TIMEOUT)
+        return False
+
+
+def collapsed(chat_id):
+    "Aggregated stacks of the chat in the collapsed format flame graph tools read"
+    stacks = cache.get(STACKS_KEY.format(chat_id)) or {}
+    return ['{} {}'.format(stack, count) for stack, count in sorted(stacks.items())]
+
+
+def clear(chat_id):
+    cache.delete(STACKS_KEY.format(chat_id))
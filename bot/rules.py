@@ -0,0 +1,266 @@
+import re
+import sre_constants
+import sre_parse
+
+from . import stemming
+from .models import Keyword
+from .normalization import normalize
+
+
+# Keys are matched according to their syntax:
+#   кот                       substring, "котлета" matches
+#   =кот                      whole word, "кот" but not "котлета"
+#   кот*                      words starting with "кот"
+#   /кот(ик|ята)/             regular expression
+#   ~чёрная кошка             the words in any form, "чёрной кошкой" matches
+#   кот AND NOT (собака OR "морская свинка")
+#                             boolean expression over substrings, =words,
+#                             prefixes*, ~words in any form and "quoted phrases"
+# Keys that don't parse, like unbalanced brackets, are substrings.
+
+# Literals are found by the multi-pattern scan of a message, see `bot.matching`
+SUBSTRING = 0
+WORD = 1
+PREFIX = 2
+# Stems of words, space separated, looked up among stems of the message's words
+LEMMA = 3
+LITERAL_KINDS = {Keyword.SUBSTRING: SUBSTRING, Keyword.WORD: WORD, Keyword.PREFIX: PREFIX, Keyword.LEMMA: LEMMA}
+
+AND = 'AND'
+OR = 'OR'
+NOT = 'NOT'
+LITERAL = 'LITERAL'
+
+REGEX_MAX_LENGTH = 256
+
+_tokens = re.compile(r'\(|\)|"[^"]*"|[^\s()"]+')
+
+
+def mode_of(key):
+    "Mode the key is matched in, given by its syntax"
+    if len(key) > 2 and key.startswith('/') and key.endswith('/'):
+        if compile_regex(pattern(key, Keyword.REGEX)) is not None:
+            return Keyword.REGEX
+    elif any(token in (AND, OR, NOT) for token in _tokens.findall(key)):
+        if parse(key) is not None:
+            return Keyword.BOOLEAN
+    elif len(key) > 1 and key.startswith('='):
+        return Keyword.WORD
+    elif len(key) > 1 and key.startswith('~'):
+        if pattern(key, Keyword.LEMMA):
+            return Keyword.LEMMA
+    elif len(key) > 1 and key.endswith('*') and '*' not in key[:-1]:
+        return Keyword.PREFIX
+    return Keyword.SUBSTRING
+
+
+def pattern(key, mode):
+    """What the index keeps of the key: the normalized literal for literal
+    modes, the regular expression or the boolean expression otherwise"""
+    if mode == Keyword.WORD:
+        return normalize(key[1:])
+    if mode == Keyword.PREFIX:
+        return normalize(key[:-1])
+    if mode == Keyword.LEMMA:
+        return lemma(key[1:])
+    if mode == Keyword.REGEX:
+        return key[1:-1]
+    if mode == Keyword.BOOLEAN:
+        return key
+    return normalize(key)
+
+
+def _literal(term):
+    "Literal node of a term of a boolean expression"
+    if term.startswith('"'):
+        kind, term = SUBSTRING, term[1:-1]
+    elif len(term) > 1 and term.startswith('='):
+        kind, term = WORD, term[1:]
+    elif len(term) > 1 and term.endswith('*'):
+        kind, term = PREFIX, term[:-1]
+    elif len(term) > 1 and term.startswith('~'):
+        term = lemma(term[1:])
+        return (LITERAL, (LEMMA, term)) if term else None
+    else:
+        kind = SUBSTRING
+    term = normalize(term)
+    return (LITERAL, (kind, term)) if term else None
+
+
+def parse(expression):
+    """Parse a boolean expression into a tree of (operator, operands) nodes
+    with (LITERAL, (kind, literal)) leaves. Returns None if it doesn't
+    parse or if it would match messages without any of its literals"""
+    tokens = _tokens.findall(expression)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        operands = [parse_and()]
+        while peek() == OR:
+            take()
+            operands.append(parse_and())
+        return operands[0] if len(operands) == 1 else (OR, operands)
+
+    def parse_and():
+        operands = [parse_not()]
+        while peek() == AND:
+            take()
+            operands.append(parse_not())
+        return operands[0] if len(operands) == 1 else (AND, operands)
+
+    def parse_not():
+        if peek() == NOT:
+            take()
+            return (NOT, parse_not())
+        if peek() == '(':
+            take()
+            node = parse_or()
+            if take() != ')':
+                raise ValueError
+            return node
+        # Adjacent words make a phrase
+        words = []
+        while peek() is not None and peek() not in (AND, OR, NOT, '(', ')'):
+            words.append(take())
+        if not words:
+            raise ValueError
+        node = _literal(words[0] if len(words) == 1 else ' '.join(words))
+        if node is None:
+            raise ValueError
+        return node
+
+    try:
+        tree = parse_or()
+    except (ValueError, IndexError):
+        return None
+    if position != len(tokens) or evaluate(tree, set()):
+        return None
+    return tree
+
+
+def evaluate(node, found):
+    "Evaluate the tree, `found` holds values of the literals that occur in the message"
+    operator, operands = node
+    if operator == LITERAL:
+        return operands in found
+    if operator == NOT:
+        return not evaluate(operands, found)
+    if operator == AND:
+        return all(evaluate(operand, found) for operand in operands)
+    return any(evaluate(operand, found) for operand in operands)
+
+
+def literals(node):
+    "Literal leaves of the tree"
+    operator, operands = node
+    if operator == LITERAL:
+        return [operands]
+    if operator == NOT:
+        return literals(operands)
+    return [literal for operand in operands for literal in literals(operand)]
+
+
+def lemma(words):
+    "Literal of words in any form: their stems"
+    return ' '.join(stemming.stems(normalize(words)))
+
+
+def compile_regex(source):
+    """Compiled case-insensitive regular expression or None if it's invalid,
+    too long, or could be run on every message or backtrack exponentially:
+    it must contain a literal every match contains, see `required_literal`,
+    and no repeat inside a repeat or alternation inside a repeat"""
+    if not source or len(source) > REGEX_MAX_LENGTH:
+        return None
+    try:
+        items = sre_parse.parse(source, re.IGNORECASE)
+        if _nested_repeat(items) or _required_literal(items) is None:
+            return None
+        return re.compile(source, re.IGNORECASE)
+    except (re.error, OverflowError, RecursionError):
+        return None
+
+
+def _nested_repeat(items, repeated=False):
+    "Whether the parsed expression has a repeat or an alternation inside a repeat"
+    for op, value in items:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            low, high, body = value
+            if repeated and high > 1:
+                return True
+            if _nested_repeat(body, repeated or high > 1):
+                return True
+        elif op == sre_constants.BRANCH:
+            if repeated:
+                return True
+            if any(_nested_repeat(branch, repeated) for branch in value[1]):
+                return True
+        elif op == sre_constants.SUBPATTERN:
+            if _nested_repeat(value[-1], repeated):
+                return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if _nested_repeat(value[1], repeated):
+                return True
+        elif op == sre_constants.GROUPREF_EXISTS:
+            if any(branch is not None and _nested_repeat(branch, repeated) for branch in value[1:]):
+                return True
+    return False
+
+
+def _sequence(items):
+    "Items of the expression with groups that always match inlined"
+    for op, value in items:
+        if op == sre_constants.SUBPATTERN:
+            yield from _sequence(value[-1])
+        else:
+            yield op, value
+
+
+def _required_literal(items):
+    runs, run = [], []
+    for op, value in _sequence(items):
+        if op == sre_constants.LITERAL:
+            run.append(chr(value))
+        else:
+            runs.append(''.join(run))
+            run = []
+    runs.append(''.join(run))
+    literal = normalize(max(runs, key=len))
+    return literal if len(literal) >= 2 else None
+
+
+def required_literal(source):
+    """Longest literal every match of the regular expression contains,
+    normalized, or None. A regex is only run on messages containing it"""
+    try:
+        return _required_literal(sre_parse.parse(source, re.IGNORECASE))
+    except (sre_constants.error, OverflowError, RecursionError):
+        return None
+
+
+def _is_word(char):
+    return char.isalnum() or char == '_'
+
+
+def occurs(text, literal, kind):
+    "Whether the literal occurs in the text as a substring, a whole word or a word prefix"
+    if kind == SUBSTRING:
+        return literal in text
+    start = text.find(literal)
+    while start != -1:
+        if start == 0 or not _is_word(text[start - 1]):
+            if kind == PREFIX:
+                return True
+            end = start + len(literal)
+            if end == len(text) or not _is_word(text[end]):
+                return True
+        start = text.find(literal, start + 1)
+    return False
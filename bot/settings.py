@@ -72,4 +72,25 @@ DJANGO_TELEGRAMBOT = {
         #Other bots here with same structure.
     ],
 
-}
\ No newline at end of file
+}
+
+# Bot API the workers deliver messages through. Point it to
+# `manage.py fake_bot_api` for load tests and replays
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+# How many times to retry a request the API answered 429 to. Retries are
+# queued to run after the `retry_after` the API asks for
+TELEGRAM_API_RETRIES = int(os.environ.get('TELEGRAM_API_RETRIES', 2))
+# Directory the workers of a host share compiled match indexes through,
+# see bot/snapshots.py. Empty to keep indexes in each process
+MATCH_INDEX_DIR = os.environ.get('MATCH_INDEX_DIR', '')
+# Keys are matched in messages case-insensitively after NFKC normalization.
+# These fold ё to е and Latin letters that look like Cyrillic ones. Folding
+# homoglyphs makes Latin keys like `cop` match Cyrillic words like `сор`,
+# so it's off unless the chats need to catch spam spelled in mixed scripts
+MATCH_FOLD_YO = os.environ.get('MATCH_FOLD_YO', 'True') == 'True'
+MATCH_FOLD_HOMOGLYPHS = os.environ.get('MATCH_FOLD_HOMOGLYPHS', 'False') == 'True'
+# Interface the workers' metrics exporter listens on, METRICS_PORT sets the port
+METRICS_ADDR = os.environ.get('METRICS_ADDR', '127.0.0.1')
+# Bearer token `/metrics` of the web process asks for. Without one it only
+# answers requests from localhost
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
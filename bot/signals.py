@@ -0,0 +1,149 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import subscriptions, utils
+from .models import Chat, Keyword, KeywordsGroup, NegativeKeyword, Relation, User
+
+
+# Keep users' data versions up to date, so everything cached
+# against them (e.g. inline listings) is invalidated on change.
+# Note that bulk_create and update don't send signals -- bump
+# the version by hand after them.
+
+CHANGED = ('post_add', 'post_remove', 'pre_clear')
+
+
+def bump(user_ids):
+    for user_id in set(user_ids):
+        utils.bump_user_data_version(user_id)
+
+
+@receiver([post_save, post_delete], sender=Keyword)
+@receiver([post_save, post_delete], sender=NegativeKeyword)
+@receiver([post_save, post_delete], sender=KeywordsGroup)
+@receiver([post_save, post_delete], sender=Relation)
+def users_object_changed(sender, instance, **kwargs):
+    bump([instance.user_id])
+
+
+@receiver(post_save, sender=Chat)
+def chat_changed(sender, instance, created, **kwargs):
+    if not created:
+        bump(instance.relation_set.values_list('user_id', flat=True))
+
+
+@receiver(m2m_changed, sender=NegativeKeyword.keywords.through)
+@receiver(m2m_changed, sender=KeywordsGroup.keys.through)
+def keywords_links_changed(sender, instance, action, **kwargs):
+    # Both sides of these relations belong to the same user
+    if action in CHANGED:
+        bump([instance.user_id])
+
+
+@receiver(m2m_changed, sender=Keyword.chats.through)
+def keyword_pins_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in CHANGED:
+        return
+    if not reverse:
+        bump([instance.user_id])
+    elif pk_set is None:
+        bump(instance.keywords.values_list('user_id', flat=True))
+    else:
+        bump(Keyword.objects.filter(id__in=pk_set).values_list('user_id', flat=True))
+
+
+@receiver(m2m_changed, sender=Relation)
+def chat_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in CHANGED:
+        return
+    if reverse:
+        bump([instance.id])
+    elif pk_set is None:
+        bump(instance.relation_set.values_list('user_id', flat=True))
+    else:
+        bump(pk_set)
+
+
+# Users cached by `utils.get_cached_user`
+
+@receiver([post_save, post_delete], sender=User)
+def cached_user_changed(sender, instance, **kwargs):
+    utils.forget_cached_user(instance)
+
+
+# Keep `ChatSubscription` in sync with pins, states, relations
+# and negative keys. Again, bulk operations have to call
+# `subscriptions.refresh_*` by hand.
+
+@receiver(post_save, sender=Keyword)
+def keyword_saved(sender, instance, created, **kwargs):
+    # New keywords aren't pinned anywhere yet
+    if not created:
+        subscriptions.refresh_keywords([instance.id])
+
+
+@receiver(pre_delete, sender=Keyword)
+def keyword_deleted(sender, instance, **kwargs):
+    # Subscriptions go away by cascade, workers still have to notice
+    subscriptions.invalidate_chats(instance.subscriptions.values_list('chat_id', flat=True))
+
+
+@receiver(m2m_changed, sender=Keyword.chats.through)
+def keyword_pins_subscriptions(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove'):
+        subscriptions.refresh_keywords(pk_set if reverse else [instance.id])
+    elif action == 'post_clear':
+        if reverse:
+            subscriptions.invalidate_chats([instance.id])
+            instance.subscriptions.all().delete()
+        else:
+            subscriptions.refresh_keywords([instance.id])
+
+
+@receiver(post_save, sender=NegativeKeyword)
+def negative_keyword_saved(sender, instance, created, **kwargs):
+    if not created:
+        subscriptions.refresh_keywords(instance.keywords.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=NegativeKeyword)
+def negative_keyword_deleting(sender, instance, **kwargs):
+    instance._linked_keywords = list(instance.keywords.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=NegativeKeyword)
+def negative_keyword_deleted(sender, instance, **kwargs):
+    subscriptions.refresh_keywords(getattr(instance, '_linked_keywords', []))
+
+
+@receiver(m2m_changed, sender=NegativeKeyword.keywords.through)
+def negative_links_subscriptions(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            subscriptions.refresh_keywords([instance.id])
+    elif action in ('post_add', 'post_remove'):
+        subscriptions.refresh_keywords(pk_set)
+    elif action == 'pre_clear':
+        negative_keyword_deleting(sender, instance)
+    elif action == 'post_clear':
+        negative_keyword_deleted(sender, instance)
+
+
+@receiver([post_save, post_delete], sender=Relation)
+def relation_subscriptions(sender, instance, **kwargs):
+    subscriptions.refresh_monitoring([(instance.user_id, instance.chat_id)])
+
+
+@receiver(m2m_changed, sender=Relation)
+def chat_users_subscriptions(sender, instance, action, reverse, pk_set, **kwargs):
+    # Forward side is `chat.user`, reverse is `user.chats`
+    if action in ('post_add', 'post_remove'):
+        if reverse:
+            subscriptions.refresh_monitoring((instance.id, pk) for pk in pk_set)
+        else:
+            subscriptions.refresh_monitoring((pk, instance.id) for pk in pk_set)
+    elif action == 'post_clear':
+        if reverse:
+            subscriptions.refresh_user(instance.id)
+        else:
+            subscriptions.refresh_keywords(instance.keywords.values_list('id', flat=True))
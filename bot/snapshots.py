@@ -0,0 +1,237 @@
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+
+from . import matching, normalization
+from .automaton import Automaton
+
+
+logger = logging.getLogger(__name__)
+
+# Compiled indexes are written to MATCH_INDEX_DIR in a flat binary format and
+# memory-mapped read-only, so prefork children of a host share the pages and
+# only the child that builds an index first pays for it. Loading an index
+# only decodes its distinct patterns: the literal, subscriber and trigger
+# tables and the automaton are used straight from the mapped pages, and
+# expressions are parsed or compiled when a message first triggers them.
+# Every index version has its own file, written atomically. Writing a
+# newer version removes the files of older ones, children that still map
+# an old file keep reading it until they load the new one.
+#
+# Layout:
+#   header   magic, format, normalization flags, index version, number of records,
+#            little-endian
+#   sections offset and number of items of every array of SECTIONS
+#   records  keyword id, owner, then offset and length in the blob of the key
+#            and of the JSON list of normalized negative keys
+#   arrays   the arrays of SECTIONS in native byte order, 8-byte aligned, the
+#            last one is the blob of UTF-8 strings, each stored once
+MAGIC = b'CMIX'
+FORMAT = 5
+HEADER = struct.Struct('<4sHHqI')
+SECTION = struct.Struct('<QQ')
+RECORD = struct.Struct('<qqIIII')
+# Strings are stored as (offset, length) pairs in the blob in the `_spans` arrays
+SECTIONS = (
+    matching.ChatIndex.TABLES
+    + tuple(('automaton_' + name, typecode) for name, typecode in Automaton.ARRAYS)
+    + (('pattern_spans', 'I'), ('expression_spans', 'I'), ('blob', 'B'))
+)
+RECORDS_OFFSET = HEADER.size + SECTION.size * len(SECTIONS)
+
+
+def path(directory, chat, version):
+    return os.path.join(directory, '{}-{}.idx'.format(chat.id, version))
+
+
+def remove_stale(directory, chat, version):
+    """Remove files of versions of the chat's index older than `version`,
+    and files left behind by writers of those versions"""
+    for filename in glob.glob(os.path.join(directory, '{}-*.idx*'.format(chat.id))):
+        name = os.path.basename(filename)
+        try:
+            stale = int(name[len(str(chat.id)) + 1:].split('.', 1)[0]) < version
+        except ValueError:
+            continue
+        if stale:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def write(filename, version, index):
+    "Atomically replace the file with a snapshot of the index"
+    arrays = {name: getattr(index, name) for name, _ in matching.ChatIndex.TABLES}
+    if len(index.scanned) >= matching.AUTOMATON_MIN_PATTERNS:
+        automaton = index.automaton()
+        arrays.update(('automaton_' + name, getattr(automaton, name)) for name, _ in Automaton.ARRAYS)
+
+    records, blob = [], bytearray()
+    # Strings repeated across records, like a pattern of many subscribers, are stored once
+    offsets = {}
+
+    def put(string):
+        if string not in offsets:
+            data = string.encode()
+            offsets[string] = (len(blob), len(data))
+            blob.extend(data)
+        return offsets[string]
+
+    for i in range(len(index)):
+        subscription = index.records[i]
+        records.append((
+            subscription.keyword_id, subscription.owner, *put(subscription.key),
+            *put(json.dumps(subscription.negative_keys, ensure_ascii=False)),
+        ))
+    arrays['pattern_spans'] = array('I', [n for pattern in index.patterns for n in put(pattern)])
+    arrays['expression_spans'] = array('I', [n for source in index.expression_sources for n in put(source)])
+    arrays['blob'] = blob
+
+    offset = RECORDS_OFFSET + RECORD.size * len(records)
+    sections, data = [], []
+    for name, typecode in SECTIONS:
+        values = bytes(arrays.get(name, b''))
+        offset = _align(offset)
+        sections.append((offset, len(values) // array(typecode).itemsize))
+        data.append((offset, values))
+        offset += len(values)
+
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, normalization.flags(), version, len(records)))
+        f.write(b''.join(SECTION.pack(*section) for section in sections))
+        f.write(b''.join(RECORD.pack(*record) for record in records))
+        for position, values in data:
+            f.write(bytes(position - f.tell()))
+            f.write(values)
+    os.replace(tmp, filename)
+
+
+class MappedRecords(object):
+    "Subscriptions of a snapshot, unpacked from the mapped file on access"
+
+    def __init__(self, buffer, blob, count):
+        self._buffer = buffer
+        self._blob = blob
+        self._count = count
+
+
+    def __len__(self):
+        return self._count
+
+
+    def __getitem__(self, i):
+        keyword_id, owner, key, key_len, negative, negative_len = \
+            RECORD.unpack_from(self._buffer, RECORDS_OFFSET + RECORD.size * i)
+        return matching.Subscription(
+            keyword_id,
+            str(self._blob[key:key + key_len], 'utf-8'),
+            owner,
+            tuple(json.loads(str(self._blob[negative:negative + negative_len], 'utf-8'))),
+        )
+
+
+class MappedStrings(object):
+    "Strings of a snapshot, decoded from the mapped file on access"
+
+    def __init__(self, blob, spans):
+        self._blob = blob
+        self._spans = spans
+
+
+    def __len__(self):
+        return len(self._spans) // 2
+
+
+    def __getitem__(self, i):
+        offset, length = self._spans[2 * i], self._spans[2 * i + 1]
+        return str(self._blob[offset:offset + length], 'utf-8')
+
+
+def _sections(buffer, count):
+    "Views of the arrays of the snapshot by name"
+    view = memoryview(buffer)
+    sections = {}
+    try:
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = SECTION.unpack_from(buffer, HEADER.size + SECTION.size * i)
+            end = offset + length * array(typecode).itemsize
+            if end > len(buffer):
+                raise ValueError("section {} is out of the file".format(name))
+            sections[name] = view[offset:end].cast(typecode)
+        if RECORDS_OFFSET + RECORD.size * count > len(buffer):
+            raise ValueError("records are out of the file")
+    except (struct.error, ValueError):
+        view.release()
+        _close(buffer, sections)
+        raise
+    finally:
+        view.release()
+    return sections
+
+
+def _close(buffer, sections):
+    "Unmap the file, the views of it have to be released first"
+    for section in sections.values():
+        section.release()
+    buffer.close()
+
+
+def load(filename, version):
+    "Map the snapshot and return its index, or None if there's no valid snapshot of this version"
+    try:
+        with open(filename, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    # Truncated or garbled files are a cache miss, the index is written again
+    sections = {}
+    try:
+        magic, format, flags, snapshot_version, count = HEADER.unpack_from(buffer)
+        if magic != MAGIC or format != FORMAT or flags != normalization.flags() or snapshot_version != version:
+            buffer.close()
+            return None
+        sections = _sections(buffer, count)
+        # The scan needs the patterns as strings, everything else stays in the pages
+        patterns = MappedStrings(sections['blob'], sections['pattern_spans'])
+        patterns = [patterns[j] for j in range(len(patterns))]
+    except (struct.error, ValueError, UnicodeDecodeError) as e:
+        logger.warning("Can't load index snapshot {}: {}".format(filename, e))
+        if not buffer.closed:
+            _close(buffer, sections)
+        return None
+    automaton = None
+    if len(sections['automaton_output']):
+        automaton = Automaton(*(sections['automaton_' + name] for name, _ in Automaton.ARRAYS))
+    return matching.ChatIndex(
+        MappedRecords(buffer, sections['blob'], count), patterns,
+        MappedStrings(sections['blob'], sections['expression_spans']), automaton,
+        **{name: sections[name] for name, _ in matching.ChatIndex.TABLES}
+    )
+
+
+def load_or_build(directory, chat, build):
+    """Return the chat's index from its snapshot, building and writing
+    the snapshot first when it's missing, outdated or broken."""
+    filename = path(directory, chat, chat.index_version)
+    index = load(filename, chat.index_version)
+    if index is not None:
+        return index
+    index = build(chat)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        write(filename, chat.index_version, index)
+        remove_stale(directory, chat, chat.index_version)
+    except OSError as e:
+        logger.warning("Can't write index snapshot {}: {}".format(filename, e))
+        return index
+    return load(filename, chat.index_version) or index
@@ -0,0 +1,141 @@
+import re
+from functools import lru_cache
+
+
+# Snowball Russian stemmer (snowballstem.org/algorithms/russian) with Ukrainian
+# letters and the commonest Ukrainian endings added to its lists. It only
+# strips suffixes, so forms of a word share a stem: кошка, кошки, кошкой,
+# кошку -> кошк. Words are expected normalized, see `bot.normalization`.
+
+VOWELS = set('аеиоуыэюяіїє')
+
+# Endings marked `after_a` are only removed after а or я, which stays
+PERFECTIVE_GERUND = {
+    'after_a': ('в', 'вши', 'вшись'),
+    'any': ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'),
+}
+ADJECTIVE = {
+    'any': ('ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'его',
+            'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею',
+            # Ukrainian
+            'ій', 'ім', 'іх', 'іми', 'ої', 'ього', 'ьому', 'ьої', 'ьою'),
+}
+PARTICIPLE = {
+    'after_a': ('ем', 'нн', 'вш', 'ющ', 'щ'),
+    'any': ('ивш', 'ывш', 'ующ'),
+}
+REFLEXIVE = {
+    'any': ('ся', 'сь'),
+}
+VERB = {
+    'after_a': ('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть',
+                'ешь', 'нно'),
+    'any': ('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым',
+            'ен', 'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю',
+            # Ukrainian
+            'емо', 'ємо', 'имо', 'єте', 'ють', 'уть'),
+}
+NOUN = {
+    'any': ('а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей', 'ой',
+            'ий', 'й', 'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию',
+            'ью', 'ю', 'ия', 'ья', 'я',
+            # Ukrainian
+            'і', 'ї', 'ів', 'їв', 'ові', 'еві', 'єві', 'єю', 'єм', 'є'),
+}
+DERIVATIONAL = {
+    'any': ('ост', 'ость'),
+}
+SUPERLATIVE = {
+    'any': ('ейш', 'ейше'),
+}
+
+_words = re.compile(r'\w+')
+
+
+def _regions(word):
+    "Start of RV, the part after the first vowel, and of R2"
+    rv = r1 = r2 = len(word)
+    for i, char in enumerate(word):
+        if char in VOWELS:
+            rv = i + 1
+            break
+    for i in range(1, len(word)):
+        if word[i - 1] in VOWELS and word[i] not in VOWELS:
+            r1 = i + 1
+            break
+    for i in range(r1 + 1, len(word)):
+        if word[i - 1] in VOWELS and word[i] not in VOWELS:
+            r2 = i + 1
+            break
+    return rv, r2
+
+
+def _table(endings):
+    "Groups of the endings by length, longest first, then by the ending"
+    table = {}
+    for group, candidates in endings.items():
+        for ending in candidates:
+            table.setdefault(len(ending), {})[ending] = group
+    return sorted(table.items(), reverse=True)
+
+
+(PERFECTIVE_GERUND, ADJECTIVE, PARTICIPLE, REFLEXIVE, VERB, NOUN, DERIVATIONAL, SUPERLATIVE) = map(_table, (
+    PERFECTIVE_GERUND, ADJECTIVE, PARTICIPLE, REFLEXIVE, VERB, NOUN, DERIVATIONAL, SUPERLATIVE))
+
+
+def _remove(word, start, table):
+    """Remove the longest of the endings that lies after `start`,
+    return None if there's none or its condition doesn't hold"""
+    for length, endings in table:
+        if len(word) - length < start:
+            continue
+        group = endings.get(word[-length:])
+        if group is None:
+            continue
+        stem = word[:-length]
+        if group == 'after_a' and not (len(stem) > start and stem[-1] in 'ая'):
+            return None
+        return stem
+    return None
+
+
+@lru_cache(maxsize=65536)
+def stem(word):
+    word = word.replace('ё', 'е')
+    rv, r2 = _regions(word)
+
+    # Step 1
+    stemmed = _remove(word, rv, PERFECTIVE_GERUND)
+    if stemmed is None:
+        word = _remove(word, rv, REFLEXIVE) or word
+        stemmed = _remove(word, rv, ADJECTIVE)
+        if stemmed is not None:
+            stemmed = _remove(stemmed, rv, PARTICIPLE) or stemmed
+        else:
+            stemmed = _remove(word, rv, VERB)
+            if stemmed is None:
+                stemmed = _remove(word, rv, NOUN)
+    if stemmed is not None:
+        word = stemmed
+
+    # Step 2
+    if word.endswith('и') and len(word) > rv:
+        word = word[:-1]
+
+    # Step 3
+    word = _remove(word, r2, DERIVATIONAL) or word
+
+    # Step 4
+    superlative = _remove(word, rv, SUPERLATIVE)
+    if superlative is not None:
+        word = superlative
+    if word.endswith('нн') and len(word) - 1 > rv:
+        word = word[:-1]
+    elif superlative is None and word.endswith('ь') and len(word) > rv:
+        word = word[:-1]
+    return word
+
+
+def stems(text):
+    "Stems of the words of the text, in order"
+    return [stem(word) for word in _words.findall(text)]
@@ -0,0 +1,121 @@
+import json
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import Chat, ChatSubscription, Keyword, NegativeKeyword, Relation
+
+
+logger = logging.getLogger(__name__)
+
+# Keywords are refreshed in batches of this size to keep `IN (...)` lists short
+BATCH_SIZE = 1000
+
+
+def _batches(ids):
+    ids = sorted(ids)
+    for i in range(0, len(ids), BATCH_SIZE):
+        yield ids[i:i + BATCH_SIZE]
+
+
+def build_subscriptions(keyword_ids):
+    """Return unsaved `ChatSubscription`s of the given keywords.
+    Takes four queries whatever the number of keywords and pins."""
+    keywords = {
+        pk: (key, mode, state, user_id, owner)
+        for pk, key, mode, state, user_id, owner in Keyword.objects.filter(id__in=keyword_ids)
+            .values_list('id', 'key', 'mode', 'state', 'user_id', 'user__chat_id')
+    }
+    if not keywords:
+        return []
+
+    pins = list(Keyword.chats.through.objects.filter(keyword_id__in=keywords)
+                .values_list('keyword_id', 'chat_id'))
+    if not pins:
+        return []
+
+    relations = {
+        (user_id, chat_id): active
+        for user_id, chat_id, active in Relation.objects
+            .filter(user_id__in=set(k[3] for k in keywords.values()),
+                    chat_id__in=set(chat_id for _, chat_id in pins))
+            .values_list('user_id', 'chat_id', 'active')
+    }
+
+    negative_keys = defaultdict(list)
+    for keyword_id, nkey in NegativeKeyword.keywords.through.objects \
+            .filter(keyword_id__in=keywords) \
+            .values_list('keyword_id', 'negativekeyword__key'):
+        negative_keys[keyword_id].append(nkey)
+
+    subscriptions = []
+    for keyword_id, chat_id in pins:
+        key, mode, state, user_id, owner = keywords[keyword_id]
+        subscriptions.append(ChatSubscription(
+            chat_id=chat_id,
+            keyword_id=keyword_id,
+            key=key,
+            mode=mode,
+            owner=owner,
+            active=state and relations.get((user_id, chat_id), False),
+            negative_keys=json.dumps(sorted(negative_keys[keyword_id]), ensure_ascii=False),
+        ))
+    return subscriptions
+
+
+def invalidate_chats(chat_ids):
+    "Make workers rebuild match indexes of the chats"
+    if chat_ids:
+        Chat.objects.filter(id__in=chat_ids).update(index_version=F('index_version') + 1)
+
+
+def refresh_keywords(keyword_ids):
+    """Rewrite subscriptions of the given keywords. Call it after
+    changing pins, states or negative keys of keywords in bulk --
+    the signals only cover changes made through the models."""
+    keyword_ids = set(keyword_ids)
+    if not keyword_ids:
+        return
+    chats = set()
+    with transaction.atomic():
+        for batch in _batches(keyword_ids):
+            stale = ChatSubscription.objects.filter(keyword_id__in=batch)
+            chats.update(stale.values_list('chat_id', flat=True))
+            stale.delete()
+            subscriptions = ChatSubscription.objects.bulk_create(build_subscriptions(batch))
+            chats.update(s.chat_id for s in subscriptions)
+        invalidate_chats(chats)
+
+
+def refresh_monitoring(pairs):
+    "Rewrite subscriptions of keywords pinned by users to chats, given as (user_id, chat_id)"
+    pairs = set(pairs)
+    if not pairs:
+        return
+    users = set(user_id for user_id, _ in pairs)
+    chats = set(chat_id for _, chat_id in pairs)
+    refresh_keywords(
+        keyword_id for keyword_id, user_id, chat_id in Keyword.chats.through.objects
+            .filter(keyword__user_id__in=users, chat_id__in=chats)
+            .values_list('keyword_id', 'keyword__user_id', 'chat_id')
+        if (user_id, chat_id) in pairs
+    )
+
+
+def refresh_user(user_id):
+    refresh_keywords(Keyword.objects.filter(user_id=user_id).values_list('id', flat=True))
+
+
+def rebuild():
+    "Rebuild the whole table from scratch. Returns the number of subscriptions"
+    count = 0
+    with transaction.atomic():
+        ChatSubscription.objects.all().delete()
+        keyword_ids = Keyword.chats.through.objects.values_list('keyword_id', flat=True).distinct()
+        for batch in _batches(keyword_ids):
+            count += len(ChatSubscription.objects.bulk_create(build_subscriptions(batch)))
+        Chat.objects.update(index_version=F('index_version') + 1)
+    logger.info("Rebuilt {} chat subscriptions".format(count))
+    return count
@@ -2,66 +2,147 @@ from __future__ import absolute_import, unicode_literals
 
 import logging
 import os
+import time as clock
 
+import requests
 from celery import shared_task
+from django.conf import settings
 
-from django.core.cache import cache
-from .models import Chat, Keyword, NegativeKeyword
-from . import utils
+from .models import Chat, Keyword, NegativeKeyword, User
+from . import digests, matching, metrics, profiling, tracing, utils
 
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 TOKEN = os.environ.get('BOT_TOKEN')
 
-import requests
+
+def call_api(method, body):
+    """Call a Bot API method, timing the request. A request the API asks
+    to repeat later (429) is queued again to run after `retry_after`,
+    see `retry_api_call`, the worker doesn't wait for it"""
+    response = _post(method, _api_url(method), body)
+    if response.status_code == 429 and settings.TELEGRAM_API_RETRIES > 0:
+        retry_after = _retry_after(response)
+        logger.info("(call_api) {} is rate limited, retrying in {}s".format(method, retry_after))
+        retry_api_call.apply_async((method, body), countdown=retry_after)
+    return response
+
+
+@shared_task(bind=True)
+def retry_api_call(self, method, body):
+    "Repeat a rate limited Bot API request, up to TELEGRAM_API_RETRIES times in all"
+    response = _post(method, _api_url(method), body)
+    if response.status_code != 429:
+        return
+    if self.request.retries + 1 >= settings.TELEGRAM_API_RETRIES:
+        logger.warning("(retry_api_call) {} is still rate limited, giving up".format(method))
+        return
+    raise self.retry(countdown=_retry_after(response), max_retries=None)
+
+
+def _api_url(method):
+    return "{}/bot{}/{}".format(settings.TELEGRAM_API_URL, TOKEN, method)
+
+
+def _retry_after(response):
+    try:
+        return response.json()['parameters']['retry_after']
+    except (ValueError, KeyError, TypeError):
+        return 1
+
+
+def _post(method, url, body):
+    status = 'error'
+    started = clock.perf_counter()
+    with tracing.span('telegram.' + method, chat_id=body.get('chat_id')) as span:
+        try:
+            response = requests.post(url, json=body)
+            status = span['status'] = str(response.status_code)
+            if not response.ok:
+                span['error'] = response.text[:200]
+            return response
+        finally:
+            metrics.TELEGRAM_API_SECONDS.labels(method, status).observe(clock.perf_counter() - started)
+
 
 def forward_message(chat_id, from_chat_id, message_id):
-    METHOD = 'forwardMessage'
-    url = "https://api.telegram.org/bot{}/{}".format(TOKEN, METHOD)
     body = {
         'chat_id': chat_id,
         'from_chat_id': from_chat_id,
         'message_id': message_id,
     }
 
-    requests.post(url, json=body)
+    call_api('forwardMessage', body)
 
 
 def send_message(chat_id, text):
-    METHOD = 'sendMessage'
-    url = "https://api.telegram.org/bot{}/{}".format(TOKEN, METHOD)
     body = {
         'chat_id': chat_id,
         'text': text
     }
 
-    requests.post(url, json=body)
+    call_api('sendMessage', body)
 
 
-@shared_task
-def check_message_for_keywords(chat_id, message_id, text, user_id, time):
-    logger.debug("Processing message \"{}\" from {}".format(text, chat_id))
-    chat = Chat.objects.get(chat_id=chat_id)
-
-    # Define a list where keywords that occur in message will be stored
-    keywords = []
-    # Try to find them, man!
-    # logger.debug("message - {}".format(update.message.text))
-    for keyword in chat.keywords.filter(state=True):
-        state = True
-        if not keyword.key: continue
-        # logger.debug("key {} - {}".format(keyword.key.lower(), keyword.key.lower() in text.lower()))
-        if keyword.key.lower() in text.lower():
-            # Also don't forget about negative keywords
-            for nkey in keyword.negativekeyword.all():
-                if nkey.key in text:
-                    state = False
-            if state:
-                relation = keyword.user.relation_set.filter(chat=chat)[0]
-                if relation.active:
-                    keywords.append(keyword)
+def edit_message_text(chat_id, message_id, text):
+    body = {
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'text': text
+    }
+
+    call_api('editMessageText', body)
+
+
+def queue_message(chat_id, message_id, text, user_id, time):
+    "Queue a group message for matching"
+    queue = check_message_for_keywords.app.conf.task_default_queue
+    metrics.MESSAGES_RECEIVED.labels(metrics.shard(chat_id), queue).inc()
+    # The trace id travels in the task headers
+    headers = {'trace_id': tracing.new_trace_id()} if tracing.enabled() else None
+    check_message_for_keywords.apply_async(
+        (chat_id, message_id, text, user_id, time), {'enqueued': clock.time()}, headers=headers)
+
+
+@shared_task(bind=True)
+def check_message_for_keywords(self, chat_id, message_id, text, user_id, time, enqueued=None):
+    trace_id = self.request.get('trace_id') or (self.request.headers or {}).get('trace_id')
+    logger.debug("Processing message \"{}\" from {} (trace {})".format(text, chat_id, trace_id))
+    labels = (metrics.shard(chat_id), (self.request.delivery_info or {}).get('routing_key') or 'direct')
+    with tracing.trace('check_message_for_keywords', trace_id, enqueued) as trace:
+        if enqueued is not None:
+            waited = max(clock.time() - enqueued, 0)
+            metrics.ENQUEUE_TO_MATCH_SECONDS.labels(*labels).observe(waited)
+            if trace is not None:
+                trace.add_span('queued', enqueued, waited)
+        # Switched on by `manage.py profile_matching`
+        profiler = profiling.profiler_for(chat_id)
+        if profiler is None:
+            return process_message(chat_id, message_id, text, user_id, time, labels)
+        with profiler:
+            return process_message(chat_id, message_id, text, user_id, time, labels)
+
+
+def process_message(chat_id, message_id, text, user_id, time, labels):
+    with tracing.span('load_index') as span:
+        chat = Chat.objects.get(chat_id=chat_id)
+        # Active subscriptions whose keys occur in the message and negative keys
+        # don't. The index is rebuilt only when the chat's subscriptions change
+        index = matching.get_index(chat)
+        span['subscriptions'] = len(index)
+    if not len(index):
+        metrics.MESSAGES_PREFILTERED.labels(*labels).inc()
+    started = clock.perf_counter()
+    with tracing.span('match') as span:
+        keywords = index.match(text)
+        span['matched'] = len(keywords)
+    cost = clock.perf_counter() - started
+    metrics.MATCH_SECONDS.labels(*labels).observe(cost)
+    # Quantiles per chat and per matched keyword, see `manage.py latency_report`
+    matched = [kw.keyword_id for kw in keywords]
+    digests.record(chat_id, matched, digests.MATCH_COST, cost)
+    digests.record(chat_id, matched, digests.MESSAGE_LENGTH, len(text))
 
     # If theres no keywords - skip
     if not keywords:
@@ -76,7 +157,12 @@ def check_message_for_keywords(chat_id, message_id, text, user_id, time):
     keys = ', '.join([kw.key for kw in keywords])
     logger.info("Found keywords ({}) in {}:{}".format(keys, message_id, text.replace('\n', ' ')))
 
-    if not utils.check_for_uniqueness(user_id, time, text):
+    metrics.MESSAGES_MATCHED.labels(*labels).inc()
+
+    with tracing.span('dedup') as span:
+        unique = span['unique'] = utils.check_for_uniqueness(user_id, text)
+    if not unique:
+        metrics.MESSAGES_DEDUPLICATED.labels(*labels).inc()
         ms = "Skipped message {} due repeating".format(message_id)
         logger.info(ms)
 
@@ -85,19 +171,51 @@ def check_message_for_keywords(chat_id, message_id, text, user_id, time):
         return False
 
     # Resending messages to users
-    users = list(set([kw.user for kw in keywords]))
+    users = set(kw.owner for kw in keywords)
     for user in users:
-        logger.info("Sending message {} to {}".format(message_id, user.chat_id))
+        logger.info("Sending message {} to {}".format(message_id, user))
 
-        forward_message(user.chat_id, chat_id, message_id)
+        forward_message(user, chat_id, message_id)
+        metrics.MESSAGES_FORWARDED.labels(*labels).inc()
+    # Since the message was sent to the chat
+    digests.record(chat_id, matched, digests.FORWARD_LATENCY, max(clock.time() - time, 0))
 
     for usr in chat.user.filter(debug=True):
-        if usr not in users:
+        if usr.chat_id not in users:
             send_message(usr.chat_id, "Skipped message (no keywords match) {}:{}".format(message_id, text))
     return True
 
 
+@shared_task
+def add_keys(user_id, negative, keys, report):
+    "Add a large paste of keys and send the user `report` formatted with the counts"
+    user = User.objects.get(id=user_id)
+    added, duplicates = utils.add_keys(user, NegativeKeyword if negative else Keyword, keys)
+    send_message(user.chat_id, report.format(added=added, duplicates=duplicates))
+
+
+@shared_task
+def delete_all_keywords(user_id, message_id, progress, done):
+    """Delete all user's keywords chunk by chunk, reporting `progress`
+    formatted with the counts in the message and finishing with `done`"""
+    user = User.objects.get(id=user_id)
+
+    def report(deleted, total):
+        edit_message_text(user.chat_id, message_id, progress.format(deleted=deleted, total=total))
+
+    utils.delete_all_keywords(user, report)
+    edit_message_text(user.chat_id, message_id, done)
+
+
+@shared_task
+def sweep_cache():
+    removed = utils.sweep_cache()
+    logger.info("Swept {} expired cache entries".format(removed))
+
+
+# Replaced with sweep_cache. Kept for one release, so flush_cache messages
+# still queued by the old beat schedule are consumed instead of failing
+# as unregistered. Remove in the next release.
 @shared_task
 def flush_cache():
-    logger.info("Flushing Cache...")
-    cache.clear()
+    logger.info("flush_cache is retired, entries expire on their own")
@@ -7,7 +7,7 @@ import re
 import uuid
 from collections import namedtuple
 
-from django.core.paginator import Paginator
+from django.core.cache import cache
 
 import telegram
 from django_telegrambot.apps import DjangoTelegramBot
@@ -17,7 +17,7 @@ from telegram.ext import (CallbackQueryHandler, CommandHandler,
 
 from . import tasks, utils
 from .bot_filters import GroupFilters
-from .models import Chat, Keyword, NegativeKeyword, User, KeywordsGroup
+from .models import Chat, Keyword, NegativeKeyword, Relation, User, KeywordsGroup
 
 # Config logging
 debug = os.environ.get('DEBUG', 0)
@@ -32,6 +32,57 @@ with open('bot/text.json', encoding='utf8') as file:
 
 
 
+# Helpers
+
+INLINE_PAGE_SIZE = 40
+
+
+def paginate(objects, update):
+    """Return a page of objects for the inline query and the offset of the next one.
+    Fetches one extra row to find out whether there is a next page instead of
+    counting all the objects like `Paginator` does"""
+    page = int(update.inline_query.offset or 1)
+    if not objects.ordered:
+        objects = objects.order_by('id')
+
+    start = (page - 1) * INLINE_PAGE_SIZE
+    items = list(objects[start:start + INLINE_PAGE_SIZE + 1])
+    next_offset = str(page + 1) if len(items) > INLINE_PAGE_SIZE else ''
+    return items[:INLINE_PAGE_SIZE], next_offset
+
+
+def typed_term(update, pattern):
+    "Return what the user typed after the trigger text of the inline query"
+    match = re.match(pattern, update.inline_query.query)
+    return update.inline_query.query[match.end():].strip()
+
+
+# Telegram may cache the answer as well. Rendered pages are cached on our
+# side until the user's data changes, so this only has to be short enough
+# for the user not to notice stale results after editing keys
+INLINE_CACHE_TIME = 15
+
+
+def answer_listing(update, user, listing, build):
+    """Answer the inline query with a page of results made by `build`.
+    Rendered pages are cached per user, listing, query and offset and are
+    invalidated by the user's data version whenever their keys change"""
+    key = utils.inline_page_key(user.id, listing, update.inline_query.query, update.inline_query.offset)
+    page = cache.get(key)
+    if page is None:
+        page = build()
+        cache.set(key, page, utils.INLINE_PAGE_TIMEOUT)
+
+    results, next_offset = page
+    update.inline_query.answer(
+        results=results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True,
+        next_offset=next_offset,
+    )
+
+
+
 # Keyboards
 
 menu_keyboard = telegram.InlineKeyboardMarkup([
@@ -150,6 +201,8 @@ def new_chat_members(bot, update):
         if member.username == bot.username:
             if chat:
                 chat.bot_in_chat = True
+                # Saving every field could roll back a concurrent bump of `index_version`
+                chat.save(update_fields=['bot_in_chat'])
 
             else:
                 # Defining chat type
@@ -158,8 +211,7 @@ def new_chat_members(bot, update):
                         chat_type = literal
 
                 chat = Chat(chat_id=update.message.chat.id, chat_type=chat_type, title=update.message.chat.title)
-
-            chat.save()
+                chat.save()
 
             # Looking for users with common chat
             for user in User.objects.all():
@@ -191,7 +243,7 @@ def left_chat_member(bot, update):
     if update.message.left_chat_member.username == bot.username:
 
         chat.bot_in_chat = False
-        chat.save()
+        chat.save(update_fields=['bot_in_chat'])
     # If any other user was kicked delete this chat from his list
     else:
         user = User.objects.get_or_none(chat_id=update.message.left_chat_member.id)
@@ -206,24 +258,26 @@ def left_chat_member(bot, update):
 # Add key
 
 def ask_new_key(bot, update):
-    bot.sendMessage(update.effective_message.chat.id, text=random.choice(text.actions.add_key.ask_new_key))
+    bot.sendMessage(update.effective_message.chat.id, text=random.choice(text.actions.add_key.ask_new_key) + '\n\n' + text.actions.add_key.syntax)
     return PROCESS_KEY
 
 
 def add_key(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
-    # Store unique-in-user-scope keys
-    keys = set(update.message.text.split('\n'))
-    for k in keys:
-        if not Keyword.objects.filter(key=k, user=user) and k:
-            key = Keyword(key=k, user=user)
-            key.save()
+    keys = utils.normalize_keys(update.message.text)
+    # Don't keep the dispatcher busy with huge pastes
+    if len(keys) > utils.BULK_KEYS_LIMIT:
+        tasks.add_keys.delay(user.id, False, keys, text.actions.add_key.report)
+        bot.sendMessage(user.chat_id, text=text.actions.add_key.queued)
+        return -1
+    added, duplicates = utils.add_keys(user, Keyword, keys)
 
     keyboard = telegram.InlineKeyboardMarkup([
         [telegram.InlineKeyboardButton(text=text.buttons.menu.pin_key_to_chat, switch_inline_query_current_chat=text.buttons.menu.pin_key_to_chat[:-2])],
     ])
-    bot.sendMessage(user.chat_id, text=text.actions.add_key.success, reply_markup=keyboard)
+    report = text.actions.add_key.report.format(added=added, duplicates=duplicates)
+    bot.sendMessage(user.chat_id, text=text.actions.add_key.success + '\n\n' + report, reply_markup=keyboard)
     return -1
 
 
@@ -237,19 +291,21 @@ def ask_negative_key(bot, update):
 
 
 def add_negative_key(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
-    # Store unique-in-user-scope keys
-    keys = set(update.message.text.split('\n'))
-    for k in keys:
-        if not NegativeKeyword.objects.filter(key=k, user=user) and k:
-            nkey = NegativeKeyword(key=k, user=user)
-            nkey.save()
+    keys = utils.normalize_keys(update.message.text)
+    # Don't keep the dispatcher busy with huge pastes
+    if len(keys) > utils.BULK_KEYS_LIMIT:
+        tasks.add_keys.delay(user.id, True, keys, text.actions.add_neg_key.report)
+        bot.sendMessage(user.chat_id, text=text.actions.add_neg_key.queued)
+        return -1
+    added, duplicates = utils.add_keys(user, NegativeKeyword, keys)
 
     keyboard = telegram.InlineKeyboardMarkup([
         [telegram.InlineKeyboardButton(text=text.buttons.menu.pin_neg_key, switch_inline_query_current_chat=text.buttons.menu.pin_neg_key[:-2])],
     ])
-    bot.sendMessage(user.chat_id, text=text.actions.add_neg_key.success, reply_markup=keyboard)
+    report = text.actions.add_neg_key.report.format(added=added, duplicates=duplicates)
+    bot.sendMessage(user.chat_id, text=text.actions.add_neg_key.success + '\n\n' + report, reply_markup=keyboard)
     return -1
 
 
@@ -260,39 +316,34 @@ def add_negative_key(bot, update):
 def get_keys_for_pinning(bot, update):
     "Shows all user's keys answering to inline query"
     logger.debug("Processing in function get_keys_for_pinning")
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
+    term = typed_term(update, text.buttons.menu.pin_key_to_chat[:-2])
 
     # Due to the restriction of number of objects we can send in response we need to paginate the data
-    objects = user.keywords.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
-
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = utils.search(user.keywords.with_chats(), 'key', user.id, term)
+        keywords, next_offset = paginate(objects, update)
+        return ([
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title='Все ключи',
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.pin_key.choose_pin_key.format(text.actions.pin_key.all_keys)))
-        ] + [
+        ] if not term else []) + [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=keyword.key,
                 description=keyword.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.pin_key.choose_pin_key.format(keyword.key))
             ) for keyword in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'get_keys_for_pinning', build)
     logger.debug("Processing finished in function get_keys_for_pinning")
 
 
 def get_chat_list_button_for_pinning_key(bot, update):
     "Shows a message with button to switch inline query with available chats on"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     key = re.match(text.re.choose_pin_key, update.message.text).group(1)
 
@@ -306,35 +357,29 @@ def get_chat_list_button_for_pinning_key(bot, update):
 
 def get_chat_list_for_pinning_key(bot, update):
     "Shows all user's chats answering to inline query"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     key = re.match(text.re.choose_chat_to_pin, update.inline_query.query).group(1)
 
     # Due to the restriction of number of objects we can send in response we need to paginate the data
-    objects = user.chats.filter(bot_in_chat=True)
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    chats = paginator.page(int(offset))
-    next_offset = str(chats.next_page_number()) if chats.has_next() else ''
-
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = user.chats.filter(bot_in_chat=True).with_keys(user)
+        chats, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=chat.title,
                 description=chat.get_keys(user),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.pin_key.pin_key_to_chat.format(chat=chat.id, key=key))
             ) for chat in chats
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'get_chat_list_for_pinning_key', build)
 
 
 def pin_key_to_chat(bot, update):
     "Pin key to chat, nothing more.."
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     match = re.match(text.re.pin_key_to_chat, update.message.text)
     chat_id = match.group(1)
@@ -362,32 +407,26 @@ def pin_key_to_chat(bot, update):
 
 def get_chat_list_for_unpinning_key(bot, update):
     "Show user's chats list answering to inline query"
-    user = User.objects.get(chat_id=update.effective_user.id)
-
-    objects = user.chats.filter(bot_in_chat=True)
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    chats = paginator.page(int(offset))
-    next_offset = str(chats.next_page_number()) if chats.has_next() else ''
+    user = utils.resolve_user(update)
 
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = user.chats.filter(bot_in_chat=True).with_keys(user)
+        chats, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=chat.title,
                 description=chat.get_keys(user),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.unpin_key.select_chat.format(chat.id))
             ) for chat in chats
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'get_chat_list_for_unpinning_key', build)
 
 
 def get_key_list_button_for_unpinning_key(bot, update):
     "Show message with button that switches inline mode on to show all keys for specified chat"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     chat = re.match(text.re.unpin_key_select_chat, update.message.text).group(1)
 
@@ -401,39 +440,35 @@ def get_key_list_button_for_unpinning_key(bot, update):
 
 def get_key_list_for_pinning_key(bot, update):
     "Show all keys for specified chat in inline mode"
-    user = User.objects.get(chat_id=update.effective_user.id)
-
-    chat_id = re.match(text.re.unpin_key_choose_key, update.inline_query.query).group(1)
-    chat = Chat.objects.get(id=chat_id)
+    user = utils.resolve_user(update)
 
-    objects = chat.keywords.filter(user=user)
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
+    match = re.match(text.re.unpin_key_choose_key, update.inline_query.query)
+    chat_id = match.group(1)
+    term = update.inline_query.query[match.end():].strip()
 
-    update.inline_query.answer(
-        results=[
+    def build():
+        chat = Chat.objects.get(id=chat_id)
+        objects = utils.search(chat.keywords.filter(user=user), 'key', user.id, term)
+        keywords, next_offset = paginate(objects, update)
+        return ([
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title='Все ключи',
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.unpin_key.unpin.format(chat=chat.id, key=text.actions.unpin_key.all_keys)))
-        ] + [
+        ] if not term else []) + [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=kw.key,
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.unpin_key.unpin.format(chat=chat.id, key=kw.key))
             ) for kw in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'get_key_list_for_pinning_key', build)
 
 
 def unpin_key_from_chat(bot, update):
     "Just unpin key from chat"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     match = re.match(text.re.unpin_key_from_chat, update.message.text)
     chat_id = match.group(1)
@@ -460,32 +495,27 @@ def unpin_key_from_chat(bot, update):
 
 def get_keys_list_for_deletion(bot, update):
     "Shows all keys list in inline mode"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
+    term = typed_term(update, text.buttons.menu.delete_key[:-2])
 
-    objects = user.keywords.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
-
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = utils.search(user.keywords.with_chats(), 'key', user.id, term)
+        keywords, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=kw.key,
                 description=kw.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.key_deletion.delete.format(key=kw.key))
             ) for kw in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'get_keys_list_for_deletion', build)
 
 
 def delete_key(bot, update):
     "Key deletion"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     key = re.match(text.re.delete_key, update.message.text).group(1)
     try:
@@ -505,37 +535,32 @@ def delete_key(bot, update):
 
 def get_negative_keys_list_for_pinning(bot, update):
     "Show a list of negative keywords in inline mode"
-    user = User.objects.get(chat_id=update.effective_user.id)
-
-    objects = user.negativekeyword.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
+    user = utils.resolve_user(update)
+    term = typed_term(update, text.buttons.menu.pin_neg_key[:-2])
 
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = utils.search(user.negativekeyword.with_keys(), 'key', user.id, term)
+        keywords, next_offset = paginate(objects, update)
+        return ([
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title='Все ключи',
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.pin_neg_key.choose_pin_key.format(text.actions.pin_neg_key.all_keys)))
-        ] + [
+        ] if not term else []) + [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=keyword.key,
                 description=keyword.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.pin_neg_key.choose_pin_key.format(keyword.key))
             ) for keyword in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'get_negative_keys_list_for_pinning', build)
 
 
 def get_key_list_button_for_pinning_negative_key(bot, update):
     "Shows a message with button to switch to show keys list"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     key = re.match(text.re.choose_pin_neg_key, update.message.text).group(1)
 
@@ -549,18 +574,14 @@ def get_key_list_button_for_pinning_negative_key(bot, update):
 
 def get_keys_list_for_pinning_negative_key(bot, update):
     "Shows a list of keys in inline mode"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     keyword = re.match(text.re.choose_key_to_pin, update.inline_query.query).group(1)
 
-    objects = user.keywords.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
-
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = user.keywords.with_chats()
+        keywords, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title='Все ключи',
@@ -573,16 +594,14 @@ def get_keys_list_for_pinning_negative_key(bot, update):
                 description=key.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.pin_neg_key.pin_key_to_key.format(key=key.id, nkey=keyword))
             ) for key in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'get_keys_list_for_pinning_negative_key', build)
 
 
 def pin_negative_key_to_key(bot, update):
     "Pin negative key to key, that's all!"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     match = re.match(text.re.pin_key_to_key, update.message.text)
     key_id = match.group(1)
@@ -622,32 +641,27 @@ def pin_negative_key_to_key(bot, update):
 
 def get_key_list_for_unpinning_negative_key(bot, update):
     "Shows a list of keywords in inline mode"
-    user = User.objects.get(chat_id=update.effective_user.id)
-
-    objects = user.keywords.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
+    user = utils.resolve_user(update)
+    term = typed_term(update, text.buttons.menu.unpin_neg_key[:-2])
 
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = utils.search(user.keywords.with_negative_keys(), 'key', user.id, term)
+        keywords, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=keyword.key,
                 description=keyword.nkeys_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.unpin_neg_key.select_key.format(keyword.id))
             ) for keyword in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'get_key_list_for_unpinning_negative_key', build)
 
 
 def get_negative_key_list_button_for_unpinning_key(bot, update):
     "Shows message with the button to switch to inline query for negative key selection"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     key = re.match(text.re.unpin_neg_key, update.message.text).group(1)
 
@@ -661,39 +675,35 @@ def get_negative_key_list_button_for_unpinning_key(bot, update):
 
 def get_negative_keys_for_unpinning_negative_key(bot, update):
     "Shows a list of negative keywords in inline mode"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
-    key_id = re.match(text.re.unpin_neg_key_choose_key, update.inline_query.query).group(1)
-    key = Keyword.objects.get(id=key_id)
-
-    objects = key.negativekeyword.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
+    match = re.match(text.re.unpin_neg_key_choose_key, update.inline_query.query)
+    key_id = match.group(1)
+    term = update.inline_query.query[match.end():].strip()
 
-    update.inline_query.answer(
-        results=[
+    def build():
+        key = Keyword.objects.get(id=key_id)
+        objects = utils.search(key.negativekeyword.all(), 'key', user.id, term)
+        keywords, next_offset = paginate(objects, update)
+        return ([
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title='Все ключи',
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.unpin_neg_key.unpin.format(key=key_id, nkey=text.actions.unpin_key.all_keys)))
-        ] + [
+        ] if not term else []) + [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=kw.key,
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.unpin_neg_key.unpin.format(key=key_id, nkey=kw.key))
             ) for kw in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'get_negative_keys_for_unpinning_negative_key', build)
 
 
 def unpin_negative_key_from_key(bot, update):
     "Just unpin negative key from key"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     match = re.match(text.re.unpin_neg_key_from_key, update.message.text)
     key_id = match.group(1)
@@ -720,32 +730,27 @@ def unpin_negative_key_from_key(bot, update):
 
 def negative_key_deletion_choose_keyword(bot, update):
     "Shows the list of negative keywords in inline mode"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
+    term = typed_term(update, text.buttons.menu.delete_neg_key[:-2])
 
-    objects = user.negativekeyword.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
-
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = utils.search(user.negativekeyword.with_keys(), 'key', user.id, term)
+        keywords, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=kw.key,
                 description=kw.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.negative_key_deletion.delete.format(key=kw.key))
             ) for kw in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'negative_key_deletion_choose_keyword', build)
 
 
 def delete_neg_key(bot, update):
     "Hey, you! Delete a negative key for me!"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     key = re.match(text.re.delete_neg_key, update.message.text).group(1)
     try:
@@ -771,7 +776,7 @@ def ask_keywords_group_name(bot, update):
 
 def create_new_group(bot, update):
     "Process given name of the group and create it"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     group = KeywordsGroup.objects.create(name=update.message.text, user=user)
 
@@ -781,32 +786,27 @@ def create_new_group(bot, update):
 # Add key to group
 def show_groups_list_for_adding_to_group(bot, update):
     "Show's group list"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
+    term = typed_term(update, text.buttons.menu.add_key_to_group)
 
-    objects = user.groups.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    groups = paginator.page(int(offset))
-    next_offset = str(groups.next_page_number()) if groups.has_next() else ''
-
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = utils.search(user.groups.with_keys(), 'name', user.id, term)
+        groups, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=group.name + group.prepare_state(),
                 description=group.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.add_key_to_group.choose_group.format(group.id))
             ) for group in groups
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'show_groups_list_for_adding_to_group', build)
 
 
 def get_button_to_show_keywords_for_groups(bot, update):
     "Shows a message with button to switch inline query for picking a keyword for the group"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
     group_id = re.match(text.re.choose_group, update.message.text).group(1)
 
     update.message.delete()
@@ -817,35 +817,31 @@ def get_button_to_show_keywords_for_groups(bot, update):
 
 
 def show_keys_for_adding_to_group(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
-    group_id = re.match(text.re.choose_key_to_group, update.inline_query.query).group(1)
-    group = KeywordsGroup.objects.get(id=group_id)
+    match = re.match(text.re.choose_key_to_group, update.inline_query.query)
+    group_id = match.group(1)
+    term = update.inline_query.query[match.end():].strip()
 
     # keyword_in_group = user.keywords.filter(groups__in=[group])
-    objects = user.keywords.exclude(groups__in=[group])
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
-
-    update.inline_query.answer(
-        results=[
+    def build():
+        group = KeywordsGroup.objects.get(id=group_id)
+        objects = utils.search(user.keywords.exclude(groups__in=[group]).with_chats(), 'key', user.id, term)
+        keywords, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=keyword.key,
                 description=keyword.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.add_key_to_group.add_key_to_group.format(group_id=group.id, key=keyword.key))
             ) for keyword in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'show_keys_for_adding_to_group', build)
 
 
 def add_key_to_group(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     match = re.match(text.re.add_key_to_group, update.message.text)
     group_id = match.group(1)
@@ -862,32 +858,27 @@ def add_key_to_group(bot, update):
 # Delete key from group
 def show_groups_for_del_key_from_group(bot, update):
     "Show's groups list"
-    user = User.objects.get(chat_id=update.effective_user.id)
-
-    objects = user.groups.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    groups = paginator.page(int(offset))
-    next_offset = str(groups.next_page_number()) if groups.has_next() else ''
+    user = utils.resolve_user(update)
+    term = typed_term(update, text.buttons.menu.del_key_from_group)
 
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = utils.search(user.groups.with_keys(), 'name', user.id, term)
+        groups, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=group.name + group.prepare_state(),
                 description=group.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.del_key_from_group.choose_group.format(group.id))
             ) for group in groups
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'show_groups_for_del_key_from_group', build)
 
 
 def get_button_to_show_keys_for_deletion_from_group(bot, update):
     "Shows a message with button to switch inline query for picking a keyword for deletion from group"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
     group_id = re.match(text.re.choose_group_for_key_deletion, update.message.text).group(1)
 
     update.message.delete()
@@ -899,34 +890,30 @@ def get_button_to_show_keys_for_deletion_from_group(bot, update):
 
 def show_keys_for_deleting_from_group(bot, update):
     "Show keys from group for deletion"
-    user = User.objects.get(chat_id=update.effective_user.id)
-
-    group_id = re.match(text.re.choose_key_for_key_from_group_deletion, update.inline_query.query).group(1)
-    group = KeywordsGroup.objects.get(id=group_id)
+    user = utils.resolve_user(update)
 
-    objects = user.keywords.filter(groups__in=[group])
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    keywords = paginator.page(int(offset))
-    next_offset = str(keywords.next_page_number()) if keywords.has_next() else ''
+    match = re.match(text.re.choose_key_for_key_from_group_deletion, update.inline_query.query)
+    group_id = match.group(1)
+    term = update.inline_query.query[match.end():].strip()
 
-    update.inline_query.answer(
-        results=[
+    def build():
+        group = KeywordsGroup.objects.get(id=group_id)
+        objects = utils.search(user.keywords.filter(groups__in=[group]).with_chats(), 'key', user.id, term)
+        keywords, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=keyword.key,
                 description=keyword.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.del_key_from_group.del_key_from_group.format(group_id=group.id, key=keyword.key))
             ) for keyword in keywords
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'show_keys_for_deleting_from_group', build)
 
 
 def delete_key_from_group(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     match = re.match(text.re.del_key_from_group, update.message.text)
     group_id = match.group(1)
@@ -943,30 +930,25 @@ def delete_key_from_group(bot, update):
 
 # Switch groups on and off
 def show_groups_for_switching(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
-
-    objects = user.groups.all()
-    offset = 1 if not update.inline_query.offset else update.inline_query.offset
-    paginator = Paginator(objects, 40)
-    groups = paginator.page(int(offset))
-    next_offset = str(groups.next_page_number()) if groups.has_next() else ''
+    user = utils.resolve_user(update)
+    term = typed_term(update, text.buttons.menu.switch_groups)
 
-    update.inline_query.answer(
-        results=[
+    def build():
+        objects = utils.search(user.groups.with_keys(), 'name', user.id, term)
+        groups, next_offset = paginate(objects, update)
+        return [
             telegram.InlineQueryResultArticle(
                 id=uuid.uuid4(),
                 title=group.name + group.prepare_state(),
                 description=group.prepare_description(),
                 input_message_content=telegram.InputTextMessageContent(message_text=text.actions.group_switch.switch.format(group_id=group.id))
             ) for group in groups
-        ],
-        cache_time=3,
-        is_personal=True,
-        next_offset=next_offset,
-    )
+        ], next_offset
+
+    answer_listing(update, user, 'show_groups_for_switching', build)
 
 def switch_group(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     group_id = re.match(text.re.switch_group, update.message.text).group(1)
     group = KeywordsGroup.objects.get_or_none(id=group_id)
@@ -989,31 +971,63 @@ def switch_group(bot, update):
 
 # Monitoring chat's activity
 
+CHATS_PAGE_SIZE = 90
+
+
+def chats_keyboard(user, page):
+    """Keyboard to switch monitoring of the user's chats, a page at a time.
+    Returns None if there are no chats on the page"""
+    start = (page - 1) * CHATS_PAGE_SIZE
+    relations = list(Relation.objects.filter(user=user).select_related('chat').order_by('chat_id')[start:start + CHATS_PAGE_SIZE + 1])
+    if not relations:
+        return None
+
+    keyboard = [
+        [telegram.InlineKeyboardButton(text=relation.represent(), callback_data=text.buttons.chats.switch.format(chat=relation.chat_id, page=page))] for relation in relations[:CHATS_PAGE_SIZE]
+    ]
+    navigation = []
+    if page > 1:
+        navigation.append(telegram.InlineKeyboardButton(text=text.buttons.chats.previous, callback_data=text.buttons.chats.page.format(page - 1)))
+    if len(relations) > CHATS_PAGE_SIZE:
+        navigation.append(telegram.InlineKeyboardButton(text=text.buttons.chats.next, callback_data=text.buttons.chats.page.format(page + 1)))
+    if navigation:
+        keyboard.append(navigation)
+    return telegram.InlineKeyboardMarkup(keyboard)
+
+
 def show_all_chats(bot, update):
     "Show all possible common chats for user in a message using InlineKeyboard"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
+    keyboard = chats_keyboard(user, 1)
     # Check whether a user has common chats
-    if user.chats.count() == 0:
+    if not keyboard:
         bot.sendMessage(user.chat_id, text=text.actions.chats.no_chats)
         return
 
-    keyboard = telegram.InlineKeyboardMarkup([
-        [telegram.InlineKeyboardButton(text=chat.represent(user), callback_data=text.buttons.chats.switch.format(chat=chat.id))] for chat in user.chats.all()[:99]
-    ])
     bot.sendMessage(user.chat_id, text=text.actions.chats.show_all, reply_markup=keyboard)
 
 
+def switch_chats_page(bot, update):
+    "Show another page of the chats keyboard"
+    user = utils.resolve_user(update)
+
+    page = int(re.match(text.re.chats_page, update.callback_query.data).group(1))
+    update.callback_query.answer()
+    update.callback_query.edit_message_reply_markup(reply_markup=chats_keyboard(user, page))
+
+
 def switch_chat(bot, update):
     "Switch chat activity"
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
-    chat_id = re.match(text.re.switch, update.callback_query.data).group(1)
-    chat = Chat.objects.get(id=chat_id)
+    match = re.match(text.re.switch, update.callback_query.data)
+    chat_id = match.group(1)
+    page = int(match.group(2) or 1)
 
-    if chat in user.chats.all():
-        if chat.bot_in_chat:
-            relation = chat.relation_set.filter(user=user)[0]
+    relation = Relation.objects.filter(user=user, chat_id=chat_id).select_related('chat').first()
+    if relation:
+        if relation.chat.bot_in_chat:
             relation.active = not relation.active
             relation.save()
 
@@ -1022,10 +1036,7 @@ def switch_chat(bot, update):
             else:
                 update.callback_query.answer(text=text.actions.chats.switch_success + ' ' + text.actions.chats.switch_active)
 
-            keyboard = telegram.InlineKeyboardMarkup([
-                [telegram.InlineKeyboardButton(text=chat.represent(user), callback_data=text.buttons.chats.switch.format(chat=chat.id))] for chat in user.chats.all()
-            ])
-            update.callback_query.edit_message_reply_markup(reply_markup=keyboard)
+            update.callback_query.edit_message_reply_markup(reply_markup=chats_keyboard(user, page))
 
         else:
             update.callback_query.answer(text=text.actions.chats.switch_fail, show_alert=True)
@@ -1034,12 +1045,13 @@ def switch_chat(bot, update):
 
 # Settings
 def show_settings(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     settings_keyboard = telegram.InlineKeyboardMarkup([
         [telegram.InlineKeyboardButton(text=text.buttons.settings.debug_mode + ' ' + user.prepare_debug_state(), callback_data=text.buttons.settings.debug_mode)],
         [telegram.InlineKeyboardButton(text=text.buttons.settings.settings_up, callback_data=text.buttons.settings.settings_up)],
         [telegram.InlineKeyboardButton(text=text.buttons.settings.settings_down, callback_data=text.buttons.settings.settings_down)],
+        [telegram.InlineKeyboardButton(text=text.buttons.settings.settings_sync_up, callback_data=text.buttons.settings.settings_sync_up)],
         [telegram.InlineKeyboardButton(text=text.buttons.settings.delete_all_keywords, callback_data=text.buttons.settings.delete_all_keywords)],
     ])
 
@@ -1047,7 +1059,7 @@ def show_settings(bot, update):
 
 
 def switch_debug_mode(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     if user.debug:
         user.debug = False
@@ -1064,7 +1076,7 @@ def switch_debug_mode(bot, update):
 
 
 def upload_settings_to_user(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     data = utils.gen_users_dataprint(user)
     filename = str(uuid.uuid4()) + '.xml'
@@ -1074,28 +1086,52 @@ def upload_settings_to_user(bot, update):
     bot.sendDocument(user.chat_id, document=open(filename, 'rb'), caption=text.actions.settings.settings_up_text, timeout=60)
 
 
+def upload_sync_settings_to_user(bot, update):
+    user = utils.resolve_user(update)
+
+    data = utils.gen_users_syncprint(user)
+    document = io.BytesIO(data.encode("utf-8"))
+
+    bot.sendDocument(user.chat_id, document=document, filename=str(uuid.uuid4()) + '.json', caption=text.actions.settings.settings_sync_up_text, timeout=60)
+
+
 def ask_file_to_download_settings(bot, update):
     bot.sendMessage(update.effective_user.id, text.actions.settings.settings_down_request)
     return PROCESS_SETTINGS_FILE
 
 
 def process_settings_down_saving(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
 
     file = update.message.document.get_file()
     data_stream = io.BytesIO()
     file.download(out=data_stream)
     data = data_stream.getvalue().decode("utf-8")
 
-    repl_state = utils.replicate_users_dataprint(user, data)
-    if repl_state:
-        bot.sendMessage(user.chat_id, text.actions.settings.settings_down_text_success)
+    if utils.is_syncprint(data):
+        report = utils.sync_users_dataprint(user, data)
+        if report:
+            counters = {'{}_{}'.format(state, model): getattr(report, state)[model]
+                        for state in ('added', 'updated', 'removed') for model in ('keywords', 'negative_keywords', 'groups')}
+            bot.sendMessage(user.chat_id, text.actions.settings.settings_sync_report.format(**counters))
+        else:
+            bot.sendMessage(user.chat_id, "Ooops... Something gone wrong")
+        return -1
+
+    report = utils.replicate_users_dataprint(user, data)
+    if report:
+        counters = {'{}_{}'.format(state, model): getattr(report, state)[model]
+                    for state in ('created', 'skipped') for model in ('keywords', 'negative_keywords', 'groups')}
+        message = text.actions.settings.settings_down_text_success + '\n\n' + text.actions.settings.settings_down_report.format(**counters)
+        if report.skipped_groups:
+            message += '\n' + text.actions.settings.settings_down_skipped_groups.format(groups=', '.join(report.skipped_groups))
+        bot.sendMessage(user.chat_id, message)
     else:
         bot.sendMessage(user.chat_id, "Ooops... Something gone wrong")
     return -1
 
 def delete_all_keys_confirm(bot, update):
-    # user = User.objects.get(chat_id=update.effective_user.id)
+    # user = utils.resolve_user(update)
     keyboard = telegram.InlineKeyboardMarkup([
         [telegram.InlineKeyboardButton(text=text.buttons.settings.delete_yes, callback_data=text.buttons.settings.delete_yes_cb)],
         [telegram.InlineKeyboardButton(text=text.buttons.settings.delete_no, callback_data=text.buttons.settings.delete_no_cb)],
@@ -1105,11 +1141,13 @@ def delete_all_keys_confirm(bot, update):
 
 
 def delete_all_keys(bot, update):
-    user = User.objects.get(chat_id=update.effective_user.id)
+    user = utils.resolve_user(update)
     update.callback_query.answer('Deleting...')
-    user.delete_all_keywords()
-    # update.callback_query.message.edit_reply_markup(none)
-    update.callback_query.message.edit_text(text.actions.settings.deleted, reply_markup=None)
+    message = update.callback_query.message
+    message.edit_text(text.actions.settings.deleting, reply_markup=None)
+    # Large accounts take a while, the task reports progress in this message
+    tasks.delete_all_keywords.delay(user.id, message.message_id,
+                                    text.actions.settings.deleting_progress, text.actions.settings.deleted)
 
 def delete_not_keywords(bot, update):
     update.callback_query.answer('Canceled')
@@ -1121,19 +1159,12 @@ def delete_not_keywords(bot, update):
 
 def handle_group_message(bot, update):
     "Handle group messages"
-    if update.message.text:
-        tasks.check_message_for_keywords.delay(
-        update.message.chat.id,
-        update.message.message_id,
-        update.message.text,
-        str(update.message.from_user.id),
-        int(update.message.date.timestamp()),
-        )
-    elif update.message.caption:
-        tasks.check_message_for_keywords.delay(
+    message_text = update.message.text or update.message.caption
+    if message_text:
+        tasks.queue_message(
         update.message.chat.id,
         update.message.message_id,
-        update.message.caption,
+        message_text,
         str(update.message.from_user.id),
         int(update.message.date.timestamp()),
         )
@@ -1285,6 +1316,8 @@ def main():
 
     dp.add_handler(CallbackQueryHandler(callback=switch_chat, pattern=text.re.switch))
 
+    dp.add_handler(CallbackQueryHandler(callback=switch_chats_page, pattern=text.re.chats_page))
+
     # Settings
     dp.add_handler(CallbackQueryHandler(callback=show_settings, pattern=text.buttons.menu.settings))
 
@@ -1292,6 +1325,8 @@ def main():
 
     dp.add_handler(CallbackQueryHandler(callback=upload_settings_to_user, pattern=text.buttons.settings.settings_up))
 
+    dp.add_handler(CallbackQueryHandler(callback=upload_sync_settings_to_user, pattern=text.buttons.settings.settings_sync_up))
+
     dp.add_handler(ConversationHandler(
         allow_reentry=True,
         entry_points=[
@@ -1,3 +1,1374 @@
-from django.test import TestCase
+import fnmatch
+import io
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+from random import Random
+from unittest import mock
 
-# Create your tests here.
+import redis
+from django.core.cache import cache
+from django.core.cache.backends import filebased
+from django.core.management import CommandError, call_command
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+
+from . import digests, matching, metrics, normalization, profiling, rules, snapshots, stemming, subscriptions, tasks, telegrambot, tracing, utils
+from .automaton import Automaton
+from .cache import SweptFileBasedCache, TwoTierCache
+from .models import Chat, ChatSubscription, Keyword, KeywordsGroup, NegativeKeyword, Relation, User
+from .normalization import normalize
+
+
+def index_of(*keys):
+    "Index of keys of one owner, keyword ids are positions of the keys"
+    return matching.ChatIndex.from_rows(
+        (i, key, 1, '[]', rules.mode_of(key)) for i, key in enumerate(keys)
+    )
+
+
+class RegexTests(SimpleTestCase):
+    def test_compiles_regex_with_required_literal(self):
+        for source in ('кот(ик|ята)', '(кот)\\d+', 'тел \\d{3}-\\d{2}', 'кот.*пёс', 'кот(ab){2,5}'):
+            with self.subTest(source=source):
+                self.assertIsNotNone(rules.compile_regex(source))
+                self.assertEqual(rules.mode_of('/{}/'.format(source)), Keyword.REGEX)
+
+    def test_rejects_regex_without_required_literal(self):
+        # It would have to run on every message of the chat
+        for source in ('\\d{3}-\\d{2}', '.*', '[а-я]+', 'a{2}', 'кот|пёс'):
+            with self.subTest(source=source):
+                self.assertIsNone(rules.compile_regex(source))
+                self.assertEqual(rules.mode_of('/{}/'.format(source)), Keyword.SUBSTRING)
+
+    def test_rejects_nested_repeats(self):
+        # Backtracking over these takes exponential time
+        for source in ('(а+)+$', 'кот(x*)*', 'кот(a|aa)+', 'кот(?:a{1,3}){1,100}', 'кот((ab)+c)*'):
+            with self.subTest(source=source):
+                self.assertIsNone(rules.compile_regex(source))
+
+    def test_rejects_long_and_invalid_regex(self):
+        self.assertIsNone(rules.compile_regex('кот' * rules.REGEX_MAX_LENGTH))
+        self.assertIsNone(rules.compile_regex('кот('))
+        self.assertIsNone(rules.compile_regex(''))
+
+    def test_required_literal(self):
+        self.assertEqual(rules.required_literal('Кот(ик|ята)'), 'кот')
+        self.assertEqual(rules.required_literal('(?:ко)(?:т)\\d'), 'кот')
+        self.assertEqual(rules.required_literal('а\\d+пёс'), 'пес')
+        self.assertIsNone(rules.required_literal('\\d+'))
+
+    def test_stored_dangerous_regex_never_runs(self):
+        # Keys saved in the regex mode before the checks existed
+        index = matching.ChatIndex.from_rows([
+            (1, '/(а+)+$/', 1, '[]', Keyword.REGEX),
+            (2, '/кот(ик|ята)/', 1, '[]', Keyword.REGEX),
+        ])
+        self.assertEqual([s.keyword_id for s in index.match('а' * 40 + '!')], [])
+        self.assertEqual([s.keyword_id for s in index.match('котята и ' + 'а' * 40 + '!')], [2])
+
+    def test_regex_runs_only_on_messages_with_its_literal(self):
+        index = index_of('/тел \\d{3}-\\d{2}/')
+        self.assertEqual(len(index.match('тел 123-45')), 1)
+        self.assertEqual(len(index.match('123-45')), 0)
+        self.assertEqual(len(index.match('тел 12-345')), 0)
+
+
+class RulesTests(SimpleTestCase):
+    def test_mode_of(self):
+        self.assertEqual(rules.mode_of('кот'), Keyword.SUBSTRING)
+        self.assertEqual(rules.mode_of('=кот'), Keyword.WORD)
+        self.assertEqual(rules.mode_of('кот*'), Keyword.PREFIX)
+        self.assertEqual(rules.mode_of('~чёрная кошка'), Keyword.LEMMA)
+        self.assertEqual(rules.mode_of('/кот(ик|ята)/'), Keyword.REGEX)
+        self.assertEqual(rules.mode_of('кот AND NOT пёс'), Keyword.BOOLEAN)
+
+    def test_mode_of_falls_back_to_substring(self):
+        for key in ('=', '*', '~', 'к*т*', '//', '/кот(/', 'кот AND', '(кот AND пёс', 'NOT кот', 'кот OR NOT пёс'):
+            with self.subTest(key=key):
+                self.assertEqual(rules.mode_of(key), Keyword.SUBSTRING)
+
+    def test_parse(self):
+        self.assertEqual(rules.parse('кот AND NOT (собака OR "Морская свинка")'), (rules.AND, [
+            (rules.LITERAL, (rules.SUBSTRING, 'кот')),
+            (rules.NOT, (rules.OR, [
+                (rules.LITERAL, (rules.SUBSTRING, 'собака')),
+                (rules.LITERAL, (rules.SUBSTRING, 'морская свинка')),
+            ])),
+        ]))
+        self.assertEqual(rules.parse('=кот OR кот* OR ~кошки'), (rules.OR, [
+            (rules.LITERAL, (rules.WORD, 'кот')),
+            (rules.LITERAL, (rules.PREFIX, 'кот')),
+            (rules.LITERAL, (rules.LEMMA, 'кошк')),
+        ]))
+        # Adjacent words make a phrase
+        self.assertEqual(rules.parse('продам iphone AND =12'), (rules.AND, [
+            (rules.LITERAL, (rules.SUBSTRING, 'продам iphone')),
+            (rules.LITERAL, (rules.WORD, '12')),
+        ]))
+
+    def test_parse_rejects(self):
+        # Unbalanced, dangling operators, and expressions true without any literal
+        for expression in ('(кот', 'кот)', 'кот AND', 'OR кот', 'NOT кот', 'кот OR NOT пёс', '()'):
+            with self.subTest(expression=expression):
+                self.assertIsNone(rules.parse(expression))
+
+    def test_evaluate(self):
+        tree = rules.parse('кот AND NOT (собака OR пёс)')
+        cat, dog = (rules.SUBSTRING, 'кот'), (rules.SUBSTRING, 'собака')
+        self.assertTrue(rules.evaluate(tree, {cat}))
+        self.assertFalse(rules.evaluate(tree, {cat, dog}))
+        self.assertFalse(rules.evaluate(tree, {dog}))
+
+    def test_occurs(self):
+        self.assertTrue(rules.occurs('котлета', 'кот', rules.SUBSTRING))
+        self.assertFalse(rules.occurs('котлета', 'кот', rules.WORD))
+        self.assertTrue(rules.occurs('котлета и кот.', 'кот', rules.WORD))
+        self.assertTrue(rules.occurs('котлета', 'кот', rules.PREFIX))
+        self.assertFalse(rules.occurs('скотина', 'кот', rules.PREFIX))
+        self.assertFalse(rules.occurs('скотина', 'кот', rules.WORD))
+        self.assertTrue(rules.occurs('скот, кот', 'кот', rules.WORD))
+        self.assertFalse(rules.occurs('кот_1', 'кот', rules.WORD))
+
+    def test_index_matches_every_mode(self):
+        index = index_of('кот', '=кот', 'кот*', '~кошка', '/кот(ик|ята)/', 'кот AND NOT собака')
+        matched = lambda text: [s.key for s in index.match(text)]
+        self.assertEqual(matched('котлета'), ['кот', 'кот*', 'кот AND NOT собака'])
+        self.assertEqual(matched('КОТ и собака'), ['кот', '=кот', 'кот*'])
+        self.assertEqual(matched('котята'), ['кот', 'кот*', '/кот(ик|ята)/', 'кот AND NOT собака'])
+        self.assertEqual(matched('пропала кошкой'), ['~кошка'])
+        self.assertEqual(matched('скотина'), ['кот', 'кот AND NOT собака'])
+
+    def test_index_skips_negative_keys(self):
+        index = matching.ChatIndex.from_rows([(1, 'яблоко', 1, '["Гнил"]', Keyword.SUBSTRING)])
+        self.assertEqual(len(index.match('Яблоко')), 1)
+        self.assertEqual(len(index.match('ГНИЛОЕ яблоко')), 0)
+
+
+class AutomatonTests(SimpleTestCase):
+    def test_finds_what_a_naive_scan_finds(self):
+        random = Random(1)
+        alphabet = 'абвгдкот '
+        patterns = list({''.join(random.choice(alphabet[:-1]) for _ in range(random.randint(1, 6))) for _ in range(500)})
+        automaton = Automaton.build(patterns)
+        for _ in range(200):
+            text = ''.join(random.choice(alphabet) for _ in range(random.randint(0, 80)))
+            self.assertEqual(automaton.search(text), {j for j, pattern in enumerate(patterns) if pattern in text})
+
+    def test_overlapping_patterns(self):
+        patterns = ['he', 'she', 'his', 'hers', 'е', 'её']
+        self.assertEqual(Automaton.build(patterns).search('ushers её'), {0, 1, 3, 4, 5})
+        self.assertEqual(Automaton.build(patterns).search(''), set())
+
+    def test_index_scans_with_automaton_as_without(self):
+        keys = ['k{}x'.format(i) for i in range(matching.AUTOMATON_MIN_PATTERNS * 2)]
+        index = index_of(*keys)
+        # Short texts go through the automaton, long ones are scanned pattern by pattern
+        self.assertEqual([s.key for s in index.match('k1x k20x')], ['k1x', 'k20x'])
+        self.assertIsNotNone(index._automaton)
+        self.assertEqual([s.key for s in index.match('k1x k20x' + ' ' * len(keys))], ['k1x', 'k20x'])
+
+
+class StemmingTests(SimpleTestCase):
+    def test_forms_share_a_stem(self):
+        for words in (
+            ('кошка', 'кошки', 'кошкой', 'кошку'),
+            ('чёрная', 'черной', 'черную'),
+            ('квартира', 'квартиры', 'квартиру'),
+            # Ukrainian
+            ('хата', 'хати', 'хатою'),
+            ('книжки', 'книжкою'),
+        ):
+            with self.subTest(words=words):
+                self.assertEqual(len({stemming.stem(word) for word in words}), 1)
+
+    def test_stem(self):
+        self.assertEqual(stemming.stem('кошкой'), 'кошк')
+        self.assertEqual(stemming.stem('однокомнатную'), 'однокомнатн')
+        self.assertEqual(stemming.stem('кот'), 'кот')
+        self.assertNotEqual(stemming.stem('котлета'), stemming.stem('кот'))
+
+    def test_stems(self):
+        self.assertEqual(stemming.stems('черной кошкой, 2 раза!'), ['черн', 'кошк', '2', 'раз'])
+
+
+class NormalizationTests(SimpleTestCase):
+    def test_normalize(self):
+        self.assertEqual(normalize('ПРОДАМ Ёлку'), 'продам елку')
+        self.assertEqual(normalize('Straße'), normalize('STRASSE'))
+        self.assertEqual(normalize('ﬁat'), normalize('fiat'))
+        self.assertEqual(normalize('iPhone'), 'iphone')
+        # Latin letters stay Latin by default
+        self.assertEqual(normalize('прoдам'), 'прoдам')
+
+    @override_settings(MATCH_FOLD_HOMOGLYPHS=True)
+    def test_fold_homoglyphs(self):
+        self.assertEqual(normalize('прoдам'), normalize('продам'))
+        self.assertEqual(normalize('iPhone'), normalize('IPHONE'))
+        self.assertEqual(normalization.flags(), normalization.FOLD_YO | normalization.FOLD_HOMOGLYPHS)
+
+    def test_latin_keys_dont_match_cyrillic_text(self):
+        self.assertEqual(index_of('cop').match('сор на полу'), [])
+        self.assertEqual(index_of('сор').match('cop car'), [])
+        with override_settings(MATCH_FOLD_HOMOGLYPHS=True):
+            self.assertEqual(len(index_of('cop').match('сор на полу')), 1)
+
+    @override_settings(MATCH_FOLD_YO=False)
+    def test_folds_can_be_switched_off(self):
+        self.assertEqual(normalize('Ёлка'), 'ёлка')
+        self.assertEqual(normalization.flags(), 0)
+
+    def test_flags(self):
+        self.assertEqual(normalization.flags(), normalization.FOLD_YO)
+
+
+class AccountTestCase(TestCase):
+    "Source account with keys, a negative key and a group, and an empty target account"
+
+    def setUp(self):
+        self.source = User.objects.create(chat_id=1, name='source')
+        self.target = User.objects.create(chat_id=2, name='target')
+        self.chat = Chat.objects.create(chat_id=-1, chat_type=Chat.GROUP_CHAT, title='chat')
+        keywords = [Keyword.objects.create(user=self.source, key=key) for key in ('кот', '=пёс', 'рыба')]
+        keywords[0].chats.add(self.chat)
+        keywords[2].state = False
+        keywords[2].save()
+        NegativeKeyword.objects.create(user=self.source, key='собака').keywords.add(*keywords[:2])
+        KeywordsGroup.objects.create(user=self.source, name='звери', state=False).keys.add(*keywords[:2])
+
+
+class ImportTests(AccountTestCase):
+    def test_replicate(self):
+        Keyword.objects.create(user=self.target, key='кот')
+        report = utils.replicate_users_dataprint(self.target, utils.gen_users_dataprint(self.source))
+        self.assertEqual(report.created, {'keywords': 2, 'negative_keywords': 1, 'groups': 1})
+        self.assertEqual(report.skipped['keywords'], 1)
+        self.assertEqual(dict(self.target.keywords.values_list('key', 'mode')),
+                         {'кот': Keyword.SUBSTRING, '=пёс': Keyword.WORD, 'рыба': Keyword.SUBSTRING})
+        self.assertFalse(self.target.keywords.get(key='рыба').state)
+        self.assertEqual(set(self.target.negativekeyword.get().keywords.values_list('key', flat=True)), {'кот', '=пёс'})
+        group = self.target.groups.get()
+        self.assertEqual((group.name, group.state), ('звери', False))
+        self.assertEqual(set(group.keys.values_list('key', flat=True)), {'кот', '=пёс'})
+
+    def test_replicate_pins_new_keywords_only(self):
+        utils.replicate_users_dataprint(self.target, utils.gen_users_dataprint(self.source))
+        self.assertEqual(list(self.target.keywords.get(key='кот').chats.all()), [self.chat])
+        self.assertFalse(self.target.keywords.get(key='рыба').chats.exists())
+
+    def test_replicate_is_idempotent(self):
+        data = utils.gen_users_dataprint(self.source)
+        utils.replicate_users_dataprint(self.target, data)
+        report = utils.replicate_users_dataprint(self.target, data)
+        self.assertEqual(sum(report.created.values()), 0)
+        self.assertEqual(report.skipped, {'keywords': 3, 'negative_keywords': 1, 'groups': 1})
+        self.assertEqual(self.target.keywords.count(), 3)
+        self.assertEqual(self.target.groups.count(), 1)
+
+    def test_replicate_keeps_groups_of_the_same_name(self):
+        group = KeywordsGroup.objects.create(user=self.target, name='звери', state=True)
+        report = utils.replicate_users_dataprint(self.target, utils.gen_users_dataprint(self.source))
+        self.assertEqual(report.skipped_groups, ['звери'])
+        self.assertEqual(list(self.target.groups.all()), [group])
+        self.assertTrue(self.target.groups.get().state)
+        self.assertFalse(group.keys.exists())
+
+    def test_report_names_skipped_groups(self):
+        KeywordsGroup.objects.create(user=self.target, name='звери')
+        data = utils.gen_users_dataprint(self.source).encode()
+        update = mock.Mock(bot_user=self.target)
+        update.message.document.get_file.return_value.download.side_effect = lambda out: out.write(data)
+        bot = mock.Mock()
+        telegrambot.process_settings_down_saving(bot, update)
+        message = bot.sendMessage.call_args[0][1]
+        self.assertIn('групп: 0', message)
+        self.assertIn(telegrambot.text.actions.settings.settings_down_skipped_groups.format(groups='звери'), message)
+
+    def test_replicate_rejects_broken_files(self):
+        entities = '<?xml version="1.0"?><!DOCTYPE x [<!ENTITY a "b">]><django-objects version="1.0">&a;</django-objects>'
+        with self.assertLogs('bot.utils', 'ERROR'):
+            self.assertIsNone(utils.replicate_users_dataprint(self.target, 'garbage'))
+            self.assertIsNone(utils.replicate_users_dataprint(self.target, entities))
+        self.assertFalse(self.target.keywords.exists())
+
+
+class SyncTests(AccountTestCase):
+    def state(self, user):
+        "What syncprints compare, without ids"
+        return {model: set(objects) for model, objects in utils._users_sync_state(user).items()}
+
+    def test_sync_round_trip(self):
+        report = utils.sync_users_dataprint(self.target, utils.gen_users_syncprint(self.source))
+        self.assertEqual(report.added, {'keywords': 3, 'negative_keywords': 1, 'groups': 1})
+        self.assertEqual(self.state(self.target), self.state(self.source))
+        self.assertEqual(self.target.keywords.get(key='=пёс').mode, Keyword.WORD)
+
+    def test_sync_is_idempotent(self):
+        data = utils.gen_users_syncprint(self.source)
+        utils.sync_users_dataprint(self.target, data)
+        report = utils.sync_users_dataprint(self.target, data)
+        self.assertEqual(sum(report.added.values()) + sum(report.updated.values()) + sum(report.removed.values()), 0)
+        self.assertEqual(self.state(self.target), self.state(self.source))
+
+    def test_sync_updates_in_place_and_removes(self):
+        cat = Keyword.objects.create(user=self.target, key='кот', state=False)
+        cat.chats.add(self.chat)
+        Keyword.objects.create(user=self.target, key='лишний')
+        report = utils.sync_users_dataprint(self.target, utils.gen_users_syncprint(self.source))
+        self.assertEqual(report.updated['keywords'], 1)
+        self.assertEqual(report.removed['keywords'], 1)
+        self.assertEqual(self.state(self.target), self.state(self.source))
+        # Updated keywords keep their pins
+        cat.refresh_from_db()
+        self.assertTrue(cat.state)
+        self.assertEqual(list(cat.chats.all()), [self.chat])
+
+    def test_sync_rejects_other_files(self):
+        with self.assertLogs('bot.utils', 'ERROR'):
+            self.assertIsNone(utils.sync_users_dataprint(self.target, '{"format": "other"}'))
+            self.assertIsNone(utils.sync_users_dataprint(self.target, utils.gen_users_dataprint(self.source)))
+
+
+class InlineListingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(chat_id=1, name='user')
+
+    def answer(self, build, query='', offset=''):
+        update = mock.Mock()
+        update.inline_query.query, update.inline_query.offset = query, offset
+        telegrambot.answer_listing(update, self.user, 'listing', build)
+        return update.inline_query.answer.call_args[1]
+
+    def test_pages_are_cached(self):
+        build = mock.Mock(return_value=(['result'], '2'))
+        self.assertEqual(self.answer(build)['results'], ['result'])
+        self.assertEqual(self.answer(build)['next_offset'], '2')
+        self.assertEqual(build.call_count, 1)
+        # Other queries and offsets are other pages
+        self.answer(build, query='кот')
+        self.answer(build, offset='2')
+        self.assertEqual(build.call_count, 3)
+
+    def test_pages_are_invalidated_by_data_version(self):
+        build = mock.Mock(side_effect=[(['old'], ''), (['new'], ''), (['newer'], '')])
+        self.answer(build)
+        utils.bump_user_data_version(self.user.id)
+        self.assertEqual(self.answer(build)['results'], ['new'])
+        # Signals bump the version when the user's keys change
+        Keyword.objects.create(user=self.user, key='кот')
+        self.assertEqual(self.answer(build)['results'], ['newer'])
+
+    def test_pages_are_per_user(self):
+        build = mock.Mock(return_value=([], ''))
+        self.answer(build)
+        self.user = User.objects.create(chat_id=2, name='other')
+        self.answer(build)
+        self.assertEqual(build.call_count, 2)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(chat_id=1, name='user')
+        self.other = User.objects.create(chat_id=2, name='other')
+        for key in ('Продам КОТА', 'котлеты', 'Cat food', 'собака'):
+            Keyword.objects.create(user=self.user, key=key)
+        Keyword.objects.create(user=self.other, key='кот')
+
+    def search(self, term, field='key', objects=None):
+        objects = self.user.keywords.all() if objects is None else objects
+        return sorted(utils.search(objects, field, self.user.id, term).values_list(field, flat=True))
+
+    def test_in_memory_search(self):
+        self.assertEqual(self.search('КОТ'), ['Продам КОТА', 'котлеты'])
+        self.assertEqual(self.search('cat'), ['Cat food'])
+        self.assertEqual(self.search(''), ['Cat food', 'Продам КОТА', 'котлеты', 'собака'])
+        self.assertEqual(self.search('пёс'), [])
+
+    def test_in_memory_search_keeps_the_queryset(self):
+        chat = Chat.objects.create(chat_id=-1, chat_type=Chat.GROUP_CHAT, title='chat')
+        chat.keywords.add(self.user.keywords.get(key='котлеты'))
+        self.assertEqual(self.search('кот', objects=chat.keywords.all()), ['котлеты'])
+
+    def test_in_memory_search_sees_new_objects(self):
+        self.assertEqual(self.search('пёс'), [])
+        Keyword.objects.create(user=self.user, key='пёс')
+        self.assertEqual(self.search('пёс'), ['пёс'])
+
+    def test_in_memory_search_returns_every_match(self):
+        utils.add_keys(self.user, Keyword, ['кот {}'.format(i) for i in range(1200)])
+        self.assertEqual(len(self.search('кот ')), 1200)
+
+    def test_search_groups(self):
+        KeywordsGroup.objects.create(user=self.user, name='Звери')
+        self.assertEqual(self.search('звер', 'name', self.user.groups.all()), ['Звери'])
+
+    def test_postgresql_search(self):
+        with mock.patch.object(utils, 'connection', mock.Mock(vendor='postgresql')):
+            objects = utils.search(self.user.keywords.all(), 'key', self.user.id, 'Cat')
+        # The lookup the trigram indexes serve, SQLite runs it for ASCII
+        self.assertEqual(objects.query.where.children[-1].lookup_name, 'icontains')
+        self.assertEqual(list(objects.values_list('key', flat=True)), ['Cat food'])
+
+
+class ChatsKeyboardTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(chat_id=1, name='user')
+
+    def add_chats(self, count):
+        Chat.objects.bulk_create(
+            Chat(chat_id=-i, chat_type=Chat.GROUP_CHAT, title='chat {}'.format(i)) for i in range(1, count + 1))
+        chats = list(Chat.objects.order_by('id'))
+        Relation.objects.bulk_create(Relation(user=self.user, chat=chat) for chat in chats)
+        return chats
+
+    def rows(self, keyboard):
+        return [[button.callback_data for button in row] for row in keyboard.inline_keyboard]
+
+    def test_one_page(self):
+        chats = self.add_chats(telegrambot.CHATS_PAGE_SIZE)
+        with self.assertNumQueries(1):
+            rows = self.rows(telegrambot.chats_keyboard(self.user, 1))
+        self.assertEqual(rows, [['switch {} 1'.format(chat.id)] for chat in chats])
+        self.assertIsNone(telegrambot.chats_keyboard(self.user, 2))
+
+    def test_pages(self):
+        chats = self.add_chats(telegrambot.CHATS_PAGE_SIZE + 1)
+        first = self.rows(telegrambot.chats_keyboard(self.user, 1))
+        self.assertEqual(len(first), telegrambot.CHATS_PAGE_SIZE + 1)
+        self.assertEqual(first[-1], ['chats page 2'])
+        self.assertEqual(self.rows(telegrambot.chats_keyboard(self.user, 2)),
+                         [['switch {} 2'.format(chats[-1].id)], ['chats page 1']])
+        self.assertIsNone(telegrambot.chats_keyboard(self.user, 3))
+
+    def test_no_chats(self):
+        self.assertIsNone(telegrambot.chats_keyboard(self.user, 1))
+
+    def callback(self, data):
+        update = mock.Mock(bot_user=self.user)
+        update.callback_query.data = data
+        return update
+
+    def test_switch_page(self):
+        self.add_chats(telegrambot.CHATS_PAGE_SIZE + 1)
+        update = self.callback('chats page 2')
+        telegrambot.switch_chats_page(mock.Mock(), update)
+        keyboard = update.callback_query.edit_message_reply_markup.call_args[1]['reply_markup']
+        self.assertEqual(len(keyboard.inline_keyboard), 2)
+
+    def test_switch_chat(self):
+        chats = self.add_chats(telegrambot.CHATS_PAGE_SIZE + 1)
+        update = self.callback('switch {} 2'.format(chats[-1].id))
+        telegrambot.switch_chat(mock.Mock(), update)
+        self.assertFalse(Relation.objects.get(chat=chats[-1]).active)
+        # The keyboard stays on the page of the chat
+        keyboard = update.callback_query.edit_message_reply_markup.call_args[1]['reply_markup']
+        self.assertEqual(self.rows(keyboard)[-1], ['chats page 1'])
+
+    def test_switch_chat_with_old_callback(self):
+        # Keyboards sent before paging have no page in their buttons
+        chats = self.add_chats(telegrambot.CHATS_PAGE_SIZE + 1)
+        update = self.callback('switch {}'.format(chats[0].id))
+        telegrambot.switch_chat(mock.Mock(), update)
+        self.assertFalse(Relation.objects.get(chat=chats[0]).active)
+        keyboard = update.callback_query.edit_message_reply_markup.call_args[1]['reply_markup']
+        self.assertEqual(self.rows(keyboard)[-1], ['chats page 2'])
+
+    def test_switch_chat_without_bot(self):
+        chat = self.add_chats(1)[0]
+        Chat.objects.filter(id=chat.id).update(bot_in_chat=False)
+        update = self.callback('switch {} 1'.format(chat.id))
+        telegrambot.switch_chat(mock.Mock(), update)
+        self.assertTrue(Relation.objects.get(chat=chat).active)
+        self.assertTrue(update.callback_query.answer.call_args[1]['show_alert'])
+
+
+class UserCacheTests(TestCase):
+    def setUp(self):
+        utils._users.clear()
+        self.user = User.objects.create(chat_id=1, name='user')
+
+    def test_cached(self):
+        self.assertEqual(utils.get_cached_user(1), self.user)
+        with self.assertNumQueries(0):
+            user = utils.get_cached_user(1)
+        self.assertEqual((user.id, user.name, user.debug), (self.user.id, 'user', False))
+        self.assertFalse(user._state.adding)
+
+    def test_instances_are_not_shared(self):
+        utils.get_cached_user(1)
+        user = utils.get_cached_user(1)
+        user.name = 'changed'
+        self.assertIsNot(utils.get_cached_user(1), user)
+        self.assertEqual(utils.get_cached_user(1).name, 'user')
+
+    def test_forgotten_on_save(self):
+        user = utils.get_cached_user(1)
+        user.debug = True
+        user.save()
+        self.assertTrue(utils.get_cached_user(1).debug)
+
+    def test_resolved_once_per_update(self):
+        update = mock.Mock(spec=['effective_user'])
+        update.effective_user.id = 1
+        user = utils.resolve_user(update)
+        self.assertIs(utils.resolve_user(update), user)
+
+
+class SubscriptionConsistencyTests(TestCase):
+    "ChatSubscription kept up to date by signals and refreshes equals the table built from scratch"
+
+    def setUp(self):
+        self.alice = User.objects.create(chat_id=1, name='alice')
+        self.bob = User.objects.create(chat_id=2, name='bob')
+        self.chats = [Chat.objects.create(chat_id=-i, chat_type=Chat.GROUP_CHAT, title=str(i)) for i in (1, 2, 3)]
+        for chat in self.chats[:2]:
+            chat.user.add(self.alice, self.bob)
+        self.keywords = [Keyword.objects.create(user=self.alice, key=key, mode=rules.mode_of(key))
+                         for key in ('кот', '=пёс', 'рыба*')]
+        self.keywords[0].chats.add(*self.chats)
+        self.keywords[1].chats.add(self.chats[0])
+        self.nkey = NegativeKeyword.objects.create(user=self.alice, key='собака')
+        self.nkey.keywords.add(self.keywords[0])
+        self.assertConsistent()
+
+    def table(self):
+        return sorted(ChatSubscription.objects.values_list(
+            'chat_id', 'keyword_id', 'key', 'mode', 'owner', 'active', 'negative_keys'))
+
+    def assertConsistent(self):
+        table = self.table()
+        subscriptions.rebuild()
+        self.assertEqual(table, self.table())
+
+    def test_pins(self):
+        cat, dog, fish = self.keywords
+        fish.chats.add(*self.chats[:2])
+        self.assertConsistent()
+        cat.chats.remove(self.chats[1])
+        self.assertConsistent()
+        self.chats[2].keywords.add(dog, fish)
+        self.assertConsistent()
+        self.chats[0].keywords.remove(cat)
+        self.assertConsistent()
+        self.chats[2].keywords.clear()
+        self.assertConsistent()
+        dog.chats.clear()
+        self.assertConsistent()
+
+    def test_keyword_changes(self):
+        cat, dog, _ = self.keywords
+        cat.state = False
+        cat.save()
+        self.assertConsistent()
+        self.assertFalse(ChatSubscription.objects.filter(keyword=cat, active=True).exists())
+        cat.key = '=кошка'
+        cat.mode = rules.mode_of(cat.key)
+        cat.save()
+        self.assertConsistent()
+        dog.delete()
+        self.assertConsistent()
+
+    def test_relations(self):
+        chat = self.chats[2]
+        self.assertFalse(ChatSubscription.objects.filter(chat=chat, active=True).exists())
+        chat.user.add(self.alice)
+        self.assertConsistent()
+        self.assertTrue(ChatSubscription.objects.filter(chat=chat, active=True).exists())
+        relation = Relation.objects.get(user=self.alice, chat=self.chats[0])
+        relation.active = False
+        relation.save()
+        self.assertConsistent()
+        relation.active = True
+        relation.save()
+        self.assertConsistent()
+        chat.user.remove(self.alice)
+        self.assertConsistent()
+        self.alice.chats.remove(self.chats[1])
+        self.assertConsistent()
+        Relation.objects.get(user=self.alice, chat=self.chats[0]).delete()
+        self.assertConsistent()
+        self.alice.chats.add(*self.chats)
+        self.assertConsistent()
+        self.chats[0].user.clear()
+        self.assertConsistent()
+        self.alice.chats.clear()
+        self.assertConsistent()
+
+    def test_negative_keys(self):
+        cat, dog, _ = self.keywords
+        self.nkey.keywords.add(dog)
+        self.assertConsistent()
+        dog.negativekeyword.add(NegativeKeyword.objects.create(user=self.alice, key='кошка'))
+        self.assertConsistent()
+        self.assertEqual(ChatSubscription.objects.get(keyword=dog).negative_keys, '["кошка", "собака"]')
+        self.nkey.keywords.remove(cat)
+        self.assertConsistent()
+        self.nkey.key = 'собаки'
+        self.nkey.save()
+        self.assertConsistent()
+        self.nkey.keywords.clear()
+        self.assertConsistent()
+        dog.negativekeyword.clear()
+        self.assertConsistent()
+        nkey = NegativeKeyword.objects.create(user=self.alice, key='мышь')
+        nkey.keywords.add(cat, dog)
+        self.assertConsistent()
+        nkey.delete()
+        self.assertConsistent()
+
+    def test_group_switches(self):
+        group = KeywordsGroup.objects.create(user=self.alice, name='звери')
+        group.keys.add(*self.keywords[:2])
+        utils.switch_group(group, False)
+        self.assertConsistent()
+        self.assertFalse(ChatSubscription.objects.filter(active=True).exists())
+        utils.switch_group(group, True)
+        self.assertConsistent()
+
+    def test_imports(self):
+        utils.replicate_users_dataprint(self.bob, utils.gen_users_dataprint(self.alice))
+        self.assertConsistent()
+        self.bob.keywords.get(key='кот').chats.add(*self.chats)
+        self.assertConsistent()
+        self.alice.keywords.get(key='=пёс').chats.add(self.chats[1])
+        utils.sync_users_dataprint(self.bob, utils.gen_users_syncprint(self.alice))
+        self.assertConsistent()
+        utils.add_keys(self.bob, Keyword, ['мышь', 'кот'])
+        utils.add_keys(self.bob, NegativeKeyword, ['крыса'])
+        self.bob.keywords.get(key='мышь').chats.add(self.chats[0])
+        self.bob.negativekeyword.get(key='крыса').keywords.add(*self.bob.keywords.all())
+        self.assertConsistent()
+        utils.delete_all_keywords(self.bob)
+        self.assertConsistent()
+
+
+class KeysTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(chat_id=1, name='user')
+        self.other = User.objects.create(chat_id=2, name='other')
+
+    def test_normalize_keys(self):
+        self.assertEqual(utils.normalize_keys(' кот \n\n  чёрная   кошка\n'), ['кот', 'чёрная кошка'])
+
+    def test_add_keys(self):
+        Keyword.objects.create(user=self.user, key='кот')
+        Keyword.objects.create(user=self.other, key='пёс')
+        added, duplicates = utils.add_keys(self.user, Keyword, ['кот', 'пёс', 'пёс', '=рыба', 'кот AND пёс'])
+        self.assertEqual((added, duplicates), (3, 2))
+        self.assertEqual(dict(self.user.keywords.values_list('key', 'mode')), {
+            'кот': Keyword.SUBSTRING, 'пёс': Keyword.SUBSTRING, '=рыба': Keyword.WORD, 'кот AND пёс': Keyword.BOOLEAN,
+        })
+
+    def test_add_negative_keys(self):
+        self.assertEqual(utils.add_keys(self.user, NegativeKeyword, ['собака', 'собака']), (1, 1))
+        self.assertEqual(utils.add_keys(self.user, NegativeKeyword, ['собака']), (0, 1))
+        self.assertEqual(list(self.user.negativekeyword.values_list('key', flat=True)), ['собака'])
+
+    def test_add_keys_changes_data_version(self):
+        version = utils.get_user_data_version(self.user.id)
+        utils.add_keys(self.user, Keyword, ['кот'])
+        self.assertNotEqual(utils.get_user_data_version(self.user.id), version)
+
+
+class DeleteAllKeywordsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(chat_id=1, name='user')
+        self.other = User.objects.create(chat_id=2, name='other')
+
+    def test_delete_all_keywords(self):
+        chat = Chat.objects.create(chat_id=-1, chat_type=Chat.GROUP_CHAT, title='chat')
+        chat.user.add(self.user, self.other)
+        utils.add_keys(self.user, Keyword, ['k{}'.format(i) for i in range(5)])
+        keywords = list(self.user.keywords.all())
+        chat.keywords.add(*keywords)
+        NegativeKeyword.objects.create(user=self.user, key='n').keywords.add(*keywords)
+        group = KeywordsGroup.objects.create(user=self.user, name='g')
+        group.keys.add(*keywords)
+        kept = Keyword.objects.create(user=self.other, key='k1')
+        kept.chats.add(chat)
+        version = Chat.objects.get(id=chat.id).index_version
+
+        progress = []
+        with mock.patch.object(utils, 'DELETE_CHUNK_SIZE', 2):
+            self.assertEqual(utils.delete_all_keywords(self.user, lambda *counts: progress.append(counts)), 5)
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+        self.assertFalse(self.user.keywords.exists())
+        self.assertFalse(NegativeKeyword.keywords.through.objects.exists())
+        self.assertFalse(group.keys.exists())
+        self.assertEqual(list(Keyword.objects.all()), [kept])
+        self.assertEqual(list(ChatSubscription.objects.values_list('keyword_id', flat=True)), [kept.id])
+        self.assertGreater(Chat.objects.get(id=chat.id).index_version, version)
+
+    def test_delete_task_reports_progress(self):
+        utils.add_keys(self.user, Keyword, ['k{}'.format(i) for i in range(3)])
+        with mock.patch.object(utils, 'DELETE_CHUNK_SIZE', 2), \
+                mock.patch.object(tasks, 'edit_message_text') as edit:
+            tasks.delete_all_keywords(self.user.id, 10, '{deleted}/{total}', 'done')
+        self.assertEqual([call[0] for call in edit.call_args_list], [(1, 10, '2/3'), (1, 10, '3/3'), (1, 10, 'done')])
+        self.assertFalse(self.user.keywords.exists())
+
+
+class FakeRedis(object):
+    """Just enough of a Redis client for TwoTierCache. The caches of a test
+    share one, as processes share the server. Time is `clock[0]`"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.data = {}
+        self.handlers = []
+        self.down = False
+
+    def __getattribute__(self, name):
+        if name in FakeRedis.COMMANDS and object.__getattribute__(self, 'down'):
+            raise redis.ConnectionError("Connection refused")
+        return object.__getattribute__(self, name)
+
+    def _live(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires <= self.clock[0]:
+            del self.data[key]
+            return None, None
+        return value, expires
+
+    def get(self, key):
+        return self._live(key)[0]
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and self.get(key) is not None:
+            return None
+        self.data[key] = (value, None if px is None else self.clock[0] + px / 1000)
+        return True
+
+    def pttl(self, key):
+        value, expires = self._live(key)
+        if value is None:
+            return -2
+        return -1 if expires is None else int((expires - self.clock[0]) * 1000)
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def exists(self, key):
+        return int(self.get(key) is not None)
+
+    def scan_iter(self, match, count):
+        return [key for key in list(self.data) if fnmatch.fnmatchcase(key, match)]
+
+    def hmset(self, key, mapping):
+        hash = self._live(key)[0] or {}
+        hash.update((field.encode(), value.encode()) for field, value in mapping.items())
+        self.data[key] = (hash, self.data.get(key, (None, None))[1])
+        return True
+
+    def hscan_iter(self, key, match):
+        hash = self._live(key)[0] or {}
+        return [(field, value) for field, value in hash.items() if fnmatch.fnmatchcase(field.decode(), match)]
+
+    def sadd(self, key, *members):
+        members = {member.encode() for member in members}
+        self.hmset(key, {})
+        self.data[key][0].update(dict.fromkeys(members, b''))
+        return len(members)
+
+    def smembers(self, key):
+        return set(self._live(key)[0] or ())
+
+    def expire(self, key, seconds):
+        if self._live(key)[0] is None:
+            return False
+        self.data[key] = (self.data[key][0], self.clock[0] + seconds)
+        return True
+
+    def publish(self, channel, message):
+        for handler in self.handlers:
+            handler({'data': message.encode()})
+
+    def pubsub(self, ignore_subscribe_messages):
+        server = self
+
+        class PubSub(object):
+            def subscribe(self, **handlers):
+                server.handlers.extend(handlers.values())
+
+            def run_in_thread(self, sleep_time, daemon):
+                return mock.Mock(**{'is_alive.return_value': True})
+
+        return PubSub()
+
+    def pipeline(self, transaction=True):
+        server = self
+
+        class Pipeline(object):
+            def __init__(self):
+                self.commands = []
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                pass
+
+            def __getattr__(self, name):
+                return lambda *args: self.commands.append((name, args))
+
+            def execute(self):
+                return [getattr(server, name)(*args) for name, args in self.commands]
+
+        return Pipeline()
+
+    COMMANDS = {'get', 'mget', 'set', 'pttl', 'delete', 'exists', 'scan_iter', 'publish', 'pubsub', 'pipeline',
+                'hmset', 'hscan_iter', 'sadd', 'smembers', 'expire'}
+
+
+class TwoTierCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = [1000.0]
+        self.server = FakeRedis(self.clock)
+        for module in ('bot.lru', 'bot.cache'):
+            clock = mock.patch(module + '.time', mock.Mock(monotonic=lambda: self.clock[0]))
+            clock.start()
+            self.addCleanup(clock.stop)
+        self.caches = [self.connect() for _ in range(2)]
+
+    def connect(self):
+        "Cache of another process"
+        with mock.patch.object(redis.Redis, 'from_url', return_value=self.server):
+            return TwoTierCache('redis://redis', {'OPTIONS': {'LOCAL_TIMEOUT': 5}})
+
+    def test_shared(self):
+        first, second = self.caches
+        first.set('key', {'value': 1}, 60)
+        self.assertEqual(second.get('key'), {'value': 1})
+        self.assertTrue(second.add('new', 1))
+        self.assertFalse(first.add('new', 2))
+        self.assertEqual(first.get_many(['key', 'new', 'missing']), {'key': {'value': 1}, 'new': 1})
+
+    def test_local_tier(self):
+        first, second = self.caches
+        first.set('key', 1, 60)
+        second.get('key')
+        # Served locally without a round-trip
+        self.server.data.clear()
+        self.assertEqual(second.get('key'), 1)
+
+    def test_invalidation(self):
+        first, second = self.caches
+        first.set('key', 1, 60)
+        self.assertEqual(second.get('key'), 1)
+        first.set('key', 2, 60)
+        self.assertEqual(second.get('key'), 2)
+        first.delete('key')
+        self.assertIsNone(second.get('key'))
+        first.set('key', 3, 60)
+        self.assertEqual(second.get('key'), 3)
+        first.clear()
+        self.assertIsNone(second.get('key'))
+
+    def test_own_invalidations_keep_local_copy(self):
+        first, _ = self.caches
+        first.set('key', 1, 60)
+        self.server.data.clear()
+        self.assertEqual(first.get('key'), 1)
+
+    def test_local_copy_never_outlives_redis(self):
+        first, second = self.caches
+        first.set('key', 1, 2)
+        self.assertEqual(second.get('key'), 1)
+        self.clock[0] += 1
+        self.assertEqual(second.get('key'), 1)
+        self.clock[0] += 1.5
+        self.assertIsNone(first.get('key'))
+        self.assertIsNone(second.get('key'))
+
+    def test_local_copy_expires(self):
+        first, second = self.caches
+        first.set('key', 1, 60)
+        second.get('key')
+        # An invalidation is lost
+        self.server.data[first.make_key('key')] = (pickle.dumps(2), None)
+        self.assertEqual(second.get('key'), 1)
+        self.clock[0] += 6
+        self.assertEqual(second.get('key'), 2)
+
+    def test_redis_down(self):
+        first, second = self.caches
+        first.set('key', 1, 60)
+        second.get('key')
+        self.server.down = True
+        with self.assertLogs('bot.cache', 'WARNING'):
+            # Local copies are served, misses are misses
+            self.assertEqual(second.get('key'), 1)
+            self.assertIsNone(second.get('other'))
+            second.set('other', 2, 60)
+            self.assertEqual(second.get('other'), 2)
+            # add is atomic within the process
+            self.assertTrue(second.add('dedup', 1, 60))
+            self.assertFalse(second.add('dedup', 1, 60))
+            second.delete('key')
+            self.assertIsNone(second.get('key'))
+            second.clear()
+
+    def test_redis_back(self):
+        first, second = self.caches
+        second.set('key', 1, 60)
+        # The connection is lost with the subscription
+        self.server.down = True
+        self.server.handlers.remove(second._invalidated)
+        second._listener = mock.Mock(**{'is_alive.return_value': False})
+        with self.assertLogs('bot.cache', 'WARNING'):
+            self.assertIsNone(second.get('other'))
+        self.server.down = False
+        first.set('key', 2, 60)
+        # Invalidations were missed meanwhile, the local tier is cleared on subscribing again
+        self.clock[0] += second.LISTEN_RETRY
+        self.assertEqual(second.get('key'), 2)
+        first.set('key', 3, 60)
+        self.assertEqual(second.get('key'), 3)
+
+    def test_clear_removes_own_keys_only(self):
+        first, _ = self.caches
+        first.set('key', 1, 60)
+        self.server.set('celery', b'message')
+        first.clear()
+        self.assertEqual(list(self.server.data), ['celery'])
+        self.assertIsNone(first.get('key'))
+
+    def test_clear_scans_in_chunks(self):
+        first, _ = self.caches
+        for i in range(2500):
+            self.server.set(first.make_key(i), pickle.dumps(i))
+        with mock.patch.object(self.server, 'delete', wraps=self.server.delete) as delete:
+            first.clear()
+        self.assertEqual([len(call[0]) for call in delete.call_args_list], [1000, 1000, 500])
+        self.assertFalse(self.server.data)
+
+    def test_zero_timeout_deletes(self):
+        first, second = self.caches
+        first.set('key', 1, 60)
+        second.get('key')
+        first.set('key', 2, 0)
+        self.assertIsNone(first.get('key'))
+        self.assertIsNone(second.get('key'))
+
+
+class DedupTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_check_for_uniqueness(self):
+        self.assertTrue(utils.check_for_uniqueness('1', 'продам кота'))
+        self.assertFalse(utils.check_for_uniqueness('1', 'продам кота'))
+        # Repeats keep the message blocked
+        self.assertFalse(utils.check_for_uniqueness('1', 'продам кота'))
+        self.assertTrue(utils.check_for_uniqueness('2', 'продам кота'))
+        self.assertTrue(utils.check_for_uniqueness('1', 'продам пса'))
+
+    def test_retired_flush_cache_keeps_the_cache(self):
+        self.assertTrue(utils.check_for_uniqueness('1', 'продам кота'))
+        tasks.flush_cache()
+        self.assertFalse(utils.check_for_uniqueness('1', 'продам кота'))
+
+
+class SweepTests(SimpleTestCase):
+    def test_sweep_removes_expired_entries_only(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backend = SweptFileBasedCache(directory, {})
+            backend.set('expiring', 1, 30)
+            backend.set('kept', 2, 3600)
+            with mock.patch.object(filebased.time, 'time', return_value=time.time() + 60):
+                self.assertEqual(backend.sweep(), 1)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertEqual(backend.get('kept'), 2)
+
+    def test_sweep_cache_skips_other_backends(self):
+        with self.assertLogs('bot.utils', 'INFO'):
+            self.assertEqual(utils.sweep_cache(), 0)
+
+
+class MetricsTests(SimpleTestCase):
+    def scrape(self, **headers):
+        return Client(SERVER_NAME='localhost').get('/metrics', **headers)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_local_scrapes_only_without_token(self):
+        response = self.scrape()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'chatmonitor_messages_received_total', response.content)
+        self.assertEqual(self.scrape(REMOTE_ADDR='10.0.0.2').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.scrape(REMOTE_ADDR='10.0.0.2', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_shards(self):
+        self.assertEqual(metrics.shard(-1001234567890), str(1001234567890 % metrics.CHAT_SHARDS))
+        self.assertEqual({metrics.shard(i) for i in range(-100, 100)}, {str(i) for i in range(metrics.CHAT_SHARDS)})
+
+
+class DigestsTests(TestCase):
+    def setUp(self):
+        self.clock = [3600.0 * 1000]
+        self.server = FakeRedis(self.clock)
+        for name, value in (
+            ('_redis', lambda: self.server), ('_flusher_pid', os.getpid()), ('_samples', []),
+            ('_hour_digests', {}), ('_digests_hour', None), ('_unsaved', set()), ('_process_pid', None),
+        ):
+            patcher = mock.patch.object(digests, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(digests.time, 'time', lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, chat_id, keyword_ids, values):
+        for value in values:
+            digests.record(chat_id, keyword_ids, digests.MATCH_COST, value)
+
+    def fork(self):
+        "Continue as another process"
+        digests._process_pid = None
+        digests._hour_digests, digests._digests_hour = {}, None
+
+    def test_merged_across_snapshots_and_processes(self):
+        self.record(-1, [1, 2], range(100))
+        digests.snapshot()
+        self.record(-1, [1], range(100, 200))
+        digests.snapshot()
+        self.fork()
+        self.record(-1, [], range(200, 300))
+        self.record(-2, [2], [5])
+        digests.snapshot()
+
+        merged = digests.merged(1)
+        self.assertEqual(merged[(digests.CHAT, -1, digests.MATCH_COST)].n, 300)
+        self.assertAlmostEqual(merged[(digests.CHAT, -1, digests.MATCH_COST)].percentile(50), 150, delta=3)
+        self.assertEqual(merged[(digests.KEYWORD, 1, digests.MATCH_COST)].n, 200)
+        self.assertEqual(merged[(digests.KEYWORD, 2, digests.MATCH_COST)].n, 101)
+        self.assertEqual(merged[(digests.CHAT, -2, digests.MATCH_COST)].n, 1)
+        # A field per digest in a hash per process
+        hour = int(self.clock[0] // 3600)
+        self.assertEqual(len(self.server.smembers(digests.PROCESSES_KEY.format(hour=hour))), 2)
+
+    def test_many_snapshots_keep_everything(self):
+        # More entries than a capped list of the hour used to keep
+        for _ in range(70):
+            for chat_id in range(300):
+                self.record(-chat_id, [], [1])
+            digests.snapshot()
+        merged = digests.merged(1, digests.CHAT)
+        self.assertEqual(len(merged), 300)
+        self.assertEqual({digest.n for digest in merged.values()}, {70})
+
+    def test_filters_and_hours(self):
+        self.record(-1, [1], [1, 2])
+        digests.record(-1, [1], digests.MESSAGE_LENGTH, 10)
+        digests.snapshot()
+        self.clock[0] += 3600
+        self.record(-1, [1], [3])
+        digests.snapshot()
+        self.assertEqual(set(digests.merged(2, digests.KEYWORD, digests.MATCH_COST)), {(digests.KEYWORD, 1, digests.MATCH_COST)})
+        self.assertEqual(digests.merged(1, digests.CHAT, digests.MATCH_COST)[(digests.CHAT, -1, digests.MATCH_COST)].n, 1)
+        self.assertEqual(digests.merged(2, digests.CHAT, digests.MATCH_COST)[(digests.CHAT, -1, digests.MATCH_COST)].n, 3)
+        self.assertEqual(digests.merged(2, metric=digests.MESSAGE_LENGTH)[(digests.CHAT, -1, digests.MESSAGE_LENGTH)].n, 1)
+
+    def test_failed_writes_are_retried(self):
+        self.record(-1, [], [1, 2])
+        self.server.down = True
+        with self.assertLogs('bot.digests', 'ERROR'):
+            digests.snapshot()
+        self.server.down = False
+        digests.snapshot()
+        self.assertEqual(digests.merged(1)[(digests.CHAT, -1, digests.MATCH_COST)].n, 2)
+
+    def test_latency_report(self):
+        Chat.objects.create(chat_id=-1, chat_type=Chat.GROUP_CHAT, title='chat')
+        self.record(-1, [], [0.001] * 10)
+        self.record(-2, [], [0.5])
+        out = io.StringIO()
+        call_command('latency_report', '--hours', '1', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        # Highest p99 first
+        self.assertEqual(lines[1].split()[:2], ['-2', '1'])
+        self.assertEqual(lines[2].split()[:2], ['-1', '10'])
+        self.assertEqual(lines[2].split()[-1], 'chat')
+
+
+class TracingTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.export = os.path.join(directory.name, 'traces.jsonl')
+        patcher = override_settings(TRACE_EXPORT=self.export, TRACE_SLOW_SECONDS=2, TRACE_SAMPLE_RATE=0.01)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def trace(self, duration=0, sample=0.5, error=None, span_error=None):
+        "Run a trace lasting `duration` with random() returning `sample`"
+        t = tracing.Trace('id', 'message', started=time.time() - duration)
+        if error:
+            t.error = error
+        if span_error:
+            t.add_span('match', t.started, 0, error=span_error)
+        t.duration = duration
+        with mock.patch.object(tracing.random, 'random', return_value=sample):
+            return tracing._keep(t)
+
+    def test_tail_sampling(self):
+        self.assertFalse(self.trace())
+        self.assertTrue(self.trace(duration=2))
+        self.assertTrue(self.trace(error='ValueError()'))
+        self.assertTrue(self.trace(span_error='ValueError()'))
+        self.assertTrue(self.trace(sample=0.005))
+
+    def exported(self):
+        if not os.path.exists(self.export):
+            return []
+        with open(self.export, encoding='utf8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_kept_traces_are_exported(self):
+        with mock.patch.object(tracing.random, 'random', return_value=0):
+            with tracing.trace('message', trace_id='abc') as t:
+                with tracing.span('match', chat=-1) as attrs:
+                    attrs['matched'] = 2
+        self.assertIsNone(tracing.current())
+        [exported] = self.exported()
+        self.assertEqual((exported['trace_id'], exported['name']), ('abc', 'message'))
+        self.assertEqual([(s['name'], s['chat'], s['matched']) for s in exported['spans']], [('match', -1, 2)])
+        self.assertEqual(exported['duration'], t.duration)
+
+    def test_sampled_out_traces_are_not_exported(self):
+        with mock.patch.object(tracing.random, 'random', return_value=0.5):
+            with tracing.trace('message'):
+                with tracing.span('match'):
+                    pass
+        self.assertEqual(self.exported(), [])
+
+    def test_failed_traces_are_exported(self):
+        with mock.patch.object(tracing.random, 'random', return_value=0.5), self.assertRaises(ValueError):
+            with tracing.trace('message'):
+                with tracing.span('match'):
+                    raise ValueError('boom')
+        [exported] = self.exported()
+        self.assertEqual(exported['error'], repr(ValueError('boom')))
+        self.assertEqual(exported['spans'][0]['error'], repr(ValueError('boom')))
+
+    def test_off(self):
+        with override_settings(TRACE_EXPORT=''):
+            with tracing.trace('message') as t:
+                with tracing.span('match'):
+                    pass
+        self.assertIsNone(t)
+        self.assertEqual(self.exported(), [])
+
+
+def busy(seconds):
+    "Keep the profiled thread in this function for a while"
+    until = time.perf_counter() + seconds
+    while time.perf_counter() < until:
+        sum(range(100))
+
+
+class ProfilingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        profiling._config.clear()
+
+    def start(self, *args, **kwargs):
+        profiling.start(*args, **kwargs)
+        # Don't wait for CONFIG_REFRESH
+        profiling._config.clear()
+
+    def test_profiler_for(self):
+        self.assertIsNone(profiling.profiler_for(-1))
+        self.start(chats=[-1], rate=0.1)
+        self.assertIsInstance(profiling.profiler_for(-1).profiler, profiling.SamplingProfiler)
+        with mock.patch.object(profiling.random, 'random', return_value=0.5):
+            self.assertIsNone(profiling.profiler_for(-2))
+        with mock.patch.object(profiling.random, 'random', return_value=0.05):
+            self.assertEqual(profiling.profiler_for(-2).chat_id, -2)
+        self.start(chats=[-1], mode=profiling.TRACE)
+        self.assertIsInstance(profiling.profiler_for(-1).profiler, profiling.TracingProfiler)
+        profiling.stop()
+        profiling._config.clear()
+        self.assertIsNone(profiling.profiler_for(-1))
+
+    def test_config_is_read_once_per_refresh(self):
+        self.assertIsNone(profiling.config())
+        profiling.start(chats=[-1])
+        # Until CONFIG_REFRESH passes this process still sees it off
+        self.assertIsNone(profiling.config())
+        with mock.patch.object(profiling.cache, 'get') as get:
+            profiling.config()
+        get.assert_not_called()
+
+    def profile(self, profiler):
+        with profiling.Profiled(-1, profiler):
+            busy(0.05)
+        return profiling.collapsed(-1)
+
+    def test_sampling(self):
+        lines = self.profile(profiling.SamplingProfiler())
+        self.assertTrue(lines)
+        stacks = dict(line.rsplit(' ', 1) for line in lines)
+        # Stacks start in the profiled block
+        self.assertTrue(all(stack.startswith('bot.tests.busy') for stack in stacks))
+        self.assertGreater(sum(map(int, stacks.values())), 5)
+
+    def test_tracing(self):
+        previous = sys.getprofile()
+        lines = self.profile(profiling.TracingProfiler())
+        self.assertIs(sys.getprofile(), previous)
+        stacks = dict(line.rsplit(' ', 1) for line in lines)
+        self.assertIn('bot.tests.busy;builtins.sum', stacks)
+        # Microseconds of own time
+        self.assertGreater(sum(map(int, stacks.values())), 10000)
+
+    def test_stacks_add_up(self):
+        profiler = mock.Mock(stacks={'a;b': 2, 'a': 1})
+        with profiling.Profiled(-1, profiler):
+            pass
+        with profiling.Profiled(-1, profiler):
+            pass
+        self.assertEqual(profiling.collapsed(-1), ['a 2', 'a;b 4'])
+        self.assertEqual(profiling.collapsed(-2), [])
+        profiling.clear(-1)
+        self.assertEqual(profiling.collapsed(-1), [])
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('profile_matching', 'start', '--chat', '-1', stdout=out)
+        profiling._config.clear()
+        call_command('profile_matching', 'status', stdout=out)
+        self.assertIn('Profiling 1 chats [-1]', out.getvalue())
+        with profiling.Profiled(-1, mock.Mock(stacks={'a;b': 3})):
+            pass
+        out = io.StringIO()
+        call_command('profile_matching', 'dump', '--chat', '-1', stdout=out)
+        self.assertEqual(out.getvalue(), 'a;b 3\n')
+        with self.assertRaises(CommandError):
+            call_command('profile_matching', 'dump', '--chat', '-2')
+
+
+class SnapshotTests(SimpleTestCase):
+    KEYS = ['k{}x'.format(i) for i in range(matching.AUTOMATON_MIN_PATTERNS)] + [
+        'кот', '=пёс', 'рыба*', '~чёрная кошка', '/кот(ик|ята)/', 'кот AND NOT собака',
+    ]
+    TEXTS = ['k1x k200x', 'котята', 'чёрной кошкой', 'Пёс и рыбалка', 'кот и собака', 'скотина', '']
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.chat = Chat(id=7, index_version=3)
+        rows = [(i, key, i % 3, '["гнил"]' if i % 2 else '[]', rules.mode_of(key)) for i, key in enumerate(self.KEYS)]
+        self.index = matching.ChatIndex.from_rows(rows)
+        self.build = mock.Mock(return_value=self.index)
+
+    def path(self, version=3):
+        return snapshots.path(self.directory, self.chat, version)
+
+    def matches(self, index):
+        return [sorted(index.match(text)) for text in self.TEXTS + ['гнилой ' + text for text in self.TEXTS]]
+
+    def test_round_trip(self):
+        snapshots.write(self.path(), 3, self.index)
+        loaded = snapshots.load(self.path(), 3)
+        self.assertIsInstance(loaded.records, snapshots.MappedRecords)
+        self.assertIsNotNone(loaded._automaton)
+        self.assertEqual(len(loaded), len(self.index))
+        self.assertEqual([loaded.records[i] for i in range(len(loaded))],
+                         [self.index.records[i] for i in range(len(self.index))])
+        self.assertEqual(self.matches(loaded), self.matches(self.index))
+        self.assertTrue(any(self.matches(loaded)))
+
+    def test_small_index_without_automaton(self):
+        index = index_of('кот', '=пёс')
+        snapshots.write(self.path(), 3, index)
+        loaded = snapshots.load(self.path(), 3)
+        self.assertIsNone(loaded._automaton)
+        self.assertEqual(self.matches(loaded), self.matches(index))
+
+    def test_version_mismatch(self):
+        snapshots.write(self.path(), 3, self.index)
+        self.assertIsNone(snapshots.load(self.path(), 4))
+
+    def test_flags_mismatch(self):
+        snapshots.write(self.path(), 3, self.index)
+        with override_settings(MATCH_FOLD_YO=False):
+            self.assertIsNone(snapshots.load(self.path(), 3))
+        self.assertIsNotNone(snapshots.load(self.path(), 3))
+
+    def test_missing(self):
+        self.assertIsNone(snapshots.load(self.path(), 3))
+
+    def assertMiss(self, data, logged=True):
+        with open(self.path(), 'wb') as f:
+            f.write(data)
+        mapped = []
+        mmap_ = snapshots.mmap.mmap
+        with mock.patch.object(snapshots.mmap, 'mmap', side_effect=lambda *args, **kwargs: mapped.append(mmap_(*args, **kwargs)) or mapped[-1]):
+            if logged:
+                with self.assertLogs('bot.snapshots', 'WARNING'):
+                    self.assertIsNone(snapshots.load(self.path(), 3))
+            else:
+                self.assertIsNone(snapshots.load(self.path(), 3))
+        self.assertTrue(mapped[0].closed)
+
+    def test_broken_files_are_a_miss(self):
+        snapshots.write(self.path(), 3, self.index)
+        with open(self.path(), 'rb') as f:
+            data = f.read()
+        with self.subTest('truncated header'):
+            self.assertMiss(data[:snapshots.HEADER.size - 1])
+        with self.subTest('truncated sections'):
+            self.assertMiss(data[:snapshots.RECORDS_OFFSET])
+        with self.subTest('truncated arrays'):
+            self.assertMiss(data[:len(data) // 2])
+        with self.subTest('garbled magic'):
+            self.assertMiss(b'XMIX' + data[4:], logged=False)
+        with self.subTest('garbled patterns'):
+            self.assertMiss(data.replace(b'k1', b'\xff1'))
+
+    def test_load_or_build(self):
+        index = snapshots.load_or_build(self.directory, self.chat, self.build)
+        self.assertEqual(self.build.call_count, 1)
+        self.assertEqual(self.matches(index), self.matches(self.index))
+        snapshots.load_or_build(self.directory, self.chat, self.build)
+        self.assertEqual(self.build.call_count, 1)
+
+    def test_broken_snapshot_is_written_again(self):
+        with open(self.path(), 'wb') as f:
+            f.write(b'CMIX')
+        with self.assertLogs('bot.snapshots', 'WARNING'):
+            index = snapshots.load_or_build(self.directory, self.chat, self.build)
+        self.assertEqual(self.build.call_count, 1)
+        self.assertIsInstance(index.records, snapshots.MappedRecords)
+
+    def test_newer_version_removes_stale_files(self):
+        snapshots.load_or_build(self.directory, self.chat, self.build)
+        other = Chat(id=77, index_version=1)
+        snapshots.load_or_build(self.directory, other, self.build)
+        # Left behind by a writer that died
+        open(self.path(3) + '.123.tmp', 'w').close()
+        self.chat.index_version = 4
+        snapshots.load_or_build(self.directory, self.chat, self.build)
+        self.assertEqual(self.build.call_count, 3)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['7-4.idx', '77-1.idx'])
+
+    def test_stale_writer_keeps_newer_files(self):
+        self.chat.index_version = 4
+        snapshots.load_or_build(self.directory, self.chat, self.build)
+        self.chat.index_version = 3
+        snapshots.load_or_build(self.directory, self.chat, self.build)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['7-3.idx', '7-4.idx'])
@@ -0,0 +1,117 @@
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+_current = threading.local()
+_file_lock = threading.Lock()
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def enabled():
+    return bool(settings.TRACE_EXPORT)
+
+
+class Trace(object):
+    "Spans of one message going through the pipeline"
+
+    def __init__(self, trace_id, name, started=None):
+        self.trace_id = trace_id
+        self.name = name
+        # Wall clock, the trace may have started in another process
+        self.started = started or time.time()
+        self.duration = None
+        self.error = None
+        self.spans = []
+
+
+    def add_span(self, name, start, duration, **attrs):
+        self.spans.append(dict(name=name, start=start, duration=duration, **attrs))
+
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': self.started,
+            'duration': self.duration,
+            'error': self.error,
+            'spans': self.spans,
+        }
+
+
+def current():
+    return getattr(_current, 'trace', None)
+
+
+@contextmanager
+def trace(name, trace_id=None, started=None):
+    """Make a trace current for the block and export it afterwards if it
+    is kept by tail sampling. Yields None when tracing is off."""
+    if not enabled():
+        yield None
+        return
+    t = Trace(trace_id or new_trace_id(), name, started)
+    _current.trace = t
+    try:
+        yield t
+    except Exception as e:
+        t.error = repr(e)
+        raise
+    finally:
+        _current.trace = None
+        t.duration = time.time() - t.started
+        if _keep(t):
+            _export(t)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the block as a span of the current trace. Yields a dict the
+    block may add attributes to."""
+    t = current()
+    start, started = time.time(), time.perf_counter()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs['error'] = repr(e)
+        raise
+    finally:
+        if t is not None:
+            t.add_span(name, start, time.perf_counter() - started, **attrs)
+
+
+def _keep(t):
+    "Tail sampling: slow and failed traces are always kept"
+    if t.error or any('error' in s for s in t.spans):
+        return True
+    if t.duration >= settings.TRACE_SLOW_SECONDS:
+        return True
+    return random.random() < settings.TRACE_SAMPLE_RATE
+
+
+def _export(t):
+    "Append the trace to a JSON lines file or post it to a collector"
+    destination = settings.TRACE_EXPORT
+    data = t.as_dict()
+    try:
+        if destination.startswith(('http://', 'https://')):
+            requests.post(destination, json=data, timeout=1)
+        else:
+            line = json.dumps(data, ensure_ascii=False) + '\n'
+            with _file_lock, open(destination, 'a', encoding='utf8') as f:
+                f.write(line)
+    except (OSError, requests.RequestException):
+        logger.warning("(export) cannot export trace {} to {}".format(t.trace_id, destination))
@@ -1,17 +1,22 @@
-import re
-import datetime
 import json
 import hashlib
 import base64
+import uuid
+from collections import Counter, defaultdict, namedtuple
 from threading import Thread
+from xml.sax import SAXException
 
-from django.core.cache import cache
+from django.core.cache import cache, caches
 from django.core import serializers
-from .models import User, Chat, Keyword, NegativeKeyword, KeywordsGroup
+from django.core.serializers.base import DeserializationError
+from django.core.serializers.xml_serializer import DefusedXmlException
+from django.db import DatabaseError, connection, transaction
+from . import rules, subscriptions
+from .lru import LRUCache
+from .models import User, Chat, ChatSubscription, Keyword, NegativeKeyword, KeywordsGroup
 
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
@@ -21,95 +26,511 @@ def gen_users_dataprint(user):
     return data
 
 
+ImportReport = namedtuple('ImportReport', ['created', 'skipped', 'skipped_groups'])
+
+
 def replicate_users_dataprint(user, data):
+    """Import keywords, negative keywords and groups from a dataprint
+    made by `gen_users_dataprint` into the user's account.
+
+    The file is parsed in one pass. Keys the user already owns are
+    resolved with one query per model and skipped, everything new is
+    written with `bulk_create` together with its m2m links inside a
+    single transaction, so a broken file leaves no partial state.
+    Groups are matched by name: a group the user already has is left as
+    it is, neither duplicated nor merged, and its name is reported in
+    `skipped_groups`, so importing a file twice changes nothing.
+    Returns an `ImportReport` with per-model counters or None if the
+    file could not be imported."""
+    keywords, nkeywords, groups = [], [], []
     try:
-        deserialized_data = serializers.deserialize("xml", data)
-        for obj in deserialized_data:
+        for obj in serializers.deserialize("xml", data):
             if isinstance(obj.object, Keyword):
-                # if you wanna not to pin all keys
-                # to prev chats -- uncommend this
-                # obj.object.chats.clear()
-                if user.keywords.get_or_none(key=obj.object.key):
-                    continue
-                obj.object.user = user
-                obj.object.id = None
-                obj.save()
+                keywords.append(obj)
             elif isinstance(obj.object, NegativeKeyword):
-                if user.negativekeyword.get_or_none(key=obj.object.key):
-                    continue
-                obj.object.user = user
-                obj.object.id = None
-                obj.save()
-                for keyword in obj.object.keywords.all():
-                    key_text = keyword.key
-                    real_keyword = user.keywords.get_or_none(key=key_text)
-                    obj.object.keywords.remove(keyword)
-                    if real_keyword:
-                        obj.object.keywords.add(real_keyword)
+                nkeywords.append(obj)
             elif isinstance(obj.object, KeywordsGroup):
-                obj.object.user = user
-                obj.object.id = None
-                obj.save()
-                for keyword in obj.object.keys.all():
-                    key_text = keyword.key
-                    real_keyword = user.keywords.get_or_none(key=key_text)
-                    obj.object.keys.remove(keyword)
-                    if real_keyword:
-                        obj.object.keys.add(real_keyword)
-        return True
-    except:
-        return False
-
-
-def check_for_uniqueness(user:str, time:int, message:str):
-    """Return True if there was such message from the user
-    for 30 sec ago, otherwise -- return False"""
-    # from datetime import datetime
-    # from bot.utils import check_for_uniqueness
-    # check_for_uniqueness('username', int(datetime.timestamp(datetime.now())), '12345')
-    DELTA_SECONDS = 30
-    # keys is a list of all keywords in cache
-    keys_str = cache.get("keys")
-    # check if keys if in cache
-    if not keys_str:
-        # if not - create it
-        keys_str = json.dumps([])
-        cache.set("keys", keys_str)
-    # make a list of the string
-    keys = json.loads(keys_str)
-    # get short hash
-    hashing_msg = (user + ' ' + message).encode("utf-8")
-    # print(type(hashing_msg))
-    hash = hashlib.sha1(hashing_msg)
-    hash_str = base64.b64encode(hash.digest()).decode("utf-8")
-    if hash_str in keys:
-        record = cache.get(hash_str)
-        # get username, time and text from record
-        record_re = re.match("(\S+) ([0-9]+) (.+)", record)
-        record_user = record_re.group(1)
-        record_time = int(record_re.group(2))
-        record_text = record_re.group(3)
-        # if the message was sent longer, than DELTA_SECONDS --
-        # delete it and accept the new message as unique
-        # otherwise -- recheck the message
-        time_delta = datetime.datetime.now() - datetime.datetime.fromtimestamp(record_time)
-        if time_delta.total_seconds() < DELTA_SECONDS:
-            # additional check
-            if user == record_user and message == record_text:
-                record = user + ' ' + str(time) + ' ' + message
-                cache.set(hash_str, record)
-                return False
-        else:
-            # also update keys list
-            record = user + ' ' + str(time) + ' ' + message
-            cache.set(hash_str, record)
+                groups.append(obj)
+    except (DeserializationError, SAXException, DefusedXmlException):
+        logger.exception("(replicate_users_dataprint) cannot parse dataprint of {}".format(user))
+        return None
+
+    report = ImportReport(created=Counter(), skipped=Counter(), skipped_groups=[])
+    # Keys of the source keywords by their ids in the file, so the m2m
+    # links of negative keys and groups can be remapped by key text
+    source_keys = {obj.object.pk: obj.object.key for obj in keywords}
+    referenced = set()
+    for obj in [*nkeywords, *groups]:
+        for pks in obj.m2m_data.values():
+            referenced.update(pk for pk in pks if pk not in source_keys)
+    if referenced:
+        # Dataprints made by this very bot may refer to keywords that were
+        # not exported with the file
+        source_keys.update(Keyword.objects.filter(id__in=referenced).values_list('id', 'key'))
+
+    try:
+        with transaction.atomic():
+            # Keywords
+            existing = dict(user.keywords.values_list('key', 'id'))
+            before = len(existing)
+            new_keywords = {}
+            for obj in keywords:
+                key = obj.object.key
+                if not key or key in existing or key in new_keywords:
+                    report.skipped['keywords'] += 1
+                    continue
+                new_keywords[key] = (Keyword(user=user, key=key, mode=rules.mode_of(key), state=obj.object.state), obj.m2m_data.get('chats', []))
+            Keyword.objects.bulk_create([kw for kw, _ in new_keywords.values()], ignore_conflicts=True)
+            # Rows that ran into a conflict are silently left out
+            # by the insert, count what is actually there
+            existing = dict(user.keywords.values_list('key', 'id'))
+            report.created['keywords'] += len(existing) - before
+            report.skipped['keywords'] += len(new_keywords) - (len(existing) - before)
+
+            # If you don't want the keys to be pinned to the chats
+            # they were pinned to in the file -- drop this block
+            chat_ids = set(Chat.objects.filter(id__in={pk for _, pks in new_keywords.values() for pk in pks}).values_list('id', flat=True))
+            Keyword.chats.through.objects.bulk_create([
+                Keyword.chats.through(keyword_id=existing[key], chat_id=pk)
+                for key, (_, pks) in new_keywords.items() for pk in set(pks) if pk in chat_ids
+            ], ignore_conflicts=True)
+
+            # Negative keywords
+            existing_nkeys = set(user.negativekeyword.values_list('key', flat=True))
+            new_nkeywords = {}
+            for obj in nkeywords:
+                key = obj.object.key
+                if not key or key in existing_nkeys or key in new_nkeywords:
+                    report.skipped['negative_keywords'] += 1
+                    continue
+                new_nkeywords[key] = (NegativeKeyword(user=user, key=key), obj.m2m_data.get('keywords', []))
+            before = len(existing_nkeys)
+            NegativeKeyword.objects.bulk_create([nkw for nkw, _ in new_nkeywords.values()], ignore_conflicts=True)
+            inserted = user.negativekeyword.count() - before
+            report.created['negative_keywords'] += inserted
+            report.skipped['negative_keywords'] += len(new_nkeywords) - inserted
+
+            nkey_ids = dict(user.negativekeyword.filter(key__in=new_nkeywords).values_list('key', 'id'))
+            negative_links = [
+                NegativeKeyword.keywords.through(negativekeyword_id=nkey_ids[key], keyword_id=kw_id)
+                for key, (_, pks) in new_nkeywords.items()
+                for kw_id in _remap_keywords(pks, source_keys, existing)
+            ]
+            NegativeKeyword.keywords.through.objects.bulk_create(negative_links, ignore_conflicts=True)
+
+            # Groups
+            existing_groups = set(user.groups.values_list('name', flat=True))
+            new_groups = {}
+            for obj in groups:
+                name = obj.object.name
+                if name in existing_groups or name in new_groups:
+                    report.skipped['groups'] += 1
+                    report.skipped_groups.append(name)
+                    continue
+                new_groups[name] = (KeywordsGroup(user=user, name=name, state=obj.object.state), obj.m2m_data.get('keys', []))
+            KeywordsGroup.objects.bulk_create([group for group, _ in new_groups.values()])
+            report.created['groups'] += len(new_groups)
+
+            group_ids = dict(user.groups.filter(name__in=new_groups).values_list('name', 'id'))
+            KeywordsGroup.keys.through.objects.bulk_create([
+                KeywordsGroup.keys.through(keywordsgroup_id=group_ids[name], keyword_id=kw_id)
+                for name, (_, pks) in new_groups.items()
+                for kw_id in _remap_keywords(pks, source_keys, existing)
+            ], ignore_conflicts=True)
+
+            subscriptions.refresh_keywords(
+                [existing[key] for key in new_keywords] + [link.keyword_id for link in negative_links]
+            )
+    except DatabaseError:
+        logger.exception("(replicate_users_dataprint) cannot import dataprint of {}".format(user))
+        return None
+
+    # bulk_create does not send signals
+    bump_user_data_version(user.id)
+    logger.debug("(replicate_users_dataprint) created {} skipped {}".format(dict(report.created), dict(report.skipped)))
+    return report
+
+
+def _remap_keywords(pks, source_keys, user_keys):
+    "Map keyword ids from a dataprint to the ids of the user's keywords with the same key"
+    ids = {user_keys.get(source_keys.get(pk)) for pk in pks}
+    ids.discard(None)
+    return ids
+
+
+SYNCPRINT_FORMAT = 'chatmonitor-sync'
+SYNCPRINT_VERSION = 1
+
+SyncReport = namedtuple('SyncReport', ['added', 'updated', 'removed'])
+
+
+def _content_hash(*parts):
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _users_sync_state(user):
+    """Return the user's keywords, negative keywords and groups keyed by
+    their content hashes. Takes five queries whatever the size of the account."""
+    keywords = {}
+    for pk, key, state in user.keywords.values_list('id', 'key', 'state'):
+        keywords[_content_hash('keyword', key, state)] = {'id': pk, 'key': key, 'state': state}
+
+    links = defaultdict(list)
+    for pk, key in NegativeKeyword.keywords.through.objects.filter(negativekeyword__user=user).values_list('negativekeyword_id', 'keyword__key'):
+        links[pk].append(key)
+    negative_keywords = {}
+    for pk, key in user.negativekeyword.values_list('id', 'key'):
+        keys = sorted(links[pk])
+        negative_keywords[_content_hash('negative_keyword', key, keys)] = {'id': pk, 'key': key, 'keywords': keys}
+
+    links = defaultdict(list)
+    for pk, key in KeywordsGroup.keys.through.objects.filter(keywordsgroup__user=user).values_list('keywordsgroup_id', 'keyword__key'):
+        links[pk].append(key)
+    groups = {}
+    for pk, name, state in user.groups.values_list('id', 'name', 'state'):
+        keys = sorted(links[pk])
+        groups[_content_hash('group', name, state, keys)] = {'id': pk, 'name': name, 'state': state, 'keys': keys}
+
+    return {'keywords': keywords, 'negative_keywords': negative_keywords, 'groups': groups}
+
+
+def gen_users_syncprint(user):
+    """Export the user's keywords, negative keywords and groups for
+    `sync_users_dataprint`. Every object carries a content hash, so two
+    exports can be diffed without looking at the objects themselves.
+    Chat pins are not exported as chats differ between bot instances."""
+    state = _users_sync_state(user)
+    data = {
+        'format': SYNCPRINT_FORMAT,
+        'version': SYNCPRINT_VERSION,
+        **{model: [{'hash': h, **{f: v for f, v in obj.items() if f != 'id'}} for h, obj in objects.items()]
+           for model, objects in state.items()},
+    }
+    return json.dumps(data, ensure_ascii=False, indent=1)
+
+
+def is_syncprint(data):
+    return data.lstrip().startswith('{')
+
+
+def sync_users_dataprint(user, data):
+    """Make the user's keywords, negative keywords and groups the same as
+    in a syncprint made by `gen_users_syncprint`.
+
+    Only objects whose content hash differs from the user's current state
+    are touched: missing ones are created, extra ones are removed and the
+    ones with the same key but other content are updated in place, so the
+    keywords keep their chat pins. Returns a `SyncReport` or None if the
+    file could not be applied."""
+    try:
+        source = json.loads(data)
+        if source.get('format') != SYNCPRINT_FORMAT or source.get('version') != SYNCPRINT_VERSION:
+            raise ValueError("Unsupported syncprint {} v{}".format(source.get('format'), source.get('version')))
+        source = {model: {obj['hash']: obj for obj in source[model]} for model in ('keywords', 'negative_keywords', 'groups')}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        logger.exception("(sync_users_dataprint) cannot parse syncprint of {}".format(user))
+        return None
+
+    target = _users_sync_state(user)
+    report = SyncReport(added=Counter(), updated=Counter(), removed=Counter())
+
+    def diff(model, identity):
+        "Split the difference into objects to add, to update and to remove, matching them by identity"
+        src, dst = source[model], target[model]
+        removed = {dst[h][identity]: dst[h] for h in dst.keys() - src.keys()}
+        added, updated = [], []
+        for h in src.keys() - dst.keys():
+            obj = src[h]
+            if obj[identity] in removed:
+                updated.append((removed.pop(obj[identity])['id'], obj))
+            else:
+                added.append(obj)
+        report.added[model] += len(added)
+        report.updated[model] += len(updated)
+        report.removed[model] += len(removed)
+        return added, updated, [obj['id'] for obj in removed.values()]
+
+    try:
+        with transaction.atomic():
+            # Keywords
+            added, updated, removed = diff('keywords', 'key')
+            Keyword.objects.filter(id__in=removed).delete()
+            for state in (True, False):
+                Keyword.objects.filter(id__in=[pk for pk, obj in updated if obj['state'] == state]).update(state=state)
+            Keyword.objects.bulk_create([
+                Keyword(user=user, key=obj['key'], mode=rules.mode_of(obj['key']), state=obj['state']) for obj in added
+            ], ignore_conflicts=True)
+
+            # Negative keywords and groups are linked to keywords by keys
+            nkeys_added, nkeys_updated, nkeys_removed = diff('negative_keywords', 'key')
+            groups_added, groups_updated, groups_removed = diff('groups', 'name')
+            linked = set()
+            for obj in [*nkeys_added, *(obj for _, obj in nkeys_updated)]:
+                linked.update(obj['keywords'])
+            for obj in [*groups_added, *(obj for _, obj in groups_updated)]:
+                linked.update(obj['keys'])
+            key_ids = dict(user.keywords.filter(key__in=linked).values_list('key', 'id'))
+
+            # Negative keywords
+            NegativeKeyword.objects.filter(id__in=nkeys_removed).delete()
+            NegativeKeyword.objects.bulk_create([NegativeKeyword(user=user, key=obj['key']) for obj in nkeys_added], ignore_conflicts=True)
+            nkey_ids = dict(user.negativekeyword.filter(key__in=[obj['key'] for obj in nkeys_added]).values_list('key', 'id'))
+            relinked = [(pk, obj) for pk, obj in nkeys_updated] + [(nkey_ids[obj['key']], obj) for obj in nkeys_added]
+            unlinked = NegativeKeyword.keywords.through.objects.filter(negativekeyword_id__in=[pk for pk, _ in nkeys_updated])
+            # Subscriptions of keywords that lose or gain negative keys are rewritten below
+            touched = set(unlinked.values_list('keyword_id', flat=True))
+            unlinked.delete()
+            negative_links = [
+                NegativeKeyword.keywords.through(negativekeyword_id=pk, keyword_id=key_ids[key])
+                for pk, obj in relinked for key in obj['keywords'] if key in key_ids
+            ]
+            NegativeKeyword.keywords.through.objects.bulk_create(negative_links, ignore_conflicts=True)
+            touched.update(link.keyword_id for link in negative_links)
+            touched.update(pk for pk, _ in updated)
+
+            # Groups
+            KeywordsGroup.objects.filter(id__in=groups_removed).delete()
+            for state in (True, False):
+                KeywordsGroup.objects.filter(id__in=[pk for pk, obj in groups_updated if obj['state'] == state]).update(state=state)
+            KeywordsGroup.objects.bulk_create([KeywordsGroup(user=user, name=obj['name'], state=obj['state']) for obj in groups_added])
+            group_ids = dict(user.groups.filter(name__in=[obj['name'] for obj in groups_added]).values_list('name', 'id'))
+            relinked = [(pk, obj) for pk, obj in groups_updated] + [(group_ids[obj['name']], obj) for obj in groups_added]
+            KeywordsGroup.keys.through.objects.filter(keywordsgroup_id__in=[pk for pk, _ in groups_updated]).delete()
+            KeywordsGroup.keys.through.objects.bulk_create([
+                KeywordsGroup.keys.through(keywordsgroup_id=pk, keyword_id=key_ids[key])
+                for pk, obj in relinked for key in obj['keys'] if key in key_ids
+            ], ignore_conflicts=True)
+
+            subscriptions.refresh_keywords(touched)
+    except (DatabaseError, KeyError, TypeError):
+        logger.exception("(sync_users_dataprint) cannot apply syncprint of {}".format(user))
+        return None
+
+    # Neither bulk_create nor update send signals
+    bump_user_data_version(user.id)
+    logger.debug("(sync_users_dataprint) added {} updated {} removed {}".format(dict(report.added), dict(report.updated), dict(report.removed)))
+    return report
+
+
+# Keys ingestion
+
+# Pastes with more keys than this are added by a background task
+BULK_KEYS_LIMIT = 300
+# Keeps `key IN (...)` lookups under SQL parameter limits
+KEYS_LOOKUP_BATCH = 500
+
+
+def normalize_keys(text):
+    "Split a pasted list into keys, one per line, with whitespace collapsed"
+    keys = (' '.join(line.split()) for line in text.split('\n'))
+    return [key for key in keys if key]
+
+
+def add_keys(user, model, keys):
+    """Create the user's keywords or negative keywords (`model`) from
+    a list of keys with one lookup per batch and one insert.
+    Returns the number of added keys and the number of keys that
+    repeated or that the user already had."""
+    unique = list(dict.fromkeys(keys))
+    existing = set()
+    for i in range(0, len(unique), KEYS_LOOKUP_BATCH):
+        existing.update(model.objects.filter(user=user, key__in=unique[i:i + KEYS_LOOKUP_BATCH])
+                        .values_list('key', flat=True))
+    new = [key for key in unique if key not in existing]
+    if model is Keyword:
+        objects = [Keyword(user=user, key=key, mode=rules.mode_of(key)) for key in new]
     else:
-        # there was no such message before
-        record = user + ' ' + str(time) + ' ' + message
-        cache.set(hash_str, record)
-        keys.append(hash_str)
-        cache.set("keys", json.dumps(keys))
-    return True
+        objects = [model(user=user, key=key) for key in new]
+    model.objects.bulk_create(objects, ignore_conflicts=True)
+    # bulk_create does not send signals
+    bump_user_data_version(user.id)
+    logger.debug("(add_keys) added {} of {} keys for {}".format(len(new), len(keys), user))
+    return len(new), len(keys) - len(new)
+
+
+# Keys deletion
+
+DELETE_CHUNK_SIZE = 1000
+
+
+def delete_all_keywords(user, progress=None):
+    """Delete all user's keywords in chunks of DELETE_CHUNK_SIZE, each in
+    its own transaction, calling `progress(deleted, total)` after each.
+
+    Rows are deleted with plain DELETEs, links first, and keywords with
+    raw SQL, skipping the cascade collector, so no signals are sent --
+    the user's data version and the chats' match indexes are
+    invalidated once at the end instead."""
+    ids = list(user.keywords.values_list('id', flat=True))
+    chats = set()
+    for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+        chunk = ids[i:i + DELETE_CHUNK_SIZE]
+        with transaction.atomic():
+            Keyword.chats.through.objects.filter(keyword_id__in=chunk).delete()
+            NegativeKeyword.keywords.through.objects.filter(keyword_id__in=chunk).delete()
+            KeywordsGroup.keys.through.objects.filter(keyword_id__in=chunk).delete()
+            stale = ChatSubscription.objects.filter(keyword_id__in=chunk)
+            chats.update(stale.values_list('chat_id', flat=True))
+            stale.delete()
+            # Nothing refers to the keywords anymore
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM {} WHERE id IN ({})'.format(
+                    connection.ops.quote_name(Keyword._meta.db_table), ', '.join(['%s'] * len(chunk))
+                ), chunk)
+        if progress is not None:
+            progress(min(i + DELETE_CHUNK_SIZE, len(ids)), len(ids))
+
+    bump_user_data_version(user.id)
+    subscriptions.invalidate_chats(chats)
+    logger.debug("(delete_all_keywords) deleted {} keywords of {}".format(len(ids), user))
+    return len(ids)
+
+
+# Users resolution
+
+# Handlers look up the sender of every update. Entries are dropped by
+# signals when a user changes in this process and expire on their own
+# to pick up changes made elsewhere. Chats and groups are not cached:
+# bulk updates and Celery workers change them without any signal here.
+_users = LRUCache(maxsize=4096, ttl=60)
+
+
+def get_cached_user(chat_id):
+    """Like `User.objects.get(chat_id=chat_id)`, but served from a
+    process-wide LRU. It keeps the row, not the instance, and every call
+    builds a new instance, so handlers can change it freely"""
+    fields = [field.attname for field in User._meta.concrete_fields]
+    row = _users.get(chat_id)
+    if row is None:
+        user = User.objects.get(chat_id=chat_id)
+        _users.set(chat_id, (user._state.db, [getattr(user, field) for field in fields]))
+        return user
+    db, values = row
+    return User.from_db(db, fields, values)
+
+
+def forget_cached_user(user):
+    "Drop the user from the LRU of `get_cached_user`"
+    _users.delete(user.chat_id)
+
+
+def resolve_user(update):
+    """Return the bot's user who sent the update. The user is resolved once
+    per update and attached to it, so all the handlers share the instance"""
+    user = getattr(update, 'bot_user', None)
+    if user is None:
+        user = get_cached_user(update.effective_user.id)
+        update.bot_user = user
+    return user
+
+
+
+# Cache namespaces
+# Every entry the bot caches lives under its namespace prefix and
+# expires after the namespace's timeout, so nothing has to be flushed
+
+USER_DATA_VERSION_KEY = 'user_data_version:{}'
+# A lost version only makes what was cached against it be rebuilt
+USER_DATA_VERSION_TIMEOUT = 30 * 24 * 60 * 60
+INLINE_PAGE_KEY = 'inline_page:{user}:{listing}:{query}:{offset}:{version}'
+INLINE_PAGE_TIMEOUT = 10 * 60
+DEDUP_KEY = 'dedup:{}'
+DEDUP_TIMEOUT = 30
+
+
+def sweep_cache():
+    """Remove expired entries the cache backend keeps around, if it has
+    a `sweep` method like `bot.cache.SweptFileBasedCache`. Redis expires
+    them by itself. Returns the number of removed entries"""
+    backend = caches['default']
+    sweep = getattr(backend, 'sweep', None)
+    if sweep is None:
+        logger.info("(sweep_cache) {} can't be swept, nothing to do".format(type(backend).__name__))
+        return 0
+    return sweep()
+
+
+# Inline listings cache
+
+
+def get_user_data_version(user_id):
+    "Return an opaque version of the user's keys, groups and pins"
+    key = USER_DATA_VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, USER_DATA_VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump_user_data_version(user_id):
+    "Invalidate everything cached against the user's data version"
+    cache.set(USER_DATA_VERSION_KEY.format(user_id), uuid.uuid4().hex, USER_DATA_VERSION_TIMEOUT)
+
+
+def inline_page_key(user_id, listing, query, offset):
+    query = hashlib.sha1(query.encode("utf-8")).hexdigest()
+    return INLINE_PAGE_KEY.format(user=user_id, listing=listing, query=query, offset=offset or 1, version=get_user_data_version(user_id))
+
+
+# Search in inline listings
+
+# (model, field, user id) -> (user's data version, [(lowercased value, id)])
+_search_indexes = LRUCache(maxsize=256, ttl=10 * 60)
+
+
+def _get_search_index(model, field, user_id):
+    "Return lowercased values of the user's objects, reloaded when the user's data changes"
+    key = (model, field, user_id)
+    version = get_user_data_version(user_id)
+    cached = _search_indexes.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    index = [(value.lower(), pk) for pk, value in model.objects.filter(user_id=user_id).values_list('id', field)]
+
+    _search_indexes.set(key, (version, index))
+    return index
+
+
+def search(objects, field, user_id, term):
+    """Narrow down a queryset of the user's keywords, negative keywords
+    or groups to the ones whose `field` contains what the user typed,
+    case-insensitively. Every match is returned, listings page them.
+
+    On PostgreSQL it's `icontains` served by the trigram indexes. Other
+    databases only fold the case of ASCII letters in LIKE, so there the
+    same substring match is a linear scan over an in-memory list of the
+    user's values -- there is no index, which is fine for the few
+    thousand keys an account has."""
+    if not term:
+        return objects
+    if connection.vendor == 'postgresql':
+        return objects.filter(**{field + '__icontains': term})
+
+    term = term.lower()
+    ids = [pk for value, pk in _get_search_index(objects.model, field, user_id) if term in value]
+    return objects.filter(id__in=ids)
+
+
+def check_for_uniqueness(user:str, message:str):
+    """Return False if the user sent the same message less than
+    DEDUP_TIMEOUT seconds ago, otherwise -- remember it and return True"""
+    # from bot.utils import check_for_uniqueness
+    # check_for_uniqueness('username', '12345')
+    record = user + ' ' + message
+    # get short hash
+    hash = hashlib.sha1(record.encode("utf-8"))
+    key = DEDUP_KEY.format(base64.b64encode(hash.digest()).decode("utf-8"))
+    # the entry expires by itself, so there is nothing to clean up
+    if cache.add(key, record, DEDUP_TIMEOUT):
+        return True
+    # additional check against hash collisions
+    if cache.get(key) != record:
+        return True
+    # repeats keep the message blocked
+    cache.set(key, record, DEDUP_TIMEOUT)
+    return False
 
 
 def threaded(func):
@@ -122,65 +543,70 @@ def threaded(func):
 @threaded
 def pin_all_to_chat(user, chat):
     logger.debug("(pin_all_to_chat) started")
-    for kw in user.keywords.all():
-        chat.keywords.add(kw)
+    chat.keywords.add(*user.keywords.all())
     logger.debug("(pin_all_to_chat) finished")
 
 
 @threaded
 def unpin_all_from_chat(user, chat):
     logger.debug("(unpin_all_from_chat) started")
-    for kw in chat.keywords.filter(user=user):
-        chat.keywords.remove(kw)
+    chat.keywords.remove(*chat.keywords.filter(user=user))
     logger.debug("(unpin_all_from_chat) finished")
 
 
 @threaded
 def pin_all_negative_to_all(user):
     logger.debug("(pin_all_negative_to_all) started")
-    for key in user.keywords.all():
-        for kw in user.negativekeyword.all():
-            key.negativekeyword.add(kw)
+    nkeys = list(user.negativekeyword.values_list('id', flat=True))
+    NegativeKeyword.keywords.through.objects.bulk_create([
+        NegativeKeyword.keywords.through(negativekeyword_id=nkey, keyword_id=key)
+        for key in user.keywords.values_list('id', flat=True) for nkey in nkeys
+    ], ignore_conflicts=True)
+    # bulk_create does not send signals
+    bump_user_data_version(user.id)
+    subscriptions.refresh_user(user.id)
     logger.debug("(pin_all_negative_to_all) finished")
 
 
 @threaded
 def pin_all_negative_to_one(user, key):
     logger.debug("(pin_all_negative_to_one) started")
-    for kw in user.negativekeyword.all():
-        key.negativekeyword.add(kw)
+    key.negativekeyword.add(*user.negativekeyword.all())
     logger.debug("(pin_all_negative_to_one) finished")
 
 
 @threaded
 def pin_one_negative_to_all(user, nkw):
     logger.debug("(pin_one_negative_to_all) started")
-    for key in user.keywords.all():
-        key.negativekeyword.add(nkw)
+    nkw.keywords.add(*user.keywords.all())
     logger.debug("(pin_one_negative_to_all) finished")
 
 
 @threaded
 def unpin_all_negative_from_one(user, key):
     logger.debug("(unpin_all_negative_from_one) started")
-    for kw in key.negativekeyword.filter(user=user):
-        key.negativekeyword.remove(kw)
+    key.negativekeyword.remove(*key.negativekeyword.filter(user=user))
     logger.debug("(unpin_all_negative_from_one) finished")
 
 
+def switch_group(group, state):
+    "Turn the group's keys on or off with one update"
+    keys = list(group.keys.values_list('id', flat=True))
+    Keyword.objects.filter(id__in=keys).update(state=state)
+    # update does not send signals
+    bump_user_data_version(group.user_id)
+    subscriptions.refresh_keywords(keys)
+
+
 @threaded
 def switch_group_on(group):
     logger.debug("(switch_group_on) started")
-    for key in group.keys.all():
-        key.state = True
-        key.save()
+    switch_group(group, True)
     logger.debug("(switch_group_on) finished")
 
 
 @threaded
 def switch_group_off(group):
     logger.debug("(switch_group_off) started")
-    for key in group.keys.all():
-        key.state = False
-        key.save()
+    switch_group(group, False)
     logger.debug("(switch_group_off) finished")
@@ -1,3 +1,24 @@
-from django.shortcuts import render
+import hmac
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from . import metrics
+
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+def _may_scrape(request):
+    if not settings.METRICS_TOKEN:
+        return request.META.get('REMOTE_ADDR') in LOCAL_ADDRESSES
+    expected = 'Bearer {}'.format(settings.METRICS_TOKEN)
+    return hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), expected)
+
+
+def export_metrics(request):
+    "Prometheus scrape endpoint, see METRICS_TOKEN"
+    if not _may_scrape(request):
+        return HttpResponseForbidden()
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
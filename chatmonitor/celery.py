@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_init, worker_process_shutdown
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatmonitor.settings')
@@ -17,12 +18,29 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
-    'add-every-12-hors': {
-        'task': 'bot.tasks.flush_cache',
-        'schedule': 43200.0
+    'sweep-cache-every-hour': {
+        'task': 'bot.tasks.sweep_cache',
+        'schedule': 3600.0
     },
 }
 
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    "Serve the worker's metrics if METRICS_PORT is set"
+    port = os.environ.get('METRICS_PORT')
+    if port:
+        from django.conf import settings
+        from bot import metrics
+        metrics.start_exporter(int(port), settings.METRICS_ADDR)
+
+
+@worker_process_shutdown.connect
+def push_digests(**kwargs):
+    "Don't lose latency digests recorded since the last snapshot"
+    from bot import digests
+    digests.snapshot()
+
+
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
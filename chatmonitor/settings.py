@@ -24,6 +24,13 @@ CELERY_WORKER_CONCURRENCY = 5
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 
+# Tracing of the message pipeline, see bot/tracing.py. Export to a
+# JSON lines file path or an http(s) collector URL, empty turns it off
+TRACE_EXPORT = os.environ.get('TRACE_EXPORT', '')
+# Traces slower than this or failed are always kept, others are sampled
+TRACE_SLOW_SECONDS = float(os.environ.get('TRACE_SLOW_SECONDS', 2))
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
 
@@ -172,6 +179,11 @@ LOGGING = {
             'handlers': ['console'],
             'level': 'DEBUG',
         },
+        'bot': {
+            'handlers': ['console'],
+            'level': os.environ.get('LOG_LEVEL', 'DEBUG' if DEBUG else 'INFO'),
+            'propagate': False,
+        },
     },
 }
 
@@ -199,12 +211,28 @@ LOGGING = {
 #     }
 # }
 
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
-        'LOCATION': '/var/tmp/django_cache',
+# Redis is shared by the web and worker containers, a small in-process
+# LRU in front of it keeps hot entries. Falls back to the file cache
+# when there is no Redis (e.g. local runs).
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'bot.cache.TwoTierCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+            'OPTIONS': {
+                'LOCAL_MAXSIZE': 1024,
+                # Seconds a process may serve its own copy of an entry
+                'LOCAL_TIMEOUT': 5,
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'bot.cache.SweptFileBasedCache',
+            'LOCATION': '/var/tmp/django_cache',
+        }
     }
-}
 
 
 # import Bot Settings
@@ -16,7 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, re_path, include
 
+from bot.views import export_metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', export_metrics, name='metrics'),
     re_path(r'^', include('django_telegrambot.urls')),
 ]